@@ -0,0 +1,105 @@
+"""
+Startup cost of entry points: import time, memory and heavy libraries loaded by each of them.
+Each entry point is imported in a fresh interpreter several times (the best time is taken).
+
+Usage:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --repeat 10 --top 10 --json
+Run it on two revisions (e.g. with `git stash`) to compare them.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOCAL_PACKAGES = {'server', 'celery_worker', 'site', 'encodings'}
+HEAVY_MODULES = ['cv2', 'numpy', 'shapely', 'ffmpeg', 'websockets', 'requests', 'm3u8', 'server.tasks']
+ENTRY_POINTS = {
+    # Flask API and admin (gunicorn workers, `flask` CLI)
+    'api': 'from server import create_app\napp = create_app()',
+    # restart_watchers.py (without sending tasks)
+    'restart_watchers': 'import celery_worker\nfrom server.models import Camera',
+    # celery worker before it imports tasks
+    'celery_app': 'import celery_worker',
+    # celery worker with tasks (watchers load vision libraries anyway)
+    'worker': 'import celery_worker\nimport server.tasks',
+}
+PROBE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+exec(compile({code!r}, '<entry>', 'exec'))
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def run_probe(code: str, work_dir: str, importtime: bool = False) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.getenv('PYTHONPATH')])))
+    # DB and brokers are not connected on import, SQLite avoids MySQL driver requirement
+    env.setdefault('DATABASE_URL', 'sqlite:///{}'.format(os.path.join(work_dir, 'import_time.db')))
+    args = [sys.executable] + (['-X', 'importtime'] if importtime else []) + \
+        ['-c', PROBE.format(code=code, heavy=HEAVY_MODULES)]
+    # cwd is a temp dir: the app creates LOG_DIR relative to it
+    result = subprocess.run(args, cwd=work_dir, env=env, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'probe failed')
+    return result
+
+
+def slowest_imports(stderr: str, top: int) -> List[tuple]:
+    """
+    Parses `-X importtime` output
+    :return: [(cumulative seconds, package)] of the slowest libraries (their outermost imports)
+    """
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        if package in LOCAL_PACKAGES:
+            continue
+        packages[package] = max(packages.get(package, 0), int(cumulative) / 1e6)
+    return sorted(((seconds, name) for name, seconds in packages.items()), reverse=True)[:top]
+
+
+def measure(name: str, code: str, repeat: int, top: int, work_dir: str) -> Dict:
+    runs = [json.loads(run_probe(code, work_dir).stdout.strip().splitlines()[-1]) for _ in range(repeat)]
+    seconds = [run['seconds'] for run in runs]
+    result = {'entry': name, 'best_seconds': min(seconds), 'median_seconds': statistics.median(seconds),
+              'max_rss_mb': min(run['max_rss_mb'] for run in runs), 'heavy': runs[0]['heavy']}
+    if top:
+        result['slowest'] = slowest_imports(run_probe(code, work_dir, importtime=True).stderr, top)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time of entry points')
+    parser.add_argument('--entry', action='append', choices=sorted(ENTRY_POINTS), help='entry points (all by default)')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per entry point')
+    parser.add_argument('--top', type=int, default=0, help='show this number of the slowest imported libraries')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='hypersight_import_')
+    results = [measure(name, ENTRY_POINTS[name], args.repeat, args.top, work_dir)
+               for name in args.entry or ENTRY_POINTS]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{:<18}{:>10}{:>12}{:>10}  {}'.format('entry', 'best, s', 'median, s', 'RSS, MB', 'heavy modules loaded'))
+    for result in results:
+        print('{entry:<18}{best_seconds:>10.3f}{median_seconds:>12.3f}{max_rss_mb:>10.1f}  '.format(**result) +
+              (', '.join(result['heavy']) or '-'))
+        for seconds, package in result.get('slowest', []):
+            print('    {:>8.3f}  {}'.format(seconds, package))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Microbenchmarks of per-frame hot paths: geometry (distance, at_roe), detections unpacking (split_detections)
+and processors (ObjectsCounter.process, TrafficCounter._analyze_frame) on synthetic frames.
+Events are collected in memory, no DB or Redis is used.
+
+Per-frame costs are compared with a stored baseline to catch algorithmic regressions:
+    python benchmarks/processors_micro.py --save-baseline    # on a known good revision
+    python benchmarks/processors_micro.py                    # exits with 1 if a case is slower than threshold
+"""
+import argparse
+import datetime as dt
+import json
+import math
+import os
+import random
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.models import DetectedObject, Frame, ObjectsCounter, TrafficCounter, at_roe, distance  # noqa: E402
+from server.tasks import split_detections  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'processors_baseline.json')
+IMAGE = np.zeros((1, 1, 3), dtype=np.uint8)
+
+
+class ListSink:
+    """
+    Events storage of benchmarked processors
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, processor_id: int, ts: dt.datetime, value: int):
+        self.events.append((processor_id, ts, value))
+
+
+def make_zones(n_zones: int, n_vertices: int) -> str:
+    """
+    Returns zones_str with n_zones star-like polygons of n_vertices each placed in a row
+    """
+    zones = []
+    width = 1 / n_zones
+    for i in range(n_zones):
+        cx, cy = (i + 0.5) * width, 0.5
+        zone = []
+        for k in range(n_vertices):
+            angle = 2 * math.pi * k / n_vertices
+            scale = 1 if k % 2 == 0 else 0.7
+            zone.append([cx + 0.45 * width * scale * math.cos(angle), cy + 0.45 * scale * math.sin(angle)])
+        zones.append(zone)
+    return json.dumps(zones)
+
+
+def make_frames(n_frames: int, n_objects: int, fps: float = 2, seed: int = 0) -> List[Frame]:
+    """
+    Frames with objects moving from left to right (so traffic counter tracks are extended and finished)
+    """
+    rnd = random.Random(seed)
+    starts = [(rnd.random(), rnd.random(), rnd.uniform(0.005, 0.02)) for _ in range(n_objects)]
+    ts = dt.datetime(2020, 1, 1)
+    frames = []
+    for i in range(n_frames):
+        frame = Frame(IMAGE, ts + dt.timedelta(seconds=i / fps))
+        for x, y, speed in starts:
+            x_min = (x + speed * i) % 0.95
+            frame.objects.append(DetectedObject(x_min, y * 0.9, x_min + 0.05, y * 0.9 + 0.1, 0.9, 0))
+        frames.append(frame)
+    return frames
+
+
+def make_detections(n_objects: int, grid_size: Tuple[int, int], seed: int = 0) -> List[list]:
+    rnd = random.Random(seed)
+    return [[x, y, x + 0.02, y + 0.04, 0.9, 0] for x, y in
+            ((rnd.random() * 0.98, rnd.random() * 0.96) for _ in range(n_objects * grid_size[0] * grid_size[1]))]
+
+
+def measure(run: Callable[[], int], min_time: float, repeat: int) -> float:
+    """
+    :param run: function processing some frames, returns number of processed frames
+    :return: best seconds per frame
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        frames = 0
+        start = time.perf_counter()
+        while True:
+            frames += run()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / frames)
+    return best
+
+
+def cases(objects_counts: List[int], zones_counts: List[int], vertices_counts: List[int],
+          n_frames: int) -> Dict[str, Callable[[], int]]:
+    result = {}
+    for n_objects in objects_counts:
+        frames = make_frames(n_frames, n_objects)
+        points = [obj.point() for frame in frames for obj in frame.objects]
+
+        def run_distance(points=points, n_objects=n_objects):
+            target = points[0]
+            for point in points:
+                distance(point, target)
+            return len(points) // n_objects
+
+        result['distance/objects={}'.format(n_objects)] = run_distance
+
+        for grid in ((1, 1), (2, 2), (3, 3)):
+            detections = make_detections(n_objects, grid)
+
+            def run_split(detections=detections, grid=grid):
+                split_detections(detections, grid[0] * grid[1], grid)
+                return grid[0] * grid[1]
+
+            result['split_detections/objects={}/grid={}x{}'.format(n_objects, *grid)] = run_split
+
+        for n_zones in zones_counts:
+            for n_vertices in vertices_counts:
+                suffix = 'objects={}/zones={}/vertices={}'.format(n_objects, n_zones, n_vertices)
+                zones_str = make_zones(n_zones, n_vertices)
+
+                counter = ObjectsCounter(camera_id=1, zones_str=zones_str, threshold=0.5)
+                polygons = counter.polygons
+
+                def run_at_roe(frames=frames, polygons=polygons):
+                    for frame in frames:
+                        for obj in frame.objects:
+                            at_roe(obj, polygons)
+                    return len(frames)
+
+                result['at_roe/' + suffix] = run_at_roe
+
+                def run_objects(frames=frames, zones_str=zones_str):
+                    proc = ObjectsCounter(camera_id=1, zones_str=zones_str, threshold=0.5)
+                    proc.id = 1
+                    proc.event_sink = ListSink()
+                    proc.process(frames)
+                    return len(frames)
+
+                result['ObjectsCounter.process/' + suffix] = run_objects
+
+                def run_traffic(frames=frames, zones_str=zones_str):
+                    proc = TrafficCounter(camera_id=1, zones_str=zones_str, threshold=0.5)
+                    proc.id = 1
+                    proc.event_sink = ListSink()
+                    for frame in frames:
+                        proc._analyze_frame(frame)
+                    return len(frames)
+
+                result['TrafficCounter._analyze_frame/' + suffix] = run_traffic
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Processors microbenchmarks')
+    parser.add_argument('--objects', default='1,10,50,100,500', help='objects per frame')
+    parser.add_argument('--zones', default='1,4', help='zones per processor')
+    parser.add_argument('--vertices', default='4,32', help='vertices per zone')
+    parser.add_argument('--frames', type=int, default=20, help='frames per run')
+    parser.add_argument('--min-time', type=float, default=0.2, help='min measurement time of a case, seconds')
+    parser.add_argument('--repeat', type=int, default=3, help='measurements per case (the best is taken)')
+    parser.add_argument('--filter', default='', help='run only cases containing this substring')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='save results as the baseline')
+    parser.add_argument('--threshold', type=float, default=1.3,
+                        help='a case is a regression if it is slower than baseline by this factor')
+    args = parser.parse_args()
+
+    def ints(value):
+        return [int(v) for v in value.split(',')]
+
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['cases']
+
+    results = {}
+    regressions = []
+    print('{:<72}{:>14}{:>10}'.format('case', 'us/frame', 'vs base'))
+    for name, run in cases(ints(args.objects), ints(args.zones), ints(args.vertices), args.frames).items():
+        if args.filter not in name:
+            continue
+        cost = measure(run, args.min_time, args.repeat)
+        results[name] = cost
+        ratio = cost / baseline[name] if name in baseline else None
+        mark = ''
+        if ratio is not None and ratio > args.threshold:
+            regressions.append(name)
+            mark = ' !'
+        print('{:<72}{:>14.2f}{:>10}{}'.format(name, cost * 1e6, '{:.2f}'.format(ratio) if ratio else '-', mark))
+
+    if args.save_baseline:
+        # cases of other runs (--filter) are kept
+        saved = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                saved = json.load(f)['cases']
+        saved.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'cases': saved}, f, indent=2, sort_keys=True)
+        print('Baseline saved to {}'.format(args.baseline))
+    elif not baseline:
+        print('No baseline found at {}; run with --save-baseline to create it'.format(args.baseline))
+    if regressions:
+        print('{} regressions (slower than baseline by more than {}x):'.format(len(regressions), args.threshold))
+        for name in regressions:
+            print('  ' + name)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
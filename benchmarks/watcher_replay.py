@@ -0,0 +1,265 @@
+"""
+End-to-end replay benchmark of the camera watcher.
+
+Recorded (or generated) .ts segments are served by a local HLS server, objects are "detected" by a local stub
+detector with configurable latency and the real watch_camera loop processes them with a temporary SQLite DB.
+It runs offline (Redis is optional: without it heartbeats and metrics pushes fail and are logged).
+
+Usage:
+    python benchmarks/watcher_replay.py --segments 'records/*.ts' --grid 2x2 --fps 2 --traffic 2 --objects 2
+    python benchmarks/watcher_replay.py --generate 6 --detector-latency 0.05 --json
+"""
+import argparse
+import datetime as dt
+import glob
+import json
+import logging
+import math
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, List, Tuple
+
+import numpy as np
+from cv2 import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def generate_segments(out_dir: str, n: int, duration: float, fps: int, size: Tuple[int, int]) -> List[str]:
+    """
+    Writes n segments with moving boxes (to have real decoding cost)
+    """
+    w, h = size
+    paths = []
+    frame_id = 0
+    for i in range(n):
+        path = os.path.join(out_dir, 'seg{:04d}.ts'.format(i))
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+        for _ in range(int(duration * fps)):
+            img = np.full((h, w, 3), 40, dtype=np.uint8)
+            for k in range(5):
+                x = int((frame_id * 4 + k * w / 5) % w)
+                y = int(h / 6 * (k + 0.5))
+                cv2.rectangle(img, (x, y), (x + w // 12, y + h // 6), (60 * k % 255, 200, 255 - 40 * k), -1)
+            writer.write(img)
+            frame_id += 1
+        writer.release()
+        paths.append(path)
+    return paths
+
+
+def segment_info(path: str) -> Tuple[float, float, int, int]:
+    """
+    :return: duration, fps, width, height
+    """
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25
+    frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    w, h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    return frames / fps, fps, w, h
+
+
+def make_hls_server(segments: List[str], on_last_segment: Callable) -> ThreadingHTTPServer:
+    """
+    Serves segments as one live HLS stream (master and media playlists with program date time).
+    on_last_segment is called when the last segment is downloaded.
+    """
+    infos = [segment_info(path) for path in segments]
+    _, fps, w, h = infos[0]
+    start = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=sum(info[0] for info in infos))
+    media = ['#EXTM3U', '#EXT-X-VERSION:3',
+             '#EXT-X-TARGETDURATION:{}'.format(math.ceil(max(info[0] for info in infos))),
+             '#EXT-X-MEDIA-SEQUENCE:0']
+    pdt = start
+    for path, (duration, _, _, _) in zip(segments, infos):
+        media += ['#EXT-X-PROGRAM-DATE-TIME:{}'.format(pdt.isoformat(timespec='milliseconds')),
+                  '#EXTINF:{:.3f},'.format(duration), os.path.basename(path)]
+        pdt += dt.timedelta(seconds=duration)
+    playlists = {
+        '/master.m3u8': '\n'.join(['#EXTM3U', '#EXT-X-STREAM-INF:BANDWIDTH=2000000,RESOLUTION={}x{},FRAME-RATE={:.3f}'
+                                   .format(w, h, fps), 'stream.m3u8']) + '\n',
+        '/stream.m3u8': '\n'.join(media) + '\n'
+    }
+    files = {'/' + os.path.basename(path): path for path in segments}
+    last = '/' + os.path.basename(segments[-1])
+
+    class HlsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path in playlists:
+                body = playlists[self.path].encode()
+                content_type = 'application/vnd.apple.mpegurl'
+            elif self.path in files:
+                with open(files[self.path], 'rb') as f:
+                    body = f.read()
+                content_type = 'video/mp2t'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            if self.path == last:
+                on_last_segment()
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(('127.0.0.1', 0), HlsHandler)
+
+
+def make_detector_server(latency: float, objects: int, grid: Tuple[int, int]) -> ThreadingHTTPServer:
+    """
+    Stub object detector: sleeps latency seconds and returns objects moving from left to right in each grid cell
+    """
+    rows, cols = grid
+    calls = [0]
+
+    class DetectorHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            time.sleep(latency)
+            calls[0] += 1
+            detections = []
+            for row in range(rows):
+                for col in range(cols):
+                    for i in range(objects):
+                        x = (0.05 * calls[0] + i / max(objects, 1)) % 0.85
+                        y = 0.1 + 0.7 * i / max(objects, 1)
+                        detections.append([(col + x) / cols, (row + y) / rows,
+                                           (col + x + 0.1) / cols, (row + y + 0.15) / rows, 0.9, 0])
+            body = json.dumps(detections).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(('127.0.0.1', 0), DetectorHandler)
+
+
+def setup_db(stream_url: str, fps: int, grid: Tuple[int, int], traffic: int, objects: int, preview: bool) -> int:
+    """
+    Creates tables, a camera and its processors
+    :return: camera id
+    """
+    from server.database import Base, engine
+    from server import models
+
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        camera_id = conn.execute(models.Camera.__table__.insert(), {
+            'watch_fps': fps, 'watch_rows': grid[0], 'watch_cols': grid[1], 'tz': 0,
+            'stream_url': stream_url}).inserted_primary_key[0]
+        for proc_type, table, zones, n in (('traffic', models.TrafficCounter.__table__, [[[0.5, 0], [1, 0], [1, 1],
+                                                                                          [0.5, 1]]], traffic),
+                                           ('object', models.ObjectsCounter.__table__, [[[0, 0], [1, 0], [1, 1],
+                                                                                         [0, 1]]], objects)):
+            for _ in range(n):
+                proc_id = conn.execute(models.Processor.__table__.insert(), {
+                    'camera_id': camera_id, 'zones_str': json.dumps(zones), 'threshold': 0.5, 'enabled': True,
+                    'output_hls': preview, 'type': proc_type}).inserted_primary_key[0]
+                conn.execute(table.insert(), {'id': proc_id})
+    return camera_id
+
+
+def histogram_stats(sample: list, buckets: List[float]) -> dict:
+    counts, total, count = sample
+    p95_bound, cumulative = float('inf'), 0
+    for bound, bucket_count in zip(buckets + [float('inf')], counts):
+        cumulative += bucket_count
+        if cumulative >= 0.95 * count:
+            p95_bound = bound
+            break
+    return {'count': count, 'mean': total / count if count else None, 'p95_le': p95_bound}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Watcher replay benchmark')
+    parser.add_argument('--segments', help='glob of recorded .ts segments (ordered by name)')
+    parser.add_argument('--generate', type=int, default=6, help='number of segments to generate if no --segments')
+    parser.add_argument('--segment-duration', type=float, default=4, help='duration of generated segments')
+    parser.add_argument('--size', default='1280x720', help='size of generated segments')
+    parser.add_argument('--grid', default='1x1', help='detection grid rows x cols')
+    parser.add_argument('--fps', type=int, default=2, help='camera watch fps')
+    parser.add_argument('--traffic', type=int, default=1, help='number of traffic counters')
+    parser.add_argument('--objects', type=int, default=1, help='number of objects counters')
+    parser.add_argument('--preview', action='store_true', help='enable processors HLS preview (requires ffmpeg)')
+    parser.add_argument('--detector-latency', type=float, default=0.0, help='stub detector latency, seconds')
+    parser.add_argument('--detections', type=int, default=5, help='objects per frame returned by stub detector')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--verbose', action='store_true', help='print watcher logs')
+    args = parser.parse_args()
+    grid = tuple(int(v) for v in args.grid.split('x'))
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    work_dir = tempfile.mkdtemp(prefix='hypersight_bench_')
+    if args.segments:
+        segments = sorted(glob.glob(args.segments))
+        if not segments:
+            parser.error('No segments found: {}'.format(args.segments))
+    else:
+        size = tuple(int(v) for v in args.size.split('x'))
+        segments = generate_segments(work_dir, args.generate, args.segment_duration, 25, size)
+
+    # the DB must be set before server modules are imported
+    os.environ['DATABASE_URL'] = 'sqlite:///{}'.format(os.path.join(work_dir, 'bench.db'))
+    from server import create_app
+    from server import tasks
+    from server.database import engine
+    from server.telemetry import STAGE_SECONDS, FRAMES, SEGMENTS, DETECTOR_CALLS, DETECTOR_BYTES
+
+    # watcher exits by SIGTERM after the last segment is processed (exit is checked between loops)
+    hls_server = make_hls_server(segments, lambda: os.kill(os.getpid(), signal.SIGTERM))
+    detector_server = make_detector_server(args.detector_latency, args.detections, grid)
+    for server in (hls_server, detector_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    tasks.OBJECT_DETECTOR_URL = 'http://127.0.0.1:{}/detectObjects'.format(detector_server.server_port)
+    stream_url = 'http://127.0.0.1:{}/master.m3u8'.format(hls_server.server_port)
+    camera_id = setup_db(stream_url, args.fps, grid, args.traffic, args.objects, args.preview)
+
+    create_app(celery_app=True)
+    t0 = time.time()
+    tasks.watch_camera(camera_id)
+    elapsed = time.time() - t0
+    hls_server.shutdown()
+    detector_server.shutdown()
+
+    with engine.connect() as conn:
+        events = conn.execute('SELECT COUNT(*) FROM processor_event').scalar()
+    frames = sum(FRAMES.values.values())
+    results = {
+        'params': vars(args),
+        'segments': int(sum(SEGMENTS.values.values())),
+        'elapsed': elapsed,
+        'frames': int(frames),
+        'frames_per_second': frames / elapsed if elapsed else None,
+        'detector_calls': int(sum(DETECTOR_CALLS.values.values())),
+        'detector_bytes': int(sum(DETECTOR_BYTES.values.values())),
+        'events': events,
+        'stages': {labels[0]: histogram_stats(sample, list(STAGE_SECONDS.buckets))
+                   for labels, sample in STAGE_SECONDS.values.items()}
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('Segments: {segments}, frames: {frames}, elapsed: {elapsed:.2f} s, '
+          'frames/s: {frames_per_second:.2f}'.format(**results))
+    print('Detector calls: {detector_calls}, bytes: {detector_bytes}, events written: {events}'.format(**results))
+    print('{:<10}{:>8}{:>12}{:>10}'.format('stage', 'count', 'mean, s', 'p95 <=, s'))
+    for stage, stats in results['stages'].items():
+        print('{:<10}{:>8}{:>12.4f}{:>10}'.format(stage, stats['count'], stats['mean'], stats['p95_le']))
+
+
+if __name__ == '__main__':
+    main()
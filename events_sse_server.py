@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import datetime as dt
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+from logging.handlers import RotatingFileHandler
+from logging import Logger
+from typing import Dict, List, Set
+from urllib.parse import urlsplit, parse_qs
+
+from sqlalchemy import select
+
+from server.database import engine
+from server.instance.config import LOG_DIR, EVENTS_REDIS_CHANNEL, EVENTS_SSE_ADDRESS, EVENTS_SSE_PORT, \
+    EVENTS_SSE_KEEPALIVE
+from server.models import Processor, DT_FORMAT
+from server.redis_client import get_redis
+
+# event names of processors types
+EVENT_NAMES = {'traffic': 'traffic', 'object': 'objects'}
+# subscriber is disconnected if it does not read so many bytes
+MAX_PENDING_BYTES = 1024 ** 2
+
+
+def create_rotating_log(log_dir: str, fn: str, level: int) -> Logger:
+    # logging
+    logger = logging.getLogger()
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    handler = RotatingFileHandler(os.path.join(log_dir, fn), maxBytes=10000, backupCount=5)
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(level)
+    return logger
+
+
+log = create_rotating_log(LOG_DIR, 'events_sse_server.log', logging.INFO)
+# processor id -> writers of subscribers
+subscribers: Dict[int, Set[asyncio.StreamWriter]] = {}
+# processor id -> event name
+event_names: Dict[int, str] = {}
+stats = {'subscribers': 0, 'messages_in': 0, 'events_out': 0}
+
+
+def load_event_names(proc_ids: List[int]) -> Dict[int, str]:
+    """
+    Reads types of processors from DB (once per processor for the server life)
+    """
+    table = Processor.__table__
+    with engine.connect() as conn:
+        rows = conn.execute(select([table.c.id, table.c.type]).where(table.c.id.in_(proc_ids))).fetchall()
+    return {proc_id: EVENT_NAMES[proc_type] for proc_id, proc_type in rows if proc_type in EVENT_NAMES}
+
+
+def dispatch(data: bytes):
+    """
+    Sends events of a Redis message to subscribers of their processors
+    """
+    stats['messages_in'] += 1
+    try:
+        events = json.loads(data)
+    except ValueError as e:
+        log.warning('Bad events message: {}'.format(e))
+        return
+    for proc_id, ts, value in events:
+        writers = subscribers.get(proc_id)
+        if not writers:
+            continue
+        ts = dt.datetime.fromisoformat(ts).strftime(DT_FORMAT)
+        message = 'event: {}\ndata: {}\n\n'.format(
+            event_names[proc_id], json.dumps({'proc_id': proc_id, 'ts': ts, 'value': value})).encode()
+        for writer in list(writers):
+            if writer.transport.get_write_buffer_size() > MAX_PENDING_BYTES:
+                log.warning('Slow subscriber is disconnected')
+                writer.close()
+                continue
+            writer.write(message)
+            stats['events_out'] += 1
+
+
+def listen_redis(loop: asyncio.AbstractEventLoop, stopped: threading.Event):
+    """
+    Redis subscriber (runs in a separate thread). One subscription serves all connected clients.
+    """
+    while not stopped.is_set():
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(EVENTS_REDIS_CHANNEL)
+            log.info('Subscribed to Redis channel {}'.format(EVENTS_REDIS_CHANNEL))
+            while not stopped.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message:
+                    loop.call_soon_threadsafe(dispatch, message['data'])
+            pubsub.close()
+        except Exception as e:
+            log.error('Redis subscription failed: {}'.format(e))
+            stopped.wait(EVENTS_SSE_KEEPALIVE)
+
+
+async def respond_error(writer: asyncio.StreamWriter, status: str, msg: str):
+    body = json.dumps({'err': True, 'msg': msg}).encode()
+    writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                 'Connection: close\r\n\r\n'.format(status, len(body)).encode() + body)
+    await writer.drain()
+    writer.close()
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    Serves GET /events?proc_ids=1,2,3 as a Server-Sent Events stream
+    """
+    try:
+        request_line = (await reader.readline()).decode()
+        # skip headers
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        method, target, _ = request_line.split(' ', 2)
+        url = urlsplit(target)
+        proc_ids = [int(proc_id) for value in parse_qs(url.query).get('proc_ids', [])
+                    for proc_id in value.split(',') if proc_id]
+    except (ValueError, UnicodeDecodeError):
+        await respond_error(writer, '400 Bad Request', 'Wrong request')
+        return
+    if method != 'GET' or url.path != '/events':
+        await respond_error(writer, '404 Not Found', 'Use GET /events?proc_ids=1,2')
+        return
+    unknown_ids = [proc_id for proc_id in proc_ids if proc_id not in event_names]
+    if unknown_ids:
+        event_names.update(await asyncio.get_event_loop().run_in_executor(None, load_event_names, unknown_ids))
+    proc_ids = [proc_id for proc_id in proc_ids if proc_id in event_names]
+    if not proc_ids:
+        await respond_error(writer, '400 Bad Request', 'proc_ids of traffic or objects counters are required')
+        return
+
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                 b'Access-Control-Allow-Origin: *\r\nConnection: keep-alive\r\n\r\n')
+    for proc_id in proc_ids:
+        subscribers.setdefault(proc_id, set()).add(writer)
+    stats['subscribers'] += 1
+    log.debug('Subscribed to {}'.format(proc_ids))
+    try:
+        # idle subscriber costs one sleeping coroutine; keepalive detects closed connections
+        while not writer.is_closing():
+            writer.write(b': keepalive\n\n')
+            await writer.drain()
+            await asyncio.sleep(EVENTS_SSE_KEEPALIVE)
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        for proc_id in proc_ids:
+            proc_subscribers = subscribers.get(proc_id)
+            if proc_subscribers is not None:
+                proc_subscribers.discard(writer)
+                if not proc_subscribers:
+                    del subscribers[proc_id]
+        stats['subscribers'] -= 1
+        writer.close()
+
+
+async def report_metrics(interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        log.info('SSE server metrics: {}'.format(stats))
+
+
+async def sse_server(address: str, port: int, stop):
+    server = await asyncio.start_server(handle, address, port)
+    async with server:
+        await stop
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Processors events SSE server')
+    parser.add_argument('--address', default=EVENTS_SSE_ADDRESS)
+    parser.add_argument('--port', type=int, default=EVENTS_SSE_PORT)
+    args = parser.parse_args()
+    log.info('*' * 20)
+    log.info('Starting SSE server at {}:{}'.format(args.address, args.port))
+    loop = asyncio.get_event_loop()
+    # The stop condition is set when receiving SIGTERM.
+    stop = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+    redis_stopped = threading.Event()
+    threading.Thread(target=listen_redis, args=(loop, redis_stopped), daemon=True).start()
+    loop.create_task(report_metrics(60))
+    loop.run_until_complete(sse_server(args.address, args.port, stop))
+    redis_stopped.set()
+    log.info('Ended')
+    log.info('*' * 20)
@@ -1,13 +1,22 @@
+import argparse
 import asyncio
+import json
 import logging
 import os
 import signal
+import socket
 import sys
+import threading
 from logging.handlers import RotatingFileHandler
 from logging import Logger
+from typing import Optional, Tuple, Union
+
 import websockets
 
-from server.instance.config import LOG_DIR, FACE_WS_ADDRESS, FACE_WS_PORT
+from server import faces_protocol
+from server.instance.config import LOG_DIR, FACE_WS_ADDRESS, FACE_WS_PORT, FACE_RELAY_MODE, FACE_REDIS_CHANNEL, \
+    FACE_RELAY_METRICS_INTERVAL
+from server.redis_client import get_redis, FACE_RELAY_METRICS_KEY
 
 
 def create_rotating_log(log_dir: str, fn: str, level: int) -> Logger:
@@ -26,26 +35,89 @@ def create_rotating_log(log_dir: str, fn: str, level: int) -> Logger:
 
 
 log = create_rotating_log(LOG_DIR, 'faces_ws_server.log', logging.INFO)
-clients = []
+clients = {}
 detectors = []
+# ws: messages of connected detectors are sent to own clients only;
+# redis: messages are published to FACE_REDIS_CHANNEL and any relay instance sends them to its clients
+relay_mode = FACE_RELAY_MODE
+stats = {'messages_in': 0, 'messages_out': 0, 'bytes_out': 0}
+
+
+class Client:
+    """
+    Faces consumer connection: format of messages to send and subscribed cameras (None for all cameras)
+    """
+
+    def __init__(self, websocket, fmt: str = faces_protocol.FORMAT_JSON, cameras: Optional[list] = None):
+        self.websocket = websocket
+        self.format = fmt
+        self.cameras = None
+        self.subscribe(cameras)
+
+    def subscribe(self, cameras: Optional[list]):
+        self.cameras = None if cameras is None else {str(c) for c in cameras}
+
+    def wants(self, camera_id) -> bool:
+        return self.cameras is None or str(camera_id) in self.cameras
+
 
+class RelayMessage:
+    """
+    Message from a detector. Converts it to the other format at most once for all clients.
+    """
 
-async def register(websocket):
-    con_type = await websocket.recv()
+    def __init__(self, message: Union[str, bytes]):
+        self._formats = {faces_protocol.FORMAT_BINARY if isinstance(message, bytes)
+                         else faces_protocol.FORMAT_JSON: message}
+        self.camera_id = faces_protocol.message_header(message).get('camera_id')
+
+    def as_format(self, fmt: str) -> Union[str, bytes]:
+        if fmt not in self._formats:
+            if fmt == faces_protocol.FORMAT_BINARY:
+                self._formats[fmt] = faces_protocol.json_to_binary(self._formats[faces_protocol.FORMAT_JSON])
+            else:
+                self._formats[fmt] = faces_protocol.binary_to_json(self._formats[faces_protocol.FORMAT_BINARY])
+        return self._formats[fmt]
+
+
+def parse_greeting(greeting: str) -> Tuple[str, dict]:
+    """
+    Greeting is either a connection type (`client` or `detector`)
+    or JSON like {"type": "client", "format": "binary", "cameras": [1, 2]}
+    :return: connection type and its options
+    """
+    if greeting in ('client', 'detector'):
+        return greeting, {}
+    try:
+        options = json.loads(greeting)
+    except (TypeError, ValueError):
+        return greeting, {}
+    if not isinstance(options, dict):
+        return greeting, {}
+    return options.get('type'), options
+
+
+async def register(websocket) -> bool:
+    con_type, options = parse_greeting(await websocket.recv())
     if con_type == 'client':
-        clients.append(websocket)
+        fmt = options.get('format', faces_protocol.FORMAT_JSON)
+        if fmt not in (faces_protocol.FORMAT_JSON, faces_protocol.FORMAT_BINARY):
+            log.warning('Unknown message format: {}'.format(fmt))
+            return False
+        clients[websocket] = Client(websocket, fmt, options.get('cameras'))
     elif con_type == 'detector':
         detectors.append(websocket)
     else:
         log.warning('Unknown connection type: {}'.format(con_type))
-        return
+        return False
     logging.info('{} connected'.format(con_type))
     await websocket.send('OK')
+    return True
 
 
 async def unregister(websocket):
     if websocket in clients:
-        clients.remove(websocket)
+        del clients[websocket]
         await websocket.close()
         logging.info('client disconnected')
     if websocket in detectors:
@@ -54,14 +126,105 @@ async def unregister(websocket):
         logging.info('detector disconnected')
 
 
+async def broadcast(message: Union[str, bytes]):
+    """
+    Sends detector message to all subscribed clients in their formats
+    """
+    try:
+        relay_message = RelayMessage(message)
+    except Exception as e:
+        log.warning('Bad message from detector: {}'.format(e))
+        return
+    stats['messages_in'] += 1
+    sends = []
+    for client in list(clients.values()):
+        if client.wants(relay_message.camera_id):
+            data = relay_message.as_format(client.format)
+            stats['messages_out'] += 1
+            stats['bytes_out'] += len(data)
+            sends.append(client.websocket.send(data))
+    if sends:
+        await asyncio.gather(*sends, return_exceptions=True)
+
+
+async def publish(message: Union[str, bytes]):
+    """
+    Publishes detector message to Redis for all relay instances
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(None, get_redis().publish, FACE_REDIS_CHANNEL, message)
+    except Exception as e:
+        log.error('Failed to publish message to Redis: {}'.format(e))
+
+
+def listen_redis(loop: asyncio.AbstractEventLoop, stopped: threading.Event):
+    """
+    Redis subscriber (runs in a separate thread). Passes all messages of FACE_REDIS_CHANNEL to broadcast.
+    """
+    while not stopped.is_set():
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(FACE_REDIS_CHANNEL)
+            log.info('Subscribed to Redis channel {}'.format(FACE_REDIS_CHANNEL))
+            while not stopped.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message:
+                    data = message['data']
+                    # json messages of old detectors are published as text
+                    if data[:1] == b'{':
+                        data = data.decode()
+                    asyncio.run_coroutine_threadsafe(broadcast(data), loop)
+            pubsub.close()
+        except Exception as e:
+            log.error('Redis subscription failed: {}'.format(e))
+            stopped.wait(FACE_RELAY_METRICS_INTERVAL)
+
+
+async def report_metrics(instance: str, interval: int):
+    """
+    Logs number of clients and message rates of this instance.
+    In redis mode metrics are also saved to Redis to compare load of all relay instances.
+    """
+    prev = dict(stats)
+    while True:
+        await asyncio.sleep(interval)
+        metrics = {'clients': len(clients),
+                   'detectors': len(detectors),
+                   'messages_in_rate': (stats['messages_in'] - prev['messages_in']) / interval,
+                   'messages_out_rate': (stats['messages_out'] - prev['messages_out']) / interval,
+                   'bytes_out_rate': (stats['bytes_out'] - prev['bytes_out']) / interval}
+        metrics.update(stats)
+        prev = dict(stats)
+        log.info('Relay {} metrics: {}'.format(instance, metrics))
+        if relay_mode == 'redis':
+            try:
+                key = FACE_RELAY_METRICS_KEY.format(instance)
+                pipe = get_redis().pipeline()
+                pipe.hset(key, mapping=metrics)
+                pipe.expire(key, interval * 3)
+                await asyncio.get_event_loop().run_in_executor(None, pipe.execute)
+            except Exception as e:
+                log.error('Failed to save metrics to Redis: {}'.format(e))
+
+
 async def echo(websocket, path):
-    await register(websocket)
+    if not await register(websocket):
+        return
     try:
         logging.info('Connection')
         async for message in websocket:
-            log.debug(message)
-            if clients:
-                await asyncio.wait([user.send(message) for user in clients])
+            if websocket in detectors:
+                if relay_mode == 'redis':
+                    await publish(message)
+                else:
+                    await broadcast(message)
+            else:
+                # clients can change their subscription: {"cameras": [1, 2]} or {"cameras": null}
+                try:
+                    clients[websocket].subscribe(json.loads(message)['cameras'])
+                except (TypeError, ValueError, KeyError):
+                    log.warning('Unknown client message: {}'.format(message))
     finally:
         await unregister(websocket)
 
@@ -72,16 +235,29 @@ async def echo_server(address: str, port: int, stop):
 
 
 if __name__ == '__main__':
-    address = FACE_WS_ADDRESS
-    port = FACE_WS_PORT
+    parser = argparse.ArgumentParser(description='Faces WS relay server')
+    parser.add_argument('--address', default=FACE_WS_ADDRESS)
+    parser.add_argument('--port', type=int, default=FACE_WS_PORT)
+    parser.add_argument('--mode', choices=['ws', 'redis'], default=FACE_RELAY_MODE,
+                        help='redis mode allows to run several relay instances')
+    args = parser.parse_args()
+    address = args.address
+    port = args.port
+    relay_mode = args.mode
+    instance_name = '{}:{}'.format(socket.gethostname(), port)
     log.info('*' * 20)
-    log.info('Starting WS relay server at {}:{}'.format(address, port))
+    log.info('Starting WS relay server at {}:{} in {} mode'.format(address, port, relay_mode))
     loop = asyncio.get_event_loop()
     # The stop condition is set when receiving SIGTERM.
     stop = loop.create_future()
     loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+    redis_stopped = threading.Event()
+    if relay_mode == 'redis':
+        threading.Thread(target=listen_redis, args=(loop, redis_stopped), daemon=True).start()
+    loop.create_task(report_metrics(instance_name, FACE_RELAY_METRICS_INTERVAL))
     log.info('Waiting for connections')
     loop.run_until_complete(echo_server(address, port, stop))
+    redis_stopped.set()
     # loop.run_forever()
     log.info('Ended')
     logging.info('*' * 20)
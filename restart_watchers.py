@@ -1,25 +1,40 @@
 import logging
+import time
 
 from celery_worker import celery
+from server.celery_app import WATCH_CAMERA_TASK
+from server.heartbeat import read_heartbeats
+from server.instance.config import SUPERVISOR_STOP_TIMEOUT
 from server.models import Camera
-from server.tasks import watch_camera
+from server.placement import get_workers, place, read_costs, start_watcher, stop_watcher
 
-# stop running watchers (if they exist)
+# noinspection PyUnresolvedReferences
+camera_ids = [cam.id for cam in Camera.query.all()]
+
+# stop running watchers (if they exist): SIGTERM lets them write buffered events
 logging.info('Stopping all active camera watchers')
+heartbeats = read_heartbeats(camera_ids)
+for heartbeat in heartbeats.values():
+    stop_watcher(celery, heartbeat)
+deadline = time.monotonic() + SUPERVISOR_STOP_TIMEOUT
+while heartbeats and time.monotonic() < deadline:
+    time.sleep(1)
+    heartbeats = read_heartbeats(list(heartbeats))
+# hung watchers and watchers without heartbeats are killed
 inspector = celery.control.inspect()
 active_tasks = inspector.active()
 if active_tasks:
-    for usr, tasks in inspector.active().items():
+    for usr, tasks in active_tasks.items():
         for task in tasks:
-            if 'watch_camera' in task['name']:
+            if task['name'] == WATCH_CAMERA_TASK:
                 celery.control.revoke(task['id'], terminate=True, signal='SIGKILL')
                 logging.info('Stopped pid {} with args {}'.format(task['worker_pid'], task['kwargs']))
 logging.info('Done')
 
-# run new watchers
+# run new watchers placed on workers by measured costs of cameras
 logging.info('Starting new camera watchers')
-# noinspection PyUnresolvedReferences
-cams = Camera.query.all()
-for cam in cams:
-    watch_camera.delay(camera_id=cam.id)
+capacities = get_workers(celery)
+placement = place(camera_ids, read_costs(camera_ids), capacities) if capacities else {}
+for camera_id in camera_ids:
+    start_watcher(celery, camera_id, placement.get(camera_id))
 logging.info('Done')
@@ -4,13 +4,18 @@ from logging.handlers import RotatingFileHandler
 from typing import Union, List
 
 import click
-from flask import Flask
+from flask import Flask, current_app
 from flask.cli import with_appcontext
 
-from server.tasks import celery
+from server.celery_app import celery, COMPACT_OLD_EVENTS_TASK
 from server.admin import adm
 from server.babel import babel
 from server.database import db_session, init_db
+from server.models import parse_ts
+from server.profiler import request_profile
+from server.result_cache import bump_generations
+from server.retention import compact_events, partition_events
+from server.rollups import rebuild_rollups
 
 
 def create_app(test_config: Union[dict, List[tuple]] = None, celery_app: bool = False):
@@ -36,6 +41,12 @@ def create_app(test_config: Union[dict, List[tuple]] = None, celery_app: bool =
     # initialize Flask-SQLAlchemy and the init-db command
     app.logger.info('Init Flask-SQLAlchemy')
     app.cli.add_command(init_db_command)
+    app.cli.add_command(rebuild_rollups_command)
+    app.cli.add_command(partition_events_command)
+    app.cli.add_command(compact_events_command)
+    app.cli.add_command(profile_watcher_command)
+    app.cli.add_command(backfill_command)
+    app.cli.add_command(recompute_events_command)
 
     @app.teardown_appcontext
     def shutdown_session(exception=None):
@@ -80,6 +91,12 @@ def make_celery(app, celery_app):
     celery_app.conf.broker_url = app.config['CELERY_BROKER_URL']
     celery_app.conf.result_backend = app.config['CELERY_RESULT_BACKEND']
     celery_app.conf.update(app.config)
+    # each worker consumes its own queue, so watchers can be placed on chosen workers (see server/placement.py)
+    celery_app.conf.worker_direct = True
+    if app.config.get('EVENT_RETENTION_DAYS') is not None:
+        celery_app.conf.beat_schedule = {
+            'compact-old-events': {'task': COMPACT_OLD_EVENTS_TASK, 'schedule': 24 * 3600}
+        }
 
     class ContextTask(celery_app.Task):
         def __call__(self, *args, **kwargs):
@@ -98,3 +115,90 @@ def init_db_command():
     """Clear existing data and create new tables."""
     init_db()
     click.echo("Initialized the database.")
+
+
+@click.command("rebuild-rollups")
+@click.option('--processor-id', 'processor_ids', type=int, multiple=True, help='Processor to rebuild (all if omitted)')
+@click.option('--start', 'start_ts', help='First event ts (all history if omitted)')
+@click.option('--stop', 'stop_ts', help='Last event ts (up to now if omitted)')
+@with_appcontext
+def rebuild_rollups_command(processor_ids, start_ts, stop_ts):
+    """Recalculate traffic and occupancy rollups from raw events."""
+    total = rebuild_rollups(list(processor_ids) or None,
+                            parse_ts(start_ts) if start_ts else None,
+                            parse_ts(stop_ts) if stop_ts else None)
+    # cached API results of these processors may be outdated
+    bump_generations(list(processor_ids) or None)
+    click.echo("Rollups rebuilt from {} events.".format(total))
+
+
+@click.command("partition-events")
+@with_appcontext
+def partition_events_command():
+    """Partition processor_event table by month (MySQL only)."""
+    partition_events(current_app.config['EVENT_PARTITIONS_AHEAD'])
+    click.echo("processor_event is partitioned.")
+
+
+@click.command("compact-events")
+@click.option('--days', type=int, help='Raw events age to keep (EVENT_RETENTION_DAYS if omitted)')
+@with_appcontext
+def compact_events_command(days):
+    """Delete raw events older than retention period keeping their rollups."""
+    days = days if days is not None else current_app.config['EVENT_RETENTION_DAYS']
+    if days is None:
+        click.echo("Retention period is not set.")
+        return
+    if not current_app.config['USE_ROLLUPS']:
+        click.echo("Retention requires USE_ROLLUPS: API would not count deleted events.")
+        return
+    deleted = compact_events(days, current_app.config['MINUTE_ROLLUPS_RETENTION_DAYS'],
+                             current_app.config['EVENT_PARTITIONS_AHEAD'])
+    click.echo("Deleted {} events.".format(deleted))
+
+
+@click.command("profile-watcher")
+@click.option('--camera-id', type=int, required=True, help='Camera of the watcher')
+@click.option('--seconds', type=float, help='Profiling duration (PROFILE_SECONDS if omitted)')
+@with_appcontext
+def profile_watcher_command(camera_id, seconds):
+    """Profile a running camera watcher, stacks are written to PROFILES_DIR."""
+    request_profile(camera_id, seconds or current_app.config['PROFILE_SECONDS'])
+    click.echo("Profiling is requested. It starts at the next loop of the watcher.")
+
+
+@click.command("backfill")
+@click.option('--processor-id', type=int, required=True, help='Processor to recalculate')
+@click.option('--start', 'start_ts', required=True, help='Ts of the first frame of the first file')
+@click.option('--stop', 'stop_ts', help='Last ts to recalculate (the end of the last file if omitted)')
+@click.option('--workers', type=int, help='Number of processes (BACKFILL_WORKERS if omitted)')
+@click.option('--chunk-seconds', type=float, help='Video duration per task (BACKFILL_CHUNK_SECONDS if omitted)')
+@click.option('--overlap-seconds', type=float, help='Warm-up before each chunk (BACKFILL_OVERLAP_SECONDS if omitted)')
+@click.argument('files', nargs=-1, required=True)
+@with_appcontext
+def backfill_command(processor_id, start_ts, stop_ts, workers, chunk_seconds, overlap_seconds, files):
+    """Recalculate events of a processor from recorded video files (in order of recording)."""
+    # video processing code is loaded only by this command
+    from server.backfill import backfill
+    config = current_app.config
+    total = backfill(processor_id, list(files), parse_ts(start_ts), parse_ts(stop_ts) if stop_ts else None,
+                     workers or config['BACKFILL_WORKERS'],
+                     chunk_seconds or config['BACKFILL_CHUNK_SECONDS'],
+                     overlap_seconds if overlap_seconds is not None else config['BACKFILL_OVERLAP_SECONDS'])
+    click.echo("Written {} events.".format(total))
+
+
+@click.command("recompute-events")
+@click.option('--processor-id', type=int, required=True, help='Processor to recalculate')
+@click.option('--start', 'start_ts', required=True, help='First ts')
+@click.option('--stop', 'stop_ts', required=True, help='Ts to stop at (exclusive)')
+@with_appcontext
+def recompute_events_command(processor_id, start_ts, stop_ts):
+    """Recalculate events of a processor from the detection log of watchers (DETECTION_LOG_DIR)."""
+    from server.backfill import recompute
+    log_dir = current_app.config['DETECTION_LOG_DIR']
+    if not log_dir:
+        click.echo("Detection log is disabled (DETECTION_LOG_DIR is not set).")
+        return
+    total = recompute(processor_id, log_dir, parse_ts(start_ts), parse_ts(stop_ts))
+    click.echo("Written {} events.".format(total))
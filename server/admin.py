@@ -1,24 +1,37 @@
 from flask_admin import Admin
 from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import inspect
 from wtforms.validators import number_range, regexp
 
+from server.celery_app import celery, WATCH_CAMERA_TASK
+from server.config_sync import publish_config_change
 from server.database import db_session
-from server.models import TrafficCounter, Camera, ObjectsCounter, FaceDetector
-from server.tasks import watch_camera
+from server.models import TrafficCounter, Camera, ObjectsCounter, FaceDetector, Processor
 
 
 class CameraModelView(ModelView):
     """
     Customization of a camera view
     """
-    column_labels = dict(watch_fps='FPS считывания', watch_rows='Строк в детектор', watch_cols='Колонок в детектор',
+    column_labels = dict(watch_fps='FPS считывания', watch_fps_min='Мин. FPS (адаптивный)',
+                         watch_rows='Строк в детектор', watch_cols='Колонок в детектор',
                          tz='Часовой пояс', stream_url='URL камеры')
 
     form_excluded_columns = ['processors']
 
     def after_model_change(self, form, model: Camera, is_created: bool):
         if is_created:
-            watch_camera.delay(camera_id=model.id)
+            # by name: the admin does not import tasks code
+            celery.send_task(WATCH_CAMERA_TASK, kwargs={'camera_id': model.id})
+        else:
+            publish_config_change([model.id])
+
+    def on_model_delete(self, model: Camera):
+        model.deleted_id = model.id
+
+    def after_model_delete(self, model: Camera):
+        # the watcher stops
+        publish_config_change([model.deleted_id])
 
 
 class ProcessorModelView(ModelView):
@@ -51,9 +64,32 @@ class ProcessorModelView(ModelView):
         }
     }
 
+    def on_model_change(self, form, model: Processor, is_created: bool):
+        # the processor may be moved to another camera, the watcher of the previous one must drop it
+        model.previous_camera_ids = [camera.id for camera in inspect(model).attrs.camera.history.deleted if camera]
+
+    def after_model_change(self, form, model: Processor, is_created: bool):
+        publish_config_change([model.camera_id] + model.previous_camera_ids)
+
+    def on_model_delete(self, model: Processor):
+        model.previous_camera_ids = [model.camera_id]
+
+    def after_model_delete(self, model: Processor):
+        publish_config_change(model.previous_camera_ids)
+
+
+class FaceDetectorModelView(ProcessorModelView):
+    """
+    Customization of a FaceDetector view
+    """
+    column_labels = dict(ProcessorModelView.column_labels, best_shot='Лучший кадр')
+    form_columns = ProcessorModelView.form_columns + ('best_shot',)
+    form_widget_args = dict(ProcessorModelView.form_widget_args,
+                            best_shot={'style': 'float:left; margin: 5px 0px; width: 0px;'})
+
 
 adm = Admin(name='hypersight', template_mode='bootstrap3')
 adm.add_view(CameraModelView(Camera, db_session))
 adm.add_view(ProcessorModelView(TrafficCounter, db_session))
 adm.add_view(ProcessorModelView(ObjectsCounter, db_session))
-adm.add_view(ProcessorModelView(FaceDetector, db_session))
+adm.add_view(FaceDetectorModelView(FaceDetector, db_session))
@@ -1,41 +1,169 @@
 import datetime as dt
 import json
+import logging
 import os
+from typing import List
 from uuid import uuid4
 
-from cv2 import cv2
-from flask import request, abort, send_from_directory, Blueprint, current_app
-from sqlalchemy import func, desc
+from flask import request, abort, send_from_directory, Blueprint, current_app, Response, url_for
 
-from server.models import Camera, TrafficCounter, ObjectsCounter, ProcessorEvent, DT_FORMAT
+from server.models import Camera, Processor, TrafficCounter, ObjectsCounter, DT_FORMAT, parse_ts
+from server.export import export_events, FORMATS, FORMAT_NDJSON
+from server.heartbeat import read_heartbeats
+from server.lazy import LazyModule
+from server.live import read_live_values, read_live_frame_info, read_live_frame
+from server.redis_client import get_redis, FACE_RELAY_METRICS_KEY
+from server.result_cache import ResultCache, get_generations
+from server.retention import retention_limits
+from server.rollups import traffic_totals, latest_value, latest_values, traffic_series, objects_series, \
+    check_precision, PrecisionError
+from server.telemetry import render, read_snapshots
+
+# frames are captured from streams only for cameras without watchers
+cv2 = LazyModule('cv2.cv2')
 
 api_bp = Blueprint('api', __name__, url_prefix='/')
+_traffic_cache = None
+
+
+def _ts_param(value) -> dt.datetime:
+    """
+    Parses ts request parameter. Aborts request if it is wrong.
+    """
+    try:
+        return parse_ts(value)
+    except (TypeError, ValueError):
+        abort(400, 'Wrong ts format: {}'.format(value))
+
+
+def _ids_param(params: dict) -> List[int]:
+    """
+    Returns processor ids of a batch request. Aborts request if they are wrong.
+    """
+    proc_ids = params.get('proc_ids', None)
+    if not proc_ids or not isinstance(proc_ids, list):
+        abort(400, 'proc_ids is required')
+    try:
+        return [int(proc_id) for proc_id in proc_ids]
+    except (TypeError, ValueError):
+        abort(400, 'proc_ids must be a list of ints')
+
+
+def _live_values(proc_ids: List[int], timestamps: dict) -> dict:
+    """
+    Returns live values of processors which are not newer than the requested timestamps
+    (camera ts may be ahead of the server clock); other processors are to be read from DB
+    """
+    live = read_live_values(proc_ids)
+    return {proc_id: value for proc_id, value in live.items() if value[1] <= timestamps[proc_id]}
+
+
+def _retention_limits() -> tuple:
+    """
+    :return: raw events and minute rollups are deleted before these ts by the retention job (None if they are kept)
+    """
+    return retention_limits(current_app.config['EVENT_RETENTION_DAYS'],
+                            current_app.config['MINUTE_ROLLUPS_RETENTION_DAYS'])
+
+
+def _get_traffic_cache() -> ResultCache:
+    global _traffic_cache
+    if _traffic_cache is None:
+        _traffic_cache = ResultCache(current_app.config['RESULT_CACHE_SIZE'])
+    return _traffic_cache
+
+
+def _traffic_totals(ranges: dict, tz_offsets: dict) -> dict:
+    """
+    traffic_totals with results of closed windows taken from cache.
+    A window is closed if it stopped more than RESULT_CACHE_INGEST_LAG seconds ago, so its traffic never changes
+    unless events of the processor are recalculated (then its generation is changed).
+    Event ts are in camera local time, so the window age is measured by the camera clock.
+    Aborts request if a range does not fit precision of events kept by retention.
+    :param tz_offsets: processor id -> time zone offset of its camera (hours)
+    """
+    cache = _get_traffic_cache()
+    use_rollups = current_app.config['USE_ROLLUPS']
+    raw_since, minutes_since = _retention_limits()
+    if use_rollups:
+        # cached results of old ranges must be rejected the same way
+        try:
+            for start, stop in ranges.values():
+                check_precision(start, raw_since, minutes_since)
+                check_precision(stop, raw_since, minutes_since)
+        except PrecisionError as e:
+            abort(400, str(e))
+    closed_before = dt.datetime.utcnow() - dt.timedelta(seconds=current_app.config['RESULT_CACHE_INGEST_LAG'])
+    closed_ids = [proc_id for proc_id, (_, stop) in ranges.items()
+                  if stop < closed_before + dt.timedelta(hours=tz_offsets[proc_id] or 0)] \
+        if cache.max_size > 0 else []
+    generations = get_generations(closed_ids) if closed_ids else None
+    totals = {}
+    keys = {}
+    if generations is not None:
+        for proc_id in closed_ids:
+            keys[proc_id] = (proc_id,) + ranges[proc_id] + (use_rollups,) + generations[proc_id]
+            value = cache.get(keys[proc_id])
+            if value is not ResultCache.MISSING:
+                totals[proc_id] = value
+    missing = {proc_id: ts_range for proc_id, ts_range in ranges.items() if proc_id not in totals}
+    if missing:
+        computed = traffic_totals(missing, use_rollups, raw_since, minutes_since)
+        for proc_id in missing:
+            value = computed.get(proc_id)
+            if proc_id in keys:
+                cache.put(keys[proc_id], value)
+            totals[proc_id] = value
+    return {proc_id: value for proc_id, value in totals.items() if value is not None}
 
 
 @api_bp.route('/statusWatch', methods=['GET'])
 def status_watch():
     """
-    Loop through all cameras in DB and return True if corresponding watcher is active (process exists)
+    Loop through all cameras in DB and return True if corresponding watcher is active (its heartbeat is alive)
     :return:
     """
     result = {}
     # noinspection PyUnresolvedReferences
     cameras = Camera.query.all()
-    celery = None
-    inspector = celery.control.inspect()
-    active_tasks = inspector.active()
+    heartbeats = read_heartbeats([camera.id for camera in cameras])
     for camera in cameras:
-        result[camera.id] = {'watching': False, 'url': camera.stream_url}
-        if active_tasks:
-            for usr, tasks in inspector.active().items():
-                for task in tasks:
-                    if 'watch_camera' in task['name'] and task['kwargs'].get('camera_id', None) == camera.id:
-                        result[camera.id]['watching'] = True
-                        break
+        heartbeat = heartbeats.get(camera.id)
+        result[camera.id] = {'watching': heartbeat is not None, 'url': camera.stream_url, 'heartbeat': heartbeat}
     result['err'] = False
     return json.dumps(result)
 
 
+@api_bp.route('/statusFaceRelays', methods=['GET'])
+def status_face_relays():
+    """
+    Returns metrics of all faces relay instances running in redis mode
+    :return:
+    """
+    result = {}
+    r = get_redis()
+    for key in r.scan_iter(FACE_RELAY_METRICS_KEY.format('*')):
+        instance = key.decode()[len(FACE_RELAY_METRICS_KEY.format('')):]
+        result[instance] = {k.decode(): float(v) for k, v in r.hgetall(key).items()}
+    return {'relays': result, 'err': False}
+
+
+@api_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Returns metrics of all running watchers in Prometheus text format
+    """
+    return Response(render(read_snapshots()), mimetype='text/plain; version=0.0.4')
+
+
+@api_bp.route('/cacheStats', methods=['GET'])
+def cache_stats():
+    """
+    Returns hit/miss statistics of the results cache of this API process
+    """
+    return {'traffic': _get_traffic_cache().stats(), 'pid': os.getpid(), 'err': False}
+
+
 @api_bp.route('/Traffic', methods=['POST'])
 def get_traffic():
     """
@@ -53,18 +181,18 @@ def get_traffic():
     if not start_ts:
         abort(400, 'start_ts is required')
     stop_ts = params.get('stop_ts', dt.datetime.now())
+    start_ts = _ts_param(start_ts)
+    stop_ts = _ts_param(stop_ts)
     # noinspection PyUnresolvedReferences
     processor = TrafficCounter.query.filter_by(id=proc_id).first()
     if processor:
-        # noinspection PyUnresolvedReferences
-        res = ProcessorEvent.query.with_entities(func.sum(ProcessorEvent.value).label("traffic"),
-                                                 func.min(ProcessorEvent.ts).label("min_ts"),
-                                                 func.max(ProcessorEvent.ts).label("max_ts")).filter_by(
-            processor_id=processor.id).filter(ProcessorEvent.ts <= stop_ts).filter(ProcessorEvent.ts > start_ts).first()
-        if res.traffic:
-            return {'traffic': int(res.traffic),
-                    'min_ts': res.min_ts.strftime(DT_FORMAT),
-                    'max_ts': res.max_ts.strftime(DT_FORMAT),
+        # whole minutes and hours of the range are taken from rollups
+        totals = _traffic_totals({processor.id: (start_ts, stop_ts)}, {processor.id: processor.camera.tz})
+        traffic, min_ts, max_ts = totals.get(processor.id, (None, None, None))
+        if traffic:
+            return {'traffic': int(traffic),
+                    'min_ts': min_ts.strftime(DT_FORMAT),
+                    'max_ts': max_ts.strftime(DT_FORMAT),
                     'err': False}
         else:
             return {'err': True, 'msg': 'No records found'}
@@ -72,6 +200,52 @@ def get_traffic():
         return {'err': True, 'msg': 'Wrong processor id'}
 
 
+@api_bp.route('/TrafficBatch', methods=['POST'])
+def get_traffic_batch():
+    """
+    Calculates passed by traffic for many processors at once
+    - proc_ids: list of processor ids
+    - start_ts: timestamp to start from
+    - stop_ts: [Optional] last timestamp; if omitted - current ts is used
+    - ranges: [Optional] {proc_id: {"start_ts": ..., "stop_ts": ...}} to override the range for some processors
+    ts format: "2020-02-23 14:00:00.0"
+    """
+    params = request.get_json()
+    proc_ids = _ids_param(params)
+    start_ts = params.get('start_ts', None)
+    stop_ts = _ts_param(params.get('stop_ts', dt.datetime.now()))
+    custom_ranges = params.get('ranges', {})
+    if not isinstance(custom_ranges, dict):
+        abort(400, 'ranges must be a dict of proc_id: {"start_ts": ..., "stop_ts": ...}')
+    ranges = {}
+    for proc_id in proc_ids:
+        proc_range = custom_ranges.get(str(proc_id), {})
+        if not isinstance(proc_range, dict):
+            abort(400, 'ranges must be a dict of proc_id: {"start_ts": ..., "stop_ts": ...}')
+        proc_start_ts = proc_range.get('start_ts', start_ts)
+        if not proc_start_ts:
+            abort(400, 'start_ts is required')
+        ranges[proc_id] = (_ts_param(proc_start_ts), _ts_param(proc_range.get('stop_ts', stop_ts)))
+    # noinspection PyUnresolvedReferences
+    tz_offsets = dict(TrafficCounter.query.with_entities(TrafficCounter.id, Camera.tz).join(Camera).filter(
+        TrafficCounter.id.in_(proc_ids)))
+    found_ids = set(tz_offsets)
+    totals = _traffic_totals({proc_id: ranges[proc_id] for proc_id in found_ids}, tz_offsets)
+    results = {}
+    for proc_id in proc_ids:
+        traffic, min_ts, max_ts = totals.get(proc_id, (None, None, None))
+        if proc_id not in found_ids:
+            results[proc_id] = {'err': True, 'msg': 'Wrong processor id'}
+        elif traffic:
+            results[proc_id] = {'traffic': int(traffic),
+                                'min_ts': min_ts.strftime(DT_FORMAT),
+                                'max_ts': max_ts.strftime(DT_FORMAT),
+                                'err': False}
+        else:
+            results[proc_id] = {'err': True, 'msg': 'No records found'}
+    return {'results': results, 'err': False}
+
+
 @api_bp.route('/Objects', methods=['POST'])
 def get_objects():
     """
@@ -87,15 +261,23 @@ def get_objects():
     if not proc_id:
         abort(400, 'proc_id is required')
     ts = params.get('ts', dt.datetime.now())
+    ts = _ts_param(ts)
+    if 'ts' not in params:
+        # current value is taken from live storage without DB requests (only objects counters publish there)
+        live = _live_values([proc_id], {proc_id: ts})
+        if proc_id in live:
+            value, value_ts = live[proc_id]
+            return {'count': int(value),
+                    'ts': value_ts.strftime(DT_FORMAT),
+                    'err': False}
     # noinspection PyUnresolvedReferences
     processor = ObjectsCounter.query.filter_by(id=proc_id).first()
     if processor:
-        # noinspection PyUnresolvedReferences
-        res = ProcessorEvent.query.filter_by(processor_id=processor.id).filter(ProcessorEvent.ts <= ts).order_by(
-            desc(ProcessorEvent.ts)).first()
+        res = latest_value(processor.id, ts)
         if res:
-            return {'count': int(res.value),
-                    'ts': res.ts.strftime(DT_FORMAT),
+            value, value_ts = res
+            return {'count': int(value),
+                    'ts': value_ts.strftime(DT_FORMAT),
                     'err': False}
         else:
             return {'err': True, 'msg': 'No observations found'}
@@ -103,16 +285,134 @@ def get_objects():
         return {'err': True, 'msg': 'Wrong processor id'}
 
 
+@api_bp.route('/ObjectsBatch', methods=['POST'])
+def get_objects_batch():
+    """
+    Returns number of objects at frame ROEs for many processors at once
+    - proc_ids: list of processor ids
+    - ts: [Optional] timestamp; if omitted - current ts is used
+    - timestamps: [Optional] {proc_id: ts} to override ts for some processors
+    ts format: "2020-02-23 14:00:00.0"
+    """
+    params = request.get_json()
+    proc_ids = _ids_param(params)
+    ts = params.get('ts', dt.datetime.now())
+    custom_timestamps = params.get('timestamps', {})
+    if not isinstance(custom_timestamps, dict):
+        abort(400, 'timestamps must be a dict of proc_id: ts')
+    timestamps = {proc_id: _ts_param(custom_timestamps.get(str(proc_id), ts)) for proc_id in proc_ids}
+    # noinspection PyUnresolvedReferences
+    found_ids = {p.id for p in ObjectsCounter.query.with_entities(ObjectsCounter.id).filter(
+        ObjectsCounter.id.in_(proc_ids))}
+    live_ids = [proc_id for proc_id in found_ids if 'ts' not in params and str(proc_id) not in custom_timestamps]
+    values = _live_values(live_ids, timestamps)
+    values.update(latest_values({proc_id: timestamps[proc_id] for proc_id in found_ids if proc_id not in values}))
+    results = {}
+    for proc_id in proc_ids:
+        if proc_id not in found_ids:
+            results[proc_id] = {'err': True, 'msg': 'Wrong processor id'}
+        elif proc_id in values:
+            value, value_ts = values[proc_id]
+            results[proc_id] = {'count': int(value),
+                                'ts': value_ts.strftime(DT_FORMAT),
+                                'err': False}
+        else:
+            results[proc_id] = {'err': True, 'msg': 'No observations found'}
+    return {'results': results, 'err': False}
+
+
+@api_bp.route('/Series', methods=['POST'])
+def get_series():
+    """
+    Returns time series of a processor metric with a given bucket size:
+    traffic for each bucket for TrafficCounter and number of objects at the end of each bucket for ObjectsCounter
+    - proc_id: processor id
+    - start_ts: timestamp to start from (rounded down to bucket start)
+    - stop_ts: [Optional] last timestamp (not included); if omitted - current ts is used
+    - bucket: bucket size in seconds
+    ts format: "2020-02-23 14:00:00.0"
+    """
+    params = request.get_json()
+    proc_id = params.get('proc_id', None)
+    if not proc_id:
+        abort(400, 'proc_id is required')
+    start_ts = params.get('start_ts', None)
+    if not start_ts:
+        abort(400, 'start_ts is required')
+    bucket = params.get('bucket', None)
+    if not isinstance(bucket, int) or bucket <= 0:
+        abort(400, 'bucket must be a positive number of seconds')
+    stop_ts = params.get('stop_ts', dt.datetime.now())
+    start_ts = _ts_param(start_ts)
+    stop_ts = _ts_param(stop_ts)
+    if (stop_ts - start_ts) / dt.timedelta(seconds=bucket) > current_app.config['SERIES_MAX_BUCKETS']:
+        abort(400, 'Too many buckets')
+    # noinspection PyUnresolvedReferences
+    processor = Processor.query.filter_by(id=proc_id).first()
+    if isinstance(processor, TrafficCounter):
+        get_series_func = traffic_series
+    elif isinstance(processor, ObjectsCounter):
+        get_series_func = objects_series
+    else:
+        return {'err': True, 'msg': 'Wrong processor id'}
+    try:
+        series = get_series_func(processor.id, start_ts, stop_ts, bucket, current_app.config['USE_ROLLUPS'],
+                                 *_retention_limits())
+    except PrecisionError as e:
+        abort(400, str(e))
+    return {'bucket': bucket,
+            'series': [{'ts': ts.strftime(DT_FORMAT), 'value': value} for ts, value in series],
+            'err': False}
+
+
+@api_bp.route('/Export', methods=['POST'])
+def export():
+    """
+    Streams raw events of processors with start_ts <= ts < stop_ts
+    - proc_ids: list of processor ids
+    - start_ts: timestamp to start from
+    - stop_ts: [Optional] timestamp to stop at; if omitted - current ts is used
+    - format: [Optional] ndjson (default) or csv
+    ts format: "2020-02-23 14:00:00.0"
+    """
+    params = request.get_json()
+    proc_ids = _ids_param(params)
+    start_ts = params.get('start_ts', None)
+    if not start_ts:
+        abort(400, 'start_ts is required')
+    start_ts = _ts_param(start_ts)
+    stop_ts = _ts_param(params.get('stop_ts', dt.datetime.now()))
+    fmt = params.get('format', FORMAT_NDJSON)
+    if fmt not in FORMATS:
+        abort(400, 'format must be one of {}'.format(', '.join(FORMATS)))
+    # events are read and sent by chunks while the response is being transferred
+    return Response(export_events(proc_ids, start_ts, stop_ts, fmt, current_app.config['EXPORT_CHUNK_SIZE']),
+                    mimetype=FORMATS[fmt],
+                    headers={'Content-Disposition': 'attachment; filename=events.{}'.format(fmt)})
+
+
 @api_bp.route('/getFrame', methods=['POST'])
 def get_frame():
     """
-    Requests one frame from camera, saves it to temp dir and returns path to it.
+    Returns path to the latest frame published by the camera watcher.
+    If the camera is not watched requests one frame from camera, saves it to temp dir and returns path to it.
     To avoid overfill it removes old frames from temp dir
     """
     params = request.get_json()
     camera_id = params.get('camera_id', None)
     if not camera_id:
         return abort(400, 'camera_id is required')
+    try:
+        live_frame = read_live_frame_info(camera_id)
+    except Exception as e:
+        # the frame is read from the camera then
+        logging.error('Failed to read live frame of camera {}'.format(camera_id))
+        logging.error(str(e))
+        live_frame = None
+    if live_frame:
+        # ts makes path unique, so browser does not show a cached frame
+        return {'path': url_for('api.live_frame', camera_id=camera_id, ts=live_frame['ts']),
+                'height': live_frame['height'], 'width': live_frame['width'], 'err': False}
     # find camera
     # noinspection PyUnresolvedReferences
     camera = Camera.query.get(camera_id)
@@ -144,6 +444,17 @@ def get_frame():
         return {'err': True, 'msg': 'Camera does not respond'}
 
 
+@api_bp.route('/liveFrame/<int:camera_id>')
+def live_frame(camera_id):
+    """
+    Returns JPEG of the latest frame published by the camera watcher
+    """
+    jpg = read_live_frame(camera_id)
+    if jpg is None:
+        abort(404, 'Camera is not watched')
+    return Response(jpg, mimetype='image/jpeg')
+
+
 # Custom static data
 @api_bp.route('/frame/<path:filename>')
 def custom_static(filename):
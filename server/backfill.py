@@ -0,0 +1,246 @@
+"""
+Offline backfill of ProcessorEvents from recorded video.
+
+Recorded files of a camera are split into time chunks processed in parallel by a process pool.
+Each chunk starts overlap seconds earlier to warm up the processor state (tracks of a traffic counter);
+events of the warm-up part belong to the previous chunk and are dropped, so chunks do not duplicate events.
+Then events of the processor in the range are replaced in one transaction and rollups are rebuilt.
+
+Events can be also recomputed from the detection log of watchers (see server.detection_log) without video and
+the object detector.
+"""
+import datetime as dt
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from cv2 import cv2
+from sqlalchemy import and_
+
+from server.database import engine, db_session
+from server.detection_log import read_detections
+from server.models import Processor, ProcessorEvent, Frame
+from server.result_cache import bump_generations
+from server.rollups import rebuild_rollups
+from server.tasks import read_frames, detect_objs
+
+# (ts, value)
+Event = Tuple[dt.datetime, int]
+
+
+class VideoFile(NamedTuple):
+    path: str
+    start: dt.datetime
+    frame_rate: float
+    n_frames: int
+
+    @property
+    def stop(self) -> dt.datetime:
+        return self.start + dt.timedelta(seconds=self.n_frames / self.frame_rate)
+
+
+class EventsSink:
+    """
+    Collects events of a processor instead of event_writer
+    """
+
+    def __init__(self):
+        self.events: List[Event] = []
+
+    def add(self, processor_id: int, ts: dt.datetime, value: int):
+        self.events.append((ts, value))
+
+
+def video_timeline(paths: Iterable[str], start: dt.datetime) -> List[VideoFile]:
+    """
+    Places consecutive recordings on the time axis
+    :param paths: video files in order of recording
+    :param start: ts of the first frame of the first file (camera local time as events)
+    """
+    timeline = []
+    for path in paths:
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            raise ValueError('Failed to open {}'.format(path))
+        frame_rate = cap.get(cv2.CAP_PROP_FPS)
+        n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        if not frame_rate > 0:
+            raise ValueError('Unknown frame rate of {}'.format(path))
+        video = VideoFile(path, start, frame_rate, n_frames)
+        timeline.append(video)
+        start = video.stop
+    return timeline
+
+
+def _init_worker():
+    # connections of the parent process must not be shared with forked workers
+    engine.dispose()
+
+
+def load_processor(processor_id: int) -> Processor:
+    """
+    Loads processor with its camera and detaches it from the session, so it can be used without DB
+    """
+    # noinspection PyUnresolvedReferences
+    processor = Processor.query.get(processor_id)
+    if processor is None:
+        raise ValueError('Processor {} was not found'.format(processor_id))
+    _ = processor.camera.grid_size
+    db_session.expunge_all()
+    # no preview for history
+    processor.output_hls = False
+    return processor
+
+
+def process_frames(processor: Processor, frames: Iterator[Frame], batch_size: int, detect: bool = False):
+    """
+    Passes frames to the processor by batches (as segments for watchers)
+    :param detect: run object detector on batches
+    """
+    batch: List[Frame] = []
+
+    def process_batch():
+        if detect:
+            detect_objs(batch, processor.camera.grid_size)
+        processor.process(batch)
+        batch.clear()
+
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) >= batch_size:
+            process_batch()
+    if batch:
+        process_batch()
+
+
+def _video_frames(timeline: List[VideoFile], watch_fps: float, start: dt.datetime,
+                  stop: dt.datetime) -> Iterator[Frame]:
+    for video in timeline:
+        if video.stop <= start or video.start >= stop:
+            continue
+        cap = cv2.VideoCapture(video.path)
+        first_frame = max(0, int((start - video.start).total_seconds() * video.frame_rate))
+        if first_frame:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, first_frame)
+        first_ts = video.start + dt.timedelta(seconds=first_frame / video.frame_rate)
+        try:
+            for frame in read_frames(cap, video.frame_rate, watch_fps, first_ts):
+                if frame.ts >= stop:
+                    return
+                yield frame
+        finally:
+            cap.release()
+
+
+def process_chunk(processor_id: int, timeline: List[VideoFile], warmup_start: dt.datetime,
+                  chunk_start: dt.datetime, chunk_stop: dt.datetime, batch_seconds: float) -> List[Event]:
+    """
+    Runs detection and the processor on frames of [warmup_start, chunk_stop)
+    :return: events of [chunk_start, chunk_stop)
+    """
+    processor = load_processor(processor_id)
+    processor.event_sink = EventsSink()
+    frames = _video_frames(timeline, processor.camera.watch_fps, warmup_start, chunk_stop)
+    process_frames(processor, frames, max(1, int(batch_seconds * processor.camera.watch_fps)), detect=True)
+    return [event for event in processor.event_sink.events if chunk_start <= event[0] < chunk_stop]
+
+
+def merge_events(chunks: List[List[Event]], processor_type: str) -> List[Event]:
+    """
+    Joins events of chunks. Objects counter repeats the current value at the start of each batch and chunk,
+    repeated values are dropped.
+    """
+    events = sorted(event for chunk in chunks for event in chunk)
+    if processor_type != 'object':
+        return events
+    merged = []
+    for event in events:
+        if not merged or merged[-1][1] != event[1]:
+            merged.append(event)
+    return merged
+
+
+def write_events(processor_id: int, start: dt.datetime, stop: dt.datetime, events: List[Event],
+                 batch_size: int = 10000):
+    """
+    Replaces events of the processor in [start, stop) in one transaction, rebuilds rollups
+    and invalidates cached API results
+    """
+    pe = ProcessorEvent.__table__
+    rows = [{'processor_id': processor_id, 'ts': ts, 'value': value} for ts, value in events]
+    with engine.begin() as conn:
+        deleted = conn.execute(pe.delete().where(and_(pe.c.processor_id == processor_id,
+                                                      pe.c.ts >= start, pe.c.ts < stop))).rowcount
+        for i in range(0, len(rows), batch_size):
+            conn.execute(pe.insert(), rows[i:i + batch_size])
+    logging.info('Processor {}: {} events replaced by {} events'.format(processor_id, deleted, len(rows)))
+    rebuild_rollups([processor_id], start, stop - dt.timedelta(microseconds=1))
+    bump_generations([processor_id])
+
+
+def backfill(processor_id: int, paths: List[str], start: dt.datetime, stop: Optional[dt.datetime] = None,
+             workers: int = 4, chunk_seconds: float = 600, overlap_seconds: float = 30,
+             batch_seconds: float = 10) -> int:
+    """
+    Recalculates events of a processor from recorded video
+    :param processor_id: processor to recalculate (its camera settings are used)
+    :param paths: consecutive video files of the camera
+    :param start: ts of the first frame of the first file
+    :param stop: ts to stop at (the end of the last file if None)
+    :param workers: number of processes
+    :param chunk_seconds: duration of video processed by one task
+    :param overlap_seconds: warm-up duration before each chunk
+    :param batch_seconds: duration of frames passed to detector and processor at once (as a segment for watchers)
+    :return: number of written events
+    """
+    t0 = time.time()
+    processor = load_processor(processor_id)
+    if processor.type not in ('traffic', 'object'):
+        raise ValueError('Processor {} of type {} does not write events, it can not be backfilled'.format(
+            processor_id, processor.type))
+    timeline = video_timeline(paths, start)
+    stop = min(stop or timeline[-1].stop, timeline[-1].stop)
+    chunks = []
+    chunk_start = start
+    while chunk_start < stop:
+        chunk_stop = min(chunk_start + dt.timedelta(seconds=chunk_seconds), stop)
+        warmup_start = max(start, chunk_start - dt.timedelta(seconds=overlap_seconds))
+        chunks.append((processor_id, timeline, warmup_start, chunk_start, chunk_stop, batch_seconds))
+        chunk_start = chunk_stop
+    logging.info('Backfill of processor {} from {} to {}: {} chunks'.format(processor_id, start, stop, len(chunks)))
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as executor:
+        results = list(executor.map(process_chunk, *zip(*chunks)))
+    events = merge_events(results, processor.type)
+    write_events(processor_id, start, stop, events)
+    elapsed = time.time() - t0
+    logging.info('Backfill of {:.0f} seconds of video took {:.0f} seconds'.format(
+        (stop - start).total_seconds(), elapsed))
+    return len(events)
+
+
+def recompute(processor_id: int, log_dir: str, start: dt.datetime, stop: dt.datetime,
+              batch_seconds: float = 10) -> int:
+    """
+    Recalculates events of a processor from logged detections of its camera (with current zones and threshold)
+    :param processor_id: processor to recalculate
+    :param log_dir: DETECTION_LOG_DIR of watchers
+    :param start: first ts
+    :param stop: ts to stop at (exclusive)
+    :param batch_seconds: duration of frames passed to the processor at once (as a segment for watchers)
+    :return: number of written events
+    """
+    t0 = time.time()
+    processor = load_processor(processor_id)
+    if processor.type not in ('traffic', 'object'):
+        raise ValueError('Processor {} of type {} needs images, it can not be recomputed from detections'.format(
+            processor_id, processor.type))
+    processor.event_sink = EventsSink()
+    frames = read_detections(log_dir, processor.camera_id, start, stop)
+    process_frames(processor, frames, max(1, int(batch_seconds * processor.camera.watch_fps)))
+    events = merge_events([processor.event_sink.events], processor.type)
+    write_events(processor_id, start, stop, events)
+    logging.info('Recompute of processor {} from {} to {} took {:.1f} seconds'.format(
+        processor_id, start, stop, time.time() - t0))
+    return len(events)
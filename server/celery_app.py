@@ -0,0 +1,12 @@
+"""
+Celery application without tasks code.
+
+Tasks are defined in server.tasks, which loads video processing libraries. Workers import it by `include`,
+while the API, admin and CLI send tasks by name and do not import it.
+"""
+from celery import Celery
+
+celery = Celery('server', autofinalize=False, include=['server.tasks'])
+
+WATCH_CAMERA_TASK = 'server.tasks.watch_camera'
+COMPACT_OLD_EVENTS_TASK = 'server.tasks.compact_old_events'
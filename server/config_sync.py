@@ -0,0 +1,83 @@
+"""
+Notifications of watchers about config changes.
+
+Admin publishes ids of changed cameras to CONFIG_REDIS_CHANNEL after a camera or a processor is saved or deleted.
+A watcher keeps its camera and processors loaded and reloads them from the DB only when it is notified
+or every CONFIG_RESYNC_INTERVAL seconds (in case a notification is lost while Redis is unavailable).
+"""
+import logging
+import time
+from typing import Iterable
+
+from server.instance.config import CONFIG_REDIS_CHANNEL
+from server.redis_client import get_redis
+
+
+def publish_config_change(camera_ids: Iterable[int]):
+    """
+    Notifies watchers of cameras that their config is changed
+    """
+    try:
+        r = get_redis()
+        for camera_id in set(camera_ids):
+            if camera_id is not None:
+                r.publish(CONFIG_REDIS_CHANNEL, str(camera_id))
+    except Exception as e:
+        logging.error('Failed to publish config change of cameras {}'.format(camera_ids))
+        logging.error(str(e))
+
+
+class ConfigListener:
+    """
+    Tells a watcher when its config must be reloaded. Notifications are polled without a background thread.
+    """
+    # seconds between attempts to subscribe if Redis is unavailable
+    retry_interval = 10
+
+    def __init__(self, camera_id: int, resync_interval: float):
+        self.camera_id = camera_id
+        self.resync_interval = resync_interval
+        self._pubsub = None
+        self._changed = True
+        self._synced_at = time.monotonic()
+        self._retry_at = 0
+
+    def changed(self) -> bool:
+        """
+        Checks notifications. The result stays True until reloaded() is called.
+        """
+        now = time.monotonic()
+        if now - self._synced_at >= self.resync_interval:
+            self._changed = True
+        if self._pubsub is None and now < self._retry_at:
+            return self._changed
+        try:
+            if self._pubsub is None:
+                self._pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+                self._pubsub.subscribe(CONFIG_REDIS_CHANNEL)
+                # changes could be missed while not subscribed
+                self._changed = True
+            while True:
+                message = self._pubsub.get_message()
+                if message is None:
+                    break
+                if message['data'].decode() == str(self.camera_id):
+                    self._changed = True
+        except Exception as e:
+            logging.error('Failed to check config changes of camera {}'.format(self.camera_id))
+            logging.error(str(e))
+            self.close()
+            self._retry_at = now + self.retry_interval
+        return self._changed
+
+    def reloaded(self):
+        self._changed = False
+        self._synced_at = time.monotonic()
+
+    def close(self):
+        if self._pubsub is not None:
+            try:
+                self._pubsub.close()
+            except Exception as e:
+                logging.warning(str(e))
+            self._pubsub = None
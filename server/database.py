@@ -4,7 +4,8 @@ from sqlalchemy.orm import scoped_session, sessionmaker
 
 import os
 
-engine = create_engine('mysql://{}:{}@{}/{}'.format(
+# DATABASE_URL overrides MySQL settings (for example sqlite:// for benchmarks)
+engine = create_engine(os.getenv('DATABASE_URL') or 'mysql://{}:{}@{}/{}'.format(
     os.getenv('DB_USER', 'flask'),
     os.getenv('DB_PASSWORD', ''),
     os.getenv('DB_HOST', 'mysql'),
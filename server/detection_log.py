@@ -0,0 +1,118 @@
+"""
+Append-only log of raw detections of watchers, so processors events can be recomputed
+(e.g. after zones or threshold are changed) without running the object detector again.
+
+Detections of a camera are stored per hour in DETECTION_LOG_DIR/cam<camera_id>/<YYYYmmddHH>/ as two raw
+little-endian numpy arrays which can be appended by a watcher and memory mapped by readers:
+- frames.bin: FRAME_DTYPE, one row per frame (ts, index of its first object, number of objects, image size)
+- objects.bin: OBJECT_DTYPE, detected objects of all frames one after another
+"""
+import datetime as dt
+import logging
+import os
+from itertools import groupby
+from typing import Iterator, List
+
+import numpy as np
+
+from server.models import DetectedObject, Frame
+
+FRAMES_FILE = 'frames.bin'
+OBJECTS_FILE = 'objects.bin'
+# ts is in microseconds since 1970-01-01 (naive camera local time as events)
+FRAME_DTYPE = np.dtype([('ts', '<i8'), ('start', '<u8'), ('count', '<u4'), ('height', '<u2'), ('width', '<u2')])
+OBJECT_DTYPE = np.dtype([('x_min', '<f4'), ('y_min', '<f4'), ('x_max', '<f4'), ('y_max', '<f4'), ('prob', '<f4'),
+                         ('cls', '<i2')])
+EPOCH = dt.datetime(1970, 1, 1)
+HOUR = dt.timedelta(hours=1)
+
+
+def _to_us(ts: dt.datetime) -> int:
+    return (ts - EPOCH) // dt.timedelta(microseconds=1)
+
+
+def _hour_dir(root: str, camera_id: int, hour: dt.datetime) -> str:
+    return os.path.join(root, 'cam{}'.format(camera_id), '{:%Y%m%d%H}'.format(hour))
+
+
+def _empty_image(height: int, width: int) -> np.ndarray:
+    # image of the right shape without memory: processors use only its size, images are not logged
+    return np.lib.stride_tricks.as_strided(np.zeros(1, dtype=np.uint8), (height, width, 3), (0, 0, 0))
+
+
+class DetectionLog:
+    """
+    Writer of detections of one camera
+    """
+
+    def __init__(self, root: str, camera_id: int):
+        self.root = root
+        self.camera_id = camera_id
+
+    def append(self, frames: List[Frame]):
+        """
+        Appends detected objects of frames (in order of ts)
+        """
+        for hour, hour_frames in groupby(frames, key=lambda f: f.ts.replace(minute=0, second=0, microsecond=0)):
+            self._append_hour(hour, list(hour_frames))
+
+    def _append_hour(self, hour: dt.datetime, frames: List[Frame]):
+        path = _hour_dir(self.root, self.camera_id, hour)
+        os.makedirs(path, exist_ok=True)
+        objects_path = os.path.join(path, OBJECTS_FILE)
+        # objects are written first: objects without frame rows (an interrupted append) are just never read
+        start = os.path.getsize(objects_path) // OBJECT_DTYPE.itemsize if os.path.exists(objects_path) else 0
+        index = np.empty(len(frames), dtype=FRAME_DTYPE)
+        objects = np.empty(sum(len(frame.objects) for frame in frames), dtype=OBJECT_DTYPE)
+        i = 0
+        for k, frame in enumerate(frames):
+            height, width = frame.image.shape[:2]
+            index[k] = (_to_us(frame.ts), start + i, len(frame.objects), height, width)
+            for obj in frame.objects:
+                objects[i] = (obj.x_min, obj.y_min, obj.x_max, obj.y_max, obj.prob, obj.cls)
+                i += 1
+        with open(objects_path, 'ab') as f:
+            objects.tofile(f)
+        with open(os.path.join(path, FRAMES_FILE), 'ab') as f:
+            index.tofile(f)
+
+    def write(self, frames: List[Frame]):
+        """
+        Appends frames logging errors (logging must not stop the watcher)
+        """
+        try:
+            self.append(frames)
+        except Exception as e:
+            logging.error('Failed to log detections of camera {}'.format(self.camera_id))
+            logging.error(str(e))
+
+
+def _memmap(path: str, dtype: np.dtype) -> np.ndarray:
+    size = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+    if not size:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(size,))
+
+
+def read_detections(root: str, camera_id: int, start: dt.datetime, stop: dt.datetime) -> Iterator[Frame]:
+    """
+    Reads logged frames of [start, stop) in order of ts. Frame images are empty (only their shape is kept).
+    """
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    start_us, stop_us = _to_us(start), _to_us(stop)
+    while hour < stop:
+        path = _hour_dir(root, camera_id, hour)
+        hour += HOUR
+        index = _memmap(os.path.join(path, FRAMES_FILE), FRAME_DTYPE)
+        if not len(index):
+            continue
+        objects = _memmap(os.path.join(path, OBJECTS_FILE), OBJECT_DTYPE)
+        in_range = (index['ts'] >= start_us) & (index['ts'] < stop_us)
+        # segments processed again after a watcher restart are appended twice, the first rows are taken
+        _, first = np.unique(index['ts'][in_range], return_index=True)
+        for row in index[in_range][first]:
+            frame = Frame(_empty_image(int(row['height']), int(row['width'])),
+                          EPOCH + dt.timedelta(microseconds=int(row['ts'])))
+            first_obj = int(row['start'])
+            frame.objects = [DetectedObject(*obj) for obj in objects[first_obj:first_obj + int(row['count'])].tolist()]
+            yield frame
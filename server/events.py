@@ -0,0 +1,122 @@
+import datetime as dt
+import logging
+import os
+import threading
+from typing import Callable, List
+
+from server.database import Base, engine
+from server.instance.config import EVENT_WRITER_BATCH_SIZE, EVENT_WRITER_FLUSH_INTERVAL, EVENT_WRITER_MAX_BUFFER
+
+
+class EventWriter:
+    """
+    Write-behind storage of ProcessorEvents.
+    Events of all processors of the process are buffered in memory and inserted by a background thread
+    with multi-row inserts when batch_size events are collected or each flush_interval seconds.
+    So watchers do not wait for DB commits.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_buffer: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer  # events above this limit are dropped (oldest first) if DB is unavailable
+        self.flush_hooks: List[Callable] = []
+        self.commit_hooks: List[Callable] = []
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+    def add(self, processor_id: int, ts: dt.datetime, value: int):
+        """
+        Buffers one event
+        """
+        with self._lock:
+            self._rows.append({'processor_id': processor_id, 'ts': ts, 'value': value})
+            buffered = len(self._rows)
+        self._ensure_thread()
+        if buffered >= self.batch_size:
+            self._wakeup.set()
+
+    def add_flush_hook(self, hook: Callable):
+        """
+        Hook is called as hook(connection, rows) inside the transaction which inserts rows
+        """
+        if hook not in self.flush_hooks:
+            self.flush_hooks.append(hook)
+
+    def add_commit_hook(self, hook: Callable):
+        """
+        Hook is called as hook(rows) after rows are committed. Its errors do not affect writing
+        """
+        if hook not in self.commit_hooks:
+            self.commit_hooks.append(hook)
+
+    def flush(self) -> int:
+        """
+        Inserts all buffered events.
+        If insert fails events are returned to the buffer to be inserted next time.
+        :return: number of inserted events
+        """
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+            try:
+                table = Base.metadata.tables['processor_event']
+                with engine.begin() as conn:
+                    for i in range(0, len(rows), self.batch_size):
+                        conn.execute(table.insert(), rows[i:i + self.batch_size])
+                    for hook in self.flush_hooks:
+                        hook(conn, rows)
+            except Exception as e:
+                logging.error('Failed to write {} events'.format(len(rows)))
+                logging.error(str(e))
+                with self._lock:
+                    self._rows = rows + self._rows
+                    if len(self._rows) > self.max_buffer:
+                        logging.error('Event buffer is full. {} events dropped'.format(
+                            len(self._rows) - self.max_buffer))
+                        self._rows = self._rows[-self.max_buffer:]
+                return 0
+            logging.debug('Written {} events'.format(len(rows)))
+            for hook in self.commit_hooks:
+                try:
+                    hook(rows)
+                except Exception as e:
+                    logging.error('Commit hook failed')
+                    logging.error(str(e))
+            return len(rows)
+
+    def close(self):
+        """
+        Stops background thread and writes all buffered events
+        """
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def _ensure_thread(self):
+        # thread must be started in the process which uses writer (watchers are forked by Celery)
+        if self._thread is None or self._pid != os.getpid():
+            self._closed = False
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='event-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if not self._closed:
+                self.flush()
+
+
+event_writer = EventWriter(EVENT_WRITER_BATCH_SIZE, EVENT_WRITER_FLUSH_INTERVAL, EVENT_WRITER_MAX_BUFFER)
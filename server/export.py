@@ -0,0 +1,60 @@
+"""
+Streaming export of raw ProcessorEvents.
+Events are read by a server side cursor chunk by chunk, so memory does not depend on the range size.
+"""
+import csv
+import datetime as dt
+import io
+import json
+from typing import Iterator, List
+
+from sqlalchemy import and_, select
+
+from server.database import engine
+from server.models import ProcessorEvent, DT_FORMAT
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_CSV = 'csv'
+FORMATS = {FORMAT_NDJSON: 'application/x-ndjson', FORMAT_CSV: 'text/csv'}
+COLUMNS = ['id', 'processor_id', 'ts', 'value']
+
+
+def iter_events(proc_ids: List[int], start: dt.datetime, stop: dt.datetime,
+                chunk_size: int = 10000) -> Iterator[list]:
+    """
+    Yields chunks of events of processors with start <= ts < stop ordered by processor and ts
+    :param proc_ids: processors ids
+    :param start: first ts (inclusive)
+    :param stop: last ts (exclusive)
+    :param chunk_size: number of events fetched at once
+    """
+    pe = ProcessorEvent.__table__
+    query = select([pe.c.id, pe.c.processor_id, pe.c.ts, pe.c.value]).where(and_(
+        pe.c.processor_id.in_(proc_ids), pe.c.ts >= start, pe.c.ts < stop)).order_by(pe.c.processor_id, pe.c.ts)
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        rows = result.fetchmany(chunk_size)
+        while rows:
+            yield rows
+            rows = result.fetchmany(chunk_size)
+
+
+def export_events(proc_ids: List[int], start: dt.datetime, stop: dt.datetime, fmt: str = FORMAT_NDJSON,
+                  chunk_size: int = 10000) -> Iterator[str]:
+    """
+    Yields events encoded to NDJSON lines or CSV (with header), one piece per chunk
+    """
+    if fmt == FORMAT_CSV:
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow(COLUMNS)
+        yield buf.getvalue()
+        for rows in iter_events(proc_ids, start, stop, chunk_size):
+            buf.seek(0)
+            buf.truncate()
+            writer.writerows((row[0], row[1], row[2].strftime(DT_FORMAT), row[3]) for row in rows)
+            yield buf.getvalue()
+    else:
+        for rows in iter_events(proc_ids, start, stop, chunk_size):
+            yield ''.join(json.dumps({'id': row[0], 'processor_id': row[1], 'ts': row[2].strftime(DT_FORMAT),
+                                      'value': row[3]}) + '\n' for row in rows)
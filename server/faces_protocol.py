@@ -0,0 +1,82 @@
+"""
+Faces messages protocol used between face detectors, WS relay and its clients.
+
+There are two message formats:
+- json (legacy): JSON string, each face has its image as a base64 string in `img`
+- binary: 4 bytes big-endian header length, JSON header and raw face images one after another.
+  The header is the same as a json message but each face has image length `size` instead of `img`.
+"""
+import base64
+import json
+import struct
+from typing import List, Tuple, Union
+
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+
+_header_len = struct.Struct('>I')
+
+
+def encode_binary(meta: dict, images: List[bytes]) -> bytes:
+    """
+    Packs message meta and face images to a binary message
+    :param meta: message without faces images; meta['faces'] must be aligned with images
+    :param images: encoded face images
+    :return:
+    """
+    faces = [dict(face, size=len(img)) for face, img in zip(meta['faces'], images)]
+    header = json.dumps(dict(meta, faces=faces)).encode()
+    return b''.join([_header_len.pack(len(header)), header] + images)
+
+
+def decode_header(message: bytes) -> Tuple[dict, int]:
+    """
+    Reads only header of a binary message
+    :param message:
+    :return: header and offset of the first image
+    """
+    header_len, = _header_len.unpack_from(message)
+    offset = _header_len.size + header_len
+    return json.loads(message[_header_len.size:offset].decode()), offset
+
+
+def decode_binary(message: bytes) -> Tuple[dict, List[bytes]]:
+    """
+    Unpacks binary message to header and face images
+    """
+    header, offset = decode_header(message)
+    images = []
+    for face in header['faces']:
+        images.append(message[offset:offset + face['size']])
+        offset += face['size']
+    return header, images
+
+
+def binary_to_json(message: bytes) -> str:
+    header, images = decode_binary(message)
+    faces = []
+    for face, img in zip(header['faces'], images):
+        face = dict(face, img=base64.b64encode(img).decode())
+        face.pop('size')
+        faces.append(face)
+    return json.dumps(dict(header, faces=faces))
+
+
+def json_to_binary(message: str) -> bytes:
+    data = json.loads(message)
+    images = []
+    faces = []
+    for face in data['faces']:
+        face = dict(face)
+        images.append(base64.b64decode(face.pop('img')))
+        faces.append(face)
+    return encode_binary(dict(data, faces=faces), images)
+
+
+def message_header(message: Union[str, bytes]) -> dict:
+    """
+    Returns message info without decoding images
+    """
+    if isinstance(message, bytes):
+        return decode_header(message)[0]
+    return json.loads(message)
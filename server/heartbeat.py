@@ -0,0 +1,63 @@
+"""
+Watchers heartbeats registry.
+Each watcher writes its state to Redis on each loop; the key expires if the watcher dies or hangs.
+"""
+import json
+import logging
+import os
+import socket
+import time
+from typing import Dict, List, Optional
+
+from server.instance.config import HEARTBEAT_TTL
+from server.redis_client import get_redis, HEARTBEAT_KEY
+
+
+class Heartbeat:
+    """
+    Heartbeat of one camera watcher. Info passed to beat() is kept between beats,
+    so the last processed segment is reported while the watcher is sleeping.
+    """
+
+    def __init__(self, camera_id: int, task_id: Optional[str] = None, worker: Optional[str] = None):
+        self.camera_id = camera_id
+        self.info = {'camera_id': camera_id,
+                     'pid': os.getpid(),
+                     'host': socket.gethostname(),
+                     'worker': worker,
+                     'task_id': task_id,
+                     'started': time.time()}
+
+    def beat(self, state: str, **info):
+        """
+        Writes watcher state
+        :param state: what watcher is doing: starting, processing, sleeping, no_processors, unavailable
+        :param info: last segment, lag, fps etc
+        """
+        self.info.update(info, state=state, ts=time.time())
+        try:
+            get_redis().set(HEARTBEAT_KEY.format(self.camera_id), json.dumps(self.info), ex=HEARTBEAT_TTL)
+        except Exception as e:
+            logging.error('Failed to write heartbeat of camera {}'.format(self.camera_id))
+            logging.error(str(e))
+
+    def stop(self):
+        """
+        Removes heartbeat on watcher exit
+        """
+        try:
+            get_redis().delete(HEARTBEAT_KEY.format(self.camera_id))
+        except Exception as e:
+            logging.error('Failed to remove heartbeat of camera {}'.format(self.camera_id))
+            logging.error(str(e))
+
+
+def read_heartbeats(camera_ids: List[int]) -> Dict[int, dict]:
+    """
+    Returns the latest heartbeats of running watchers
+    :return: camera id -> heartbeat info (cameras without running watchers are omitted)
+    """
+    if not camera_ids:
+        return {}
+    values = get_redis().mget([HEARTBEAT_KEY.format(camera_id) for camera_id in camera_ids])
+    return {camera_id: json.loads(value) for camera_id, value in zip(camera_ids, values) if value is not None}
@@ -16,11 +16,66 @@ SQLALCHEMY_ENGINE_OPTIONS = {'pool_recycle': 3600, 'pool_pre_ping': True}  # for
 CELERY_RESULT_BACKEND = 'redis://localhost'
 CELERY_BROKER_URL = 'redis://localhost'
 
+# Redis (shared state of watchers, relays and API)
+REDIS_URL = 'redis://localhost'
+
+LIVE_VALUE_TTL = 60  # seconds; current number of objects published by a watcher expires after this
+LIVE_VALUE_LOCAL_TTL = 0.5  # seconds; API process keeps values read from Redis for this time
+LIVE_FRAME_TTL = 60  # seconds; the latest frame of a camera published by a watcher expires after this
+LIVE_FRAME_QUALITY = 90  # JPEG quality of published frames
+EVENTS_REDIS_CHANNEL = 'hypersight:events'  # written events are published here for push subscriptions
+EVENTS_SSE_ADDRESS = '0.0.0.0'
+EVENTS_SSE_PORT = 6790
+EVENTS_SSE_KEEPALIVE = 15  # seconds between keepalive comments to idle subscribers
+PROFILE_INTERVAL = 0.01  # seconds between stack samples of a profiled watcher
+PROFILE_SECONDS = 30  # default duration of watcher profiling
+PROFILES_DIR = LOG_DIR  # collapsed stacks files of profiled watchers
+CONFIG_REDIS_CHANNEL = 'hypersight:config'  # admin notifies watchers of changed cameras and processors here
+CONFIG_RESYNC_INTERVAL = 300  # seconds; watchers reload config at least this often (if a notification is lost)
+HEARTBEAT_TTL = 120  # seconds; watcher without heartbeats for this time is considered dead
+SUPERVISOR_INTERVAL = 30  # seconds between checks of watchers by supervise_watchers.py
+SUPERVISOR_START_GRACE = 120  # seconds; a started watcher without heartbeats for this time is started again
+SUPERVISOR_STOP_TIMEOUT = 60  # seconds; a watcher stopped to be moved is killed if it does not exit for this time
+SUPERVISOR_REBALANCE_THRESHOLD = 0.3  # cameras are moved if loads of workers (per CPU) differ by more than this
+SUPERVISOR_MAX_MOVES = 1  # max number of cameras moved per check
+SUPERVISOR_DEFAULT_COST = 0.5  # load of a camera which was never watched (seconds of work per second of video)
+SUPERVISOR_COST_SMOOTHING = 0.3  # weight of the latest load in smoothed cost of a camera
+RESULT_CACHE_SIZE = 10000  # max number of results of closed time windows cached by an API process; 0 to disable
+RESULT_CACHE_INGEST_LAG = 600  # seconds; windows stopped earlier than this are closed (all their events are written)
+
 # hypersight
 SEGMENTS_DIR = '/tmp/hypersight/segments'  # dir for storing downloaded m3u8 segments
 PROCESSORS_PREVIEW_DIR = '/tmp/hypersight/preview'  # dir for storing processed m3u8 segments
 FRAMES_PATH = '/tmp/hypersight/frames'  # preview frames dir (for drawing zones)
 OBJECT_DETECTOR_URL = 'http://127.0.0.1:5007/detectObjects'  # URL for object detector
+EVENT_WRITER_BATCH_SIZE = 500  # events are written to DB when this number of events is buffered
+EVENT_WRITER_FLUSH_INTERVAL = 2  # ... or each this number of seconds
+EVENT_WRITER_MAX_BUFFER = 100000  # max number of buffered events (if DB is unavailable)
+# API takes aggregates from rollups; enable it after `flask rebuild-rollups` (rollups of events written before
+# they were introduced are missing), it is required for EVENT_RETENTION_DAYS
+USE_ROLLUPS = False
+SERIES_MAX_BUCKETS = 10000  # max number of buckets in one /Series response
+EXPORT_CHUNK_SIZE = 10000  # number of events read from DB and sent at once by /Export
+EVENT_RETENTION_DAYS = None  # raw events older than this are deleted daily (rollups are kept); None to keep all
+MINUTE_ROLLUPS_RETENTION_DAYS = None  # minute rollups older than this are deleted (hour rollups are kept forever)
+EVENT_PARTITIONS_AHEAD = 3  # future month partitions of processor_event (if it is partitioned)
+DETECTION_LOG_DIR = None  # dir of raw detections log of watchers for `flask recompute-events`; None to disable
+ADAPTIVE_FPS_IDLE_SECONDS = 60  # seconds of video without activity to lower sampling rate of cameras with min FPS
+# load shedding of watchers behind live: (lag seconds, step) applied in order,
+# steps: lower_fps, larger_grid, skip_preview, skip_faces; [] to disable
+LAG_LADDER = [(30, 'lower_fps'), (60, 'larger_grid'), (90, 'skip_preview'), (120, 'skip_faces')]
+LAG_RECOVERY_RATIO = 0.5  # a step is removed when lag drops below this part of its threshold
+LAG_FPS_FACTOR = 0.5  # sampling rate multiplier of the lower_fps step
+BACKFILL_WORKERS = 4  # processes of `flask backfill`
+BACKFILL_CHUNK_SECONDS = 600  # seconds of video processed by one backfill task
+BACKFILL_OVERLAP_SECONDS = 30  # seconds of video before each chunk to warm up processor state (traffic tracks)
 FACE_DETECTOR_URL = 'http://127.0.0.1:5007/detectFaces'  # URL for face detector
 FACE_WS_ADDRESS = '0.0.0.0'
 FACE_WS_PORT = 6789
+FACE_RELAY_MODE = 'ws'  # ws: detectors send faces to the relay; redis: detectors publish faces to FACE_REDIS_CHANNEL
+FACE_REDIS_CHANNEL = 'hypersight:faces'
+FACE_RELAY_METRICS_INTERVAL = 10  # seconds between relay metrics reports
+FACE_BEST_SHOT_MAX_DELAY = 10  # seconds; best face of a track is sent not later than this after track start
+FACE_BEST_SHOT_MAX_GAP = 5  # seconds; track without new objects for this time is finished
+FACE_GOOD_SHOT_CONF = 0.95  # face detection is skipped for tracks with a face of this confidence
+FACE_GOOD_SHOT_MIN_SIZE = 64  # ... and at least this size in pixels
@@ -0,0 +1,28 @@
+"""
+Lazy imports of heavy libraries (cv2, numpy, shapely, ffmpeg...).
+
+Models and API are imported by every process (Flask API, Celery workers, CLI), but only watchers process video.
+Modules shared by all of them import heavy libraries through LazyModule, so the API and CLI do not load them.
+"""
+import importlib
+
+
+class LazyModule:
+    """
+    Proxy of a module which is imported on the first access to its attributes
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, item):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        value = getattr(self._module, item)
+        # next accesses do not call __getattr__
+        setattr(self, item, value)
+        return value
+
+    def __repr__(self):
+        return '<lazy module {}{}>'.format(self._name, '' if self._module is None else ' (loaded)')
@@ -0,0 +1,109 @@
+"""
+Live values of processors and the latest frames of cameras published by watchers to Redis.
+API reads current values and preview frames from here instead of the DB and camera streams.
+New events are published to EVENTS_REDIS_CHANNEL for push subscriptions (see events_sse_server.py).
+"""
+import datetime as dt
+import json
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from server.instance.config import LIVE_VALUE_TTL, LIVE_VALUE_LOCAL_TTL, LIVE_FRAME_TTL, LIVE_FRAME_QUALITY, \
+    EVENTS_REDIS_CHANNEL
+from server.lazy import LazyModule
+from server.redis_client import get_redis, LIVE_VALUE_KEY, LIVE_FRAME_KEY
+
+# frames are encoded by watchers only, API does not load cv2
+cv2 = LazyModule('cv2.cv2')
+
+# process local copy of values read from Redis: proc_id -> (expiration time, value)
+_local_values = {}
+
+
+def publish_live_value(proc_id: int, value: int, ts: dt.datetime):
+    """
+    Saves the latest value of a processor. It expires in LIVE_VALUE_TTL seconds if the watcher stops.
+    """
+    try:
+        get_redis().set(LIVE_VALUE_KEY.format(proc_id), json.dumps({'value': value, 'ts': ts.isoformat()}),
+                        ex=LIVE_VALUE_TTL)
+    except Exception as e:
+        logging.error('Failed to publish live value of processor {}'.format(proc_id))
+        logging.error(str(e))
+
+
+def read_live_values(proc_ids: List[int]) -> Dict[int, Tuple[int, dt.datetime]]:
+    """
+    Returns the latest values of processors found in live storage.
+    Values are cached in the process for LIVE_VALUE_LOCAL_TTL seconds.
+    :return: processor id -> (value, ts)
+    """
+    now = time.monotonic()
+    values = {}
+    missing = []
+    for proc_id in proc_ids:
+        cached = _local_values.get(proc_id)
+        if cached and cached[0] > now:
+            values[proc_id] = cached[1]
+        else:
+            missing.append(proc_id)
+    if not missing:
+        return values
+    try:
+        raw_values = get_redis().mget([LIVE_VALUE_KEY.format(proc_id) for proc_id in missing])
+    except Exception as e:
+        logging.error('Failed to read live values')
+        logging.error(str(e))
+        return values
+    for proc_id, raw in zip(missing, raw_values):
+        if raw is None:
+            continue
+        data = json.loads(raw)
+        value = (data['value'], dt.datetime.fromisoformat(data['ts']))
+        _local_values[proc_id] = (now + LIVE_VALUE_LOCAL_TTL, value)
+        values[proc_id] = value
+    return values
+
+
+def publish_events(rows: List[dict]):
+    """
+    Publishes written events as one message: JSON list of [processor_id, ts, value].
+    It is a commit hook of event_writer, so only stored events are published.
+    """
+    get_redis().publish(EVENTS_REDIS_CHANNEL, json.dumps(
+        [[row['processor_id'], row['ts'].isoformat(), row['value']] for row in rows]))
+
+
+def publish_live_frame(camera_id: int, image: 'np.ndarray', ts: dt.datetime):
+    """
+    Saves the latest frame of a camera as JPEG. It expires in LIVE_FRAME_TTL seconds if the watcher stops.
+    """
+    try:
+        _, buf = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, LIVE_FRAME_QUALITY])
+        h, w = image.shape[:2]
+        key = LIVE_FRAME_KEY.format(camera_id)
+        pipe = get_redis().pipeline()
+        pipe.hset(key, mapping={'jpg': buf.tobytes(), 'height': h, 'width': w, 'ts': ts.isoformat()})
+        pipe.expire(key, LIVE_FRAME_TTL)
+        pipe.execute()
+    except Exception as e:
+        logging.error('Failed to publish live frame of camera {}'.format(camera_id))
+        logging.error(str(e))
+
+
+def read_live_frame_info(camera_id: int) -> Optional[dict]:
+    """
+    :return: {'height', 'width', 'ts'} of the latest frame of a camera or None if there is no running watcher
+    """
+    h, w, ts = get_redis().hmget(LIVE_FRAME_KEY.format(camera_id), ['height', 'width', 'ts'])
+    if h is None:
+        return None
+    return {'height': int(h), 'width': int(w), 'ts': ts.decode()}
+
+
+def read_live_frame(camera_id: int) -> Optional[bytes]:
+    """
+    :return: JPEG of the latest frame of a camera or None if there is no running watcher
+    """
+    return get_redis().hget(LIVE_FRAME_KEY.format(camera_id), 'jpg')
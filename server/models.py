@@ -1,5 +1,6 @@
+from __future__ import annotations
+
 import asyncio
-import base64
 import datetime as dt
 import glob
 import json
@@ -8,24 +9,54 @@ import math
 import os
 from abc import abstractmethod
 from dataclasses import dataclass
-from typing import List, Tuple
-
-import ffmpeg
-import numpy as np
-import requests
-import websockets
-from cv2 import cv2
-from shapely.geometry import Point, Polygon
-from sqlalchemy import orm, Column, Integer, SmallInteger, VARCHAR, ForeignKey, Float, Boolean, String
+from typing import List, Optional, Tuple, TYPE_CHECKING
+
+from sqlalchemy import orm, Column, Integer, SmallInteger, VARCHAR, ForeignKey, Float, Boolean, String, Index
 from sqlalchemy.dialects.mysql import DATETIME, TEXT
+from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship, backref
 
-from server.database import Base, db_session
-from server.instance.config import PROCESSORS_PREVIEW_DIR, FACE_DETECTOR_URL, FACE_WS_ADDRESS, FACE_WS_PORT
+from server.database import Base
+from server.events import event_writer
+from server.faces_protocol import encode_binary
+from server.live import publish_live_value
+from server.lazy import LazyModule
+from server.instance.config import PROCESSORS_PREVIEW_DIR, FACE_DETECTOR_URL, FACE_WS_ADDRESS, FACE_WS_PORT, \
+    FACE_BEST_SHOT_MAX_DELAY, FACE_BEST_SHOT_MAX_GAP, FACE_GOOD_SHOT_CONF, FACE_GOOD_SHOT_MIN_SIZE, FACE_RELAY_MODE, \
+    FACE_REDIS_CHANNEL
+from server.redis_client import get_redis
+from server.telemetry import EVENTS
+
+if TYPE_CHECKING:
+    from shapely.geometry import Point, Polygon
+
+# vision libraries are loaded by the first processed frame, not by API and CLI processes importing models
+cv2 = LazyModule('cv2.cv2')
+np = LazyModule('numpy')
+ffmpeg = LazyModule('ffmpeg')
+requests = LazyModule('requests')
+websockets = LazyModule('websockets')
+geometry = LazyModule('shapely.geometry')
 
 DT_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
 
 
+def parse_ts(value) -> dt.datetime:
+    """
+    Parses API timestamp ("2020-02-23 14:00:00.0", fraction of seconds is optional)
+    :param value: string or datetime
+    :return:
+    """
+    if isinstance(value, dt.datetime):
+        return value
+    for fmt in (DT_FORMAT, '%Y-%m-%d %H:%M:%S'):
+        try:
+            return dt.datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            pass
+    return dt.datetime.fromisoformat(value)
+
+
 @dataclass
 class DetectedObject:
     """
@@ -64,7 +95,7 @@ class DetectedObject:
         if -1 <= x_offset <= 1 and -1 <= y_offset <= 1:
             x = self.x_min + self.w / 2 * (1 + x_offset)
             y = self.y_min + self.h / 2 * (1 + y_offset)
-            return Point(x, y)
+            return geometry.Point(x, y)
         else:
             logging.error('Offsets are out of [-1,1] {} {}'.format(x_offset, y_offset))
             raise ValueError
@@ -90,6 +121,7 @@ class Track:
     def __init__(self, first_obj: DetectedObject, ts: dt.datetime) -> None:
         self._objs = [first_obj]
         self.last_frame_ts = ts
+        self.prev_frame_ts = None
 
     @property
     def objs(self) -> List[DetectedObject]:
@@ -101,16 +133,26 @@ class Track:
 
     def add_obj(self, obj: DetectedObject, ts: dt.datetime):
         self._objs.append(obj)
+        self.prev_frame_ts = self.last_frame_ts
         self.last_frame_ts = ts
 
     def last_obj(self) -> DetectedObject:
         return self._objs[-1]
 
-    def best_prediction(self) -> Point:
+    def best_prediction(self, ts: Optional[dt.datetime] = None, max_ratio: float = 3.0) -> Point:
+        """
+        Predicts position of the object at the next frame
+        :param ts: ts of the next frame to extrapolate by time (frames are not evenly spaced);
+        one frame step is assumed if None
+        :param max_ratio: max ratio of the next step to the previous one
+        """
         if self.length > 1:
-            x = 2 * self._objs[-1].point().x - self._objs[-2].point().x
-            y = 2 * self._objs[-1].point().y - self._objs[-2].point().y
-            prediction = Point(x, y)
+            ratio = 1.0
+            if ts is not None and self.prev_frame_ts is not None and self.last_frame_ts > self.prev_frame_ts:
+                ratio = min(max_ratio, (ts - self.last_frame_ts) / (self.last_frame_ts - self.prev_frame_ts))
+            x = self._objs[-1].point().x + ratio * (self._objs[-1].point().x - self._objs[-2].point().x)
+            y = self._objs[-1].point().y + ratio * (self._objs[-1].point().y - self._objs[-2].point().y)
+            prediction = geometry.Point(x, y)
         else:
             prediction = self.last_obj().point()
         return prediction
@@ -119,15 +161,98 @@ class Track:
         self._objs = self._objs[max_track_size * -1:]
 
 
+class FaceTrack(Track):
+    """
+    Used for face detector only. Besides object history it keeps the best face shot found for this track.
+    """
+
+    def __init__(self, first_obj: DetectedObject, ts: dt.datetime) -> None:
+        super().__init__(first_obj, ts)
+        self.first_frame_ts = ts
+        self.best_face = None  # face description ready to be sent (without image)
+        self.best_face_img = None  # encoded face image
+        self.best_score = (0.0, 0)  # (confidence, face area) of the best face
+        self.emitted = False
+
+    def update_best(self, face: dict, face_img: bytes, ts: dt.datetime) -> bool:
+        """
+        Replaces the best shot if the new face has higher confidence (or larger area with the same confidence)
+        :param face: face description (bbox, conf, shape)
+        :param face_img: encoded face image
+        :param ts: frame timestamp
+        :return: True if the best shot was replaced
+        """
+        score = (round(face['conf'], 2), face['shape'][0] * face['shape'][1])
+        if score > self.best_score:
+            self.best_score = score
+            self.best_face = dict(face, frame_ts=ts)
+            self.best_face_img = face_img
+            return True
+        return False
+
+    def good_enough(self, min_conf: float, min_size: int) -> bool:
+        """
+        Checks if the best shot is good enough to stop face detection for this track
+        """
+        if self.best_face is None:
+            return False
+        return self.best_face['conf'] >= min_conf and min(self.best_face['shape'][:2]) >= min_size
+
+
 class Scene:
     """
-    Used for track counter only. Stores all found Tracks.
+    Used for track counter and face detector. Stores all found Tracks.
     """
     tracks: List[Track]
 
     def __init__(self) -> None:
         self.tracks = []
 
+    def extend_tracks(self, objects: List[DetectedObject], ts: dt.datetime, x_weight=1.0, y_weight=1.0,
+                      max_next_point_dst=0.1, predict_by_time=False,
+                      first_step_dst=None) -> List[DetectedObject]:
+        """
+        Tries to extend each track with the nearest object.
+        :param predict_by_time: extrapolate tracks by time between frames (variable sampling rate)
+        :param first_step_dst: max distance for tracks of one object (they have no speed to predict the next point);
+        max_next_point_dst if None
+        :return: objects that were not appended to any track
+        """
+        new_objects = objects.copy()
+        if not new_objects:
+            return new_objects
+        tracks = self.tracks
+        if first_step_dst is not None:
+            # tracks with predicted points take their objects before tracks searching farther
+            tracks = sorted(tracks, key=lambda t: t.length == 1)
+        for track in tracks:
+            track_obj_point = track.best_prediction(ts if predict_by_time else None)
+            max_dst = first_step_dst if first_step_dst is not None and track.length == 1 else max_next_point_dst
+            new_objects.sort(key=lambda o: distance(o.point(), track_obj_point, x_weight, y_weight))
+            next_obj = new_objects[0]
+            if distance(next_obj.point(), track_obj_point, x_weight, y_weight) < max_dst:
+                track.add_obj(next_obj, ts)
+                new_objects.remove(next_obj)
+                logging.debug('Appended object to track')
+            if not new_objects:
+                break
+        return new_objects
+
+    def drop_stale_tracks(self, ts: dt.datetime, max_frames_gap) -> List[Track]:
+        """
+        Deletes tracks that were not updated for max_frames_gap seconds
+        :return: deleted tracks
+        """
+        alive_tracks = []
+        stale_tracks = []
+        for track in self.tracks:
+            if ts - track.last_frame_ts < dt.timedelta(seconds=max_frames_gap):
+                alive_tracks.append(track)
+            else:
+                stale_tracks.append(track)
+        self.tracks = alive_tracks
+        return stale_tracks
+
 
 class Camera(Base):
     """
@@ -135,7 +260,8 @@ class Camera(Base):
     """
     __tablename__ = 'camera'
     id = Column(Integer, primary_key=True)
-    watch_fps = Column(Integer, default=1)  # #FPS to read from camera
+    watch_fps = Column(Integer, default=1)  # #FPS to read from camera (max FPS of adaptive sampling)
+    watch_fps_min = Column(Float)  # min FPS of adaptive sampling; fixed watch_fps if empty
     watch_rows = Column(Integer, default=1)  # rows to combine frames for detection
     watch_cols = Column(Integer, default=1)  # cols to combine frames for detection
     tz = Column(SmallInteger)  # camera time zone offset (for storage of results)
@@ -149,6 +275,17 @@ class Camera(Base):
         """
         return self.watch_rows, self.watch_cols
 
+    @property
+    def adaptive_fps(self) -> bool:
+        return bool(self.watch_fps_min) and self.watch_fps_min < self.watch_fps
+
+    @property
+    def fps_range(self) -> Tuple[float, float]:
+        """
+        Min and max sampling rates (both are watch_fps if adaptive sampling is off)
+        """
+        return (self.watch_fps_min if self.adaptive_fps else self.watch_fps), self.watch_fps
+
 
 class ProcessorEvent(Base):
     """
@@ -157,6 +294,8 @@ class ProcessorEvent(Base):
     for traffic counter value = number of objects left the zone at this ts
     """
     __tablename__ = 'processor_event'
+    # all metrics are requested for some processor and time range
+    __table_args__ = (Index('ix_processor_event_processor_id_ts', 'processor_id', 'ts'),)
     id = Column(Integer, primary_key=True)
     processor_id = Column(Integer, ForeignKey('processor.id'), nullable=False)  # processor id
     processor = relationship('Processor')
@@ -164,6 +303,35 @@ class ProcessorEvent(Base):
     value = Column(SmallInteger)  # detected value
 
 
+class ProcessorEventRollup:
+    """
+    Aggregates of ProcessorEvents of one processor for a time bucket [bucket, bucket + resolution).
+    Rollups are updated together with writing of events and can be rebuilt from events (see rollups.py).
+    """
+    resolution: dt.timedelta
+
+    @declared_attr
+    def processor_id(cls):
+        return Column(Integer, ForeignKey('processor.id'), primary_key=True)
+
+    bucket = Column(DATETIME, primary_key=True)  # bucket start
+    value_sum = Column(Integer, nullable=False)  # sum of values (traffic)
+    events = Column(Integer, nullable=False)  # number of events
+    min_ts = Column(DATETIME(fsp=6), nullable=False)  # first event ts
+    max_ts = Column(DATETIME(fsp=6), nullable=False)  # last event ts
+    last_value = Column(SmallInteger)  # value of the last event (number of objects)
+
+
+class ProcessorEventMinute(ProcessorEventRollup, Base):
+    __tablename__ = 'processor_event_minute'
+    resolution = dt.timedelta(minutes=1)
+
+
+class ProcessorEventHour(ProcessorEventRollup, Base):
+    __tablename__ = 'processor_event_hour'
+    resolution = dt.timedelta(hours=1)
+
+
 class Processor(Base):
     """
     Base class. Must not be barely initialized. Only used as an abstract class for ORM.
@@ -184,17 +352,60 @@ class Processor(Base):
     }
 
     def __init__(self, **kwargs) -> None:
-        super().__init__(kwargs)
+        super().__init__(**kwargs)
         self.video_builder = None
+        self.event_sink = None
+        self._polygons = None
+        self.preview_enabled = True
+        self.sampling_fps = None
 
     @orm.reconstructor
     def init_on_load(self):
         self.video_builder = None
+        # object with add(processor_id, ts, value) to collect events instead of event_writer (benchmarks, backfill)
+        self.event_sink = None
+        # (zones_str, polygons) made from it
+        self._polygons = None
+        # False to pause output_hls preview (load shedding of a lagging watcher)
+        self.preview_enabled = True
+        # current sampling rate of the watcher (camera watch_fps if None)
+        self.sampling_fps = None
+
+    def take_state(self, other: 'Processor'):
+        """
+        Takes runtime state of the same processor loaded before config reload
+        """
+        self.video_builder = other.video_builder
+
+    def close(self):
+        """
+        Releases runtime state (the processor is disabled or deleted, or the watcher is stopped)
+        """
+        self.stop_video_builder()
+
+    def stop_video_builder(self):
+        if self.video_builder:
+            self.video_builder.stdin.close()
+            self.video_builder.wait()
+            self.video_builder = None
 
     @abstractmethod
     def process(self, frames: List[Frame]):
         pass
 
+    def is_active(self, frames: List[Frame]) -> bool:
+        """
+        Checks if processed frames have activity (objects in zones), cameras are sampled faster then
+        """
+        return any(at_roe(obj, self.polygons) for frame in frames for obj in frame.objects)
+
+    def emit_event(self, ts: dt.datetime, value: int):
+        """
+        Saves ProcessorEvent of this processor. Events are written to the DB in background by event_writer.
+        """
+        (self.event_sink or event_writer).add(self.id, ts, value)
+        EVENTS.inc((str(self.id),))
+
     @property
     def zones(self) -> List[List[List]]:
         # parse zones from config string
@@ -202,8 +413,10 @@ class Processor(Base):
 
     @property
     def polygons(self) -> List[Polygon]:
-        # make polygons from zones
-        return [Polygon(zone) for zone in self.zones]
+        # make polygons from zones, they are cached until zones are changed
+        if self._polygons is None or self._polygons[0] != self.zones_str:
+            self._polygons = (self.zones_str, [geometry.Polygon(zone) for zone in self.zones])
+        return self._polygons[1]
 
     def zones_mask(self, h: int, w: int) -> np.ndarray:
         base = np.zeros((h, w), dtype=np.uint8)
@@ -214,7 +427,7 @@ class Processor(Base):
 
     def update_video_builder(self, h: int, w: int):
         # enable or disable video builder
-        if self.output_hls:
+        if self.output_hls and self.preview_enabled:
 
             if self.video_builder is None:
                 file_mask = 'processed_stream'
@@ -240,10 +453,7 @@ class Processor(Base):
                                       .overwrite_output()
                                       .run_async(pipe_stdin=True))
         else:
-            if self.video_builder:
-                self.video_builder.stdin.close()
-                self.video_builder.wait()
-                self.video_builder = None
+            self.stop_video_builder()
 
     @staticmethod
     def draw_zones(img: np.ndarray, zones_mask: np.ndarray, color: Tuple[int, int, int] = (66, 183, 42)):
@@ -272,10 +482,28 @@ class TrafficCounter(Processor):
         super().init_on_load()
         self.scene = Scene()
 
+    def take_state(self, other: 'TrafficCounter'):
+        super().take_state(other)
+        self.scene = other.scene
+
     __mapper_args__ = {
         'polymorphic_identity': 'traffic',
     }
 
+    def is_active(self, frames: List[Frame]) -> bool:
+        # objects are tracked before they enter zones
+        return bool(self.scene.tracks) or super().is_active(frames)
+
+    def _interval_scale(self, max_scale: float) -> float:
+        """
+        Frames interval relative to the interval of camera watch_fps
+        (1 if frames are sampled at watch_fps, it is lowered by adaptive sampling or load shedding).
+        It is taken from sampling_fps set by the watcher, so gaps of missing segments are not scaled.
+        """
+        if self.camera is None or not self.sampling_fps:
+            return 1.0
+        return min(max_scale, max(1.0, self.camera.watch_fps / self.sampling_fps))
+
     def process(self, frames: List[Frame]):
         """
         Assuming that frames is not empty and sorted by ts.
@@ -303,19 +531,28 @@ class TrafficCounter(Processor):
             finished_tracks = self._analyze_frame(frame)
             if finished_tracks:
                 finished_tracks_counter += len(finished_tracks)
-                e = ProcessorEvent(processor_id=self.id, ts=frame.ts, value=len(finished_tracks))
-                db_session.add(e)
+                self.emit_event(frame.ts, len(finished_tracks))
             if self.video_builder:
                 frame = self._visualize(frame.image, finished_tracks_counter, finished_tracks, zones_mask)
                 self.video_builder.stdin.write(frame.astype(np.uint8).tobytes())
-        db_session.commit()
 
     def _analyze_frame(self, frame: Frame, x_weight=1.0, y_weight=1.0, max_frames_gap=5, max_next_point_dst=0.1,
                        min_track_size=3,
-                       max_track_size=10) -> List[Track]:
+                       max_track_size=10,
+                       max_interval_scale=5.0,
+                       max_first_step_scale=3.0) -> List[Track]:
         """
-        Map objects to tracks and returns finished tracks
+        Map objects to tracks and returns finished tracks.
+        max_next_point_dst and min_track_size are set for frames sampled at camera watch_fps (max_frames_gap is
+        in seconds). At a lower rate (adaptive sampling, load shedding) tracks are extrapolated by time, so the
+        distance to the predicted point stays the same, but tracks of one object are searched farther and
+        objects cross zones in fewer frames.
         """
+        scale = self._interval_scale(max_interval_scale)
+        # tracks are extrapolated by time if frames are not evenly spaced
+        predict_by_time = scale > 1 or self.camera is not None and self.camera.adaptive_fps
+        first_step_dst = max_next_point_dst * min(scale, max_first_step_scale) if scale > 1 else None
+        min_track_size = min(min_track_size, max(2, round(min_track_size / scale)))
         new_objects = frame.objects.copy()
         logging.debug('New objects: {}'.format(len(new_objects)))
         # if no objects were found then just leave this procedure
@@ -323,20 +560,11 @@ class TrafficCounter(Processor):
             return []
 
         # if not try to extend each track at one object; unused objects create new tracks
-        for track in self.scene.tracks:
-            track_obj_point = track.best_prediction()
-            new_objects.sort(key=lambda o: distance(o.point(), track_obj_point, x_weight, y_weight))
-            next_obj = new_objects[0]
-            if distance(next_obj.point(), track_obj_point, x_weight, y_weight) < max_next_point_dst:
-                track.add_obj(next_obj, frame.ts)
-                new_objects.remove(next_obj)
-                logging.debug('Appended object to track')
-            if not new_objects:
-                break
+        new_objects = self.scene.extend_tracks(new_objects, frame.ts, x_weight, y_weight, max_next_point_dst,
+                                               predict_by_time=predict_by_time, first_step_dst=first_step_dst)
 
         # delete old tracks (that were not updated for max_frames_gap seconds)
-        self.scene.tracks = [t for t in self.scene.tracks if
-                             frame.ts - t.last_frame_ts < dt.timedelta(seconds=max_frames_gap)]
+        self.scene.drop_stale_tracks(frame.ts, max_frames_gap)
         logging.debug('Scene tracks (alive): {}'.format(len(self.scene.tracks)))
         # find finished tracks of objects
         finished_tracks = []
@@ -435,19 +663,21 @@ class ObjectsCounter(Processor):
             zones_mask = None
         # first frame always goes to DB
         prev_val = sum([at_roe(obj, self.polygons) for obj in frames[0].objects])
-        e = ProcessorEvent(processor_id=self.id, ts=frames[0].ts, value=prev_val)
-        db_session.add(e)
+        prev_ts = frames[0].ts
+        self.emit_event(prev_ts, prev_val)
         for frame_id, frame in enumerate(frames):
             objs_in_zone = [obj for obj in frame.objects if at_roe(obj, self.polygons)]
             cur_val = len(objs_in_zone)
             if prev_val != cur_val:
-                e = ProcessorEvent(processor_id=self.id, ts=frame.ts, value=cur_val)
-                db_session.add(e)
+                self.emit_event(frame.ts, cur_val)
                 prev_val = cur_val
+                prev_ts = frame.ts
             if self.video_builder:
                 frame_img = self._visualize(frame, objs_in_zone, zones_mask)
                 self.video_builder.stdin.write(frame_img.astype(np.uint8).tobytes())
-        db_session.commit()
+        # the latest event is available for API without the DB
+        if self.event_sink is None:
+            publish_live_value(self.id, prev_val, prev_ts)
 
     def _visualize(self, frame: Frame, objs_in_zone: List[DetectedObject], zones_mask: np.ndarray) -> np.ndarray:
         """
@@ -484,9 +714,12 @@ class FaceDetector(Processor):
     """
     Detects faces of in zone objects. Scans only upper left square of a detected object.
     Sends faces to FACE_WS server.
+    In best shot mode objects are linked to tracks and only the best face of each track is sent:
+    when the track ends or after FACE_BEST_SHOT_MAX_DELAY seconds.
     """
     __tablename__ = 'face_detector'
     id = Column(Integer, ForeignKey('processor.id'), primary_key=True)
+    best_shot = Column(Boolean, default=False)  # true to send only the best face of each track
     __mapper_args__ = {
         'polymorphic_identity': 'face',
     }
@@ -494,11 +727,31 @@ class FaceDetector(Processor):
     def __init__(self, camera_id: int, zones_str: str, threshold: float):
         super().__init__(camera_id=camera_id, zones_str=zones_str, threshold=threshold)
         self.container = 'jpg'
+        self.scene = Scene()  # storage of existing tracks (best shot mode)
 
     @orm.reconstructor
     def init_on_load(self):
         super().init_on_load()
         self.container = 'jpg'
+        self.scene = Scene()
+
+    def take_state(self, other: 'FaceDetector'):
+        super().take_state(other)
+        self.scene = other.scene
+
+    def close(self):
+        """
+        Also sends best shots of open tracks, they would be lost otherwise
+        """
+        super().close()
+        tracks = [t for t in self.scene.tracks if not t.emitted and t.best_face]
+        for track in tracks:
+            track.emitted = True
+        self._send_messages(self._best_shot_messages(tracks))
+
+    def is_active(self, frames: List[Frame]) -> bool:
+        # best shots of tracks are sent after they end
+        return bool(self.scene.tracks) or super().is_active(frames)
 
     def process(self, frames: List[Frame]):
         # todo: scan not only top left square but the whole image anf if no face => several squares
@@ -511,53 +764,124 @@ class FaceDetector(Processor):
             zones_mask = self.zones_mask(h, w)
         else:
             zones_mask = None
-        content_type = 'image/jpeg'
-        headers = {'content-type': content_type}
+        messages = []
         for frame in frames:
-            good_faces = []
-            # scan upper square of each detected object to find a face
-            frame_faces = []
-            for obj in frame.objects:
-                if at_roe(obj, self.polygons):
-                    square_size = int(min(obj.w * w, obj.h * h))
-                    square_y_min = int(obj.y_min * h)
-                    square_y_max = square_y_min + square_size
-                    square_x_min = int(obj.x_min * w)
-                    square_x_max = square_x_min + square_size
-                    upper_square = frame.image[square_y_min: square_y_max, square_x_min: square_x_max, :]
-                    if upper_square.size > 0:
-                        _, buf = cv2.imencode('.jpg', upper_square)
-                        r = requests.post(FACE_DETECTOR_URL, data=buf.tostring(), headers=headers)
-                        faces = json.loads(r.text)
-                        boxes = faces['boxes']
-                        conf = faces['conf']
-                        if boxes:
-                            for box, conf in zip(boxes, conf):
-                                frame_faces.append(DetectedObject(obj.x_min + box[0] / w, obj.y_min + box[1] / h,
-                                                                  obj.x_min + box[2] / w, obj.y_min + box[3] / h,
-                                                                  conf))
-                                if conf >= self.threshold:
-                                    face = upper_square[int(box[1]):int(box[3]), int(box[0]):int(box[2]), :]
-                                    if face.size > 0:
-                                        _, face_buffer = cv2.imencode('.' + self.container, face)
-                                        jpg_as_text = base64.b64encode(face_buffer).decode()
-                                        good_faces.append({'shape': [int(v) for v in face.shape],
-                                                           'bbox': [int(v) for v in box],
-                                                           'conf': float(conf),
-                                                           'img': jpg_as_text})
-            # do not send empty faces
-            if good_faces:
-                data = {'frame_ts': frame.ts.strftime(DT_FORMAT),
-                        'container': self.container,
-                        'camera_id': self.camera_id,
-                        'camera_url': self.camera.stream_url,
-                        'faces': good_faces}
-                asyncio.get_event_loop().run_until_complete(self._send_to_ws(json.dumps(data)))
+            objs_in_zone = [obj for obj in frame.objects if at_roe(obj, self.polygons)]
+            if self.best_shot:
+                frame_faces, tracks_to_send = self._track_faces(frame, objs_in_zone)
+                messages.extend(self._best_shot_messages(tracks_to_send))
+            else:
+                frame_faces, good_faces, good_images = [], [], []
+                for obj in objs_in_zone:
+                    for face_obj, face, face_img in self._detect_faces(frame, obj):
+                        frame_faces.append(face_obj)
+                        if face_img is not None:
+                            good_faces.append(face)
+                            good_images.append(face_img)
+                # do not send empty faces
+                if good_faces:
+                    messages.append(self._faces_message(frame.ts, good_faces, good_images))
 
             if self.video_builder:
                 # draw faces with zones and save to video file
                 frame_img = self._visualize(frame, frame_faces, zones_mask)
                 self.video_builder.stdin.write(frame_img.astype(np.uint8).tobytes())
+        self._send_messages(messages)
+
+    def _send_messages(self, messages: List[bytes]):
+        if messages:
+            if FACE_RELAY_MODE == 'redis':
+                self._publish_to_redis(*messages)
+            else:
+                asyncio.get_event_loop().run_until_complete(self._send_to_ws(*messages))
+
+    def _best_shot_messages(self, tracks: List[FaceTrack]) -> List[bytes]:
+        messages = []
+        for track in tracks:
+            face = dict(track.best_face)
+            messages.append(self._faces_message(face.pop('frame_ts'), [face], [track.best_face_img]))
+        return messages
+
+    def _detect_faces(self, frame: Frame, obj: DetectedObject) -> List[Tuple[DetectedObject, dict, bytes]]:
+        """
+        Scans upper square of an object for faces.
+        :return: list of found faces as (face relative to frame, face description, encoded face image).
+        Encoded image is None for faces with confidence below threshold.
+        """
+        h, w, _ = frame.image.shape
+        square_size = int(min(obj.w * w, obj.h * h))
+        square_y_min = int(obj.y_min * h)
+        square_y_max = square_y_min + square_size
+        square_x_min = int(obj.x_min * w)
+        square_x_max = square_x_min + square_size
+        upper_square = frame.image[square_y_min: square_y_max, square_x_min: square_x_max, :]
+        if upper_square.size == 0:
+            return []
+        _, buf = cv2.imencode('.jpg', upper_square)
+        r = requests.post(FACE_DETECTOR_URL, data=buf.tobytes(), headers={'content-type': 'image/jpeg'})
+        faces = json.loads(r.text)
+        found = []
+        for box, conf in zip(faces['boxes'] or [], faces['conf']):
+            face_obj = DetectedObject(obj.x_min + box[0] / w, obj.y_min + box[1] / h,
+                                      obj.x_min + box[2] / w, obj.y_min + box[3] / h,
+                                      conf)
+            face_img = None
+            face = upper_square[int(box[1]):int(box[3]), int(box[0]):int(box[2]), :]
+            description = {'shape': [int(v) for v in face.shape],
+                           'bbox': [int(v) for v in box],
+                           'conf': float(conf)}
+            if conf >= self.threshold and face.size > 0:
+                _, face_buffer = cv2.imencode('.' + self.container, face)
+                face_img = face_buffer.tobytes()
+            found.append((face_obj, description, face_img))
+        return found
+
+    def _track_faces(self, frame: Frame, objs_in_zone: List[DetectedObject],
+                     max_track_size=10) -> Tuple[List[DetectedObject], List[FaceTrack]]:
+        """
+        Best shot mode. Links in zone objects to tracks and updates the best face of each updated track.
+        Face detection is skipped for tracks which already have a good enough shot.
+        :return: faces found at this frame and tracks whose best face must be sent now
+        """
+        unused_objs = self.scene.extend_tracks(objs_in_zone, frame.ts)
+        # only the last points are needed for predictions (a person can stand in view for hours)
+        for track in self.scene.tracks:
+            track.drop_old_objs(max_track_size)
+        finished_tracks = self.scene.drop_stale_tracks(frame.ts, FACE_BEST_SHOT_MAX_GAP)
+        for obj in unused_objs:
+            self.scene.tracks.append(FaceTrack(obj, frame.ts))
+
+        frame_faces = []
+        for track in self.scene.tracks:
+            if track.last_frame_ts != frame.ts or track.emitted:
+                continue
+            if track.good_enough(FACE_GOOD_SHOT_CONF, FACE_GOOD_SHOT_MIN_SIZE):
+                continue
+            for face_obj, face, face_img in self._detect_faces(frame, track.last_obj()):
+                frame_faces.append(face_obj)
+                if face_img is not None:
+                    track.update_best(face, face_img, frame.ts)
+
+        tracks_to_send = [t for t in finished_tracks if not t.emitted and t.best_face]
+        for track in self.scene.tracks:
+            if (not track.emitted and track.best_face and
+                    frame.ts - track.first_frame_ts >= dt.timedelta(seconds=FACE_BEST_SHOT_MAX_DELAY)):
+                tracks_to_send.append(track)
+        for track in tracks_to_send:
+            track.emitted = True
+        logging.debug('Face tracks: {}, faces to send: {}'.format(len(self.scene.tracks), len(tracks_to_send)))
+        return frame_faces, tracks_to_send
+
+    def _faces_message(self, frame_ts: dt.datetime, faces: List[dict], images: List[bytes]) -> bytes:
+        """
+        Packs faces to a binary message (see faces_protocol)
+        """
+        data = {'frame_ts': frame_ts.strftime(DT_FORMAT),
+                'container': self.container,
+                'camera_id': self.camera_id,
+                'camera_url': self.camera.stream_url,
+                'faces': faces}
+        return encode_binary(data, images)
 
     def _visualize(self, frame: Frame, faces: List[DetectedObject], zones_mask: np.ndarray) -> np.ndarray:
         """
@@ -590,7 +914,18 @@ class FaceDetector(Processor):
         return img
 
     @staticmethod
-    async def _send_to_ws(data: str):
+    def _publish_to_redis(*messages: bytes):
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for data in messages:
+                pipe.publish(FACE_REDIS_CHANNEL, data)
+            pipe.execute()
+        except Exception as e:
+            logging.error('Failed to publish faces to Redis from detector')
+            logging.error(str(e))
+
+    @staticmethod
+    async def _send_to_ws(*messages: bytes):
         address = FACE_WS_ADDRESS
         if address == '0.0.0.0':
             address = 'localhost'
@@ -600,7 +935,8 @@ class FaceDetector(Processor):
             async with websockets.connect(uri) as websocket:
                 await websocket.send('detector')
                 if await websocket.recv() == 'OK':
-                    await websocket.send(data)
+                    for data in messages:
+                        await websocket.send(data)
                 else:
                     logging.error('WS server did not allow to send message')
                 await websocket.close()
@@ -0,0 +1,280 @@
+"""
+Load-aware placement of camera watchers on Celery workers.
+
+Cost of a camera is its measured load: seconds of watcher work (download, decoding, detector, processors, preview)
+per second of video, reported by heartbeats and kept in Redis (smoothed) so it is known before watchers start.
+Capacity of a worker is the number of its CPUs (registered by the worker on start).
+Watchers are started on chosen workers through their direct queues (worker_direct).
+Started watchers are recorded in Redis, so they are not started again by anyone while their tasks are queued.
+
+The supervisor restarts crashed watchers and moves single cameras from the most to the least loaded worker
+(a watcher is stopped gracefully first, so two watchers never process one camera).
+"""
+import json
+import logging
+import time
+from typing import Collection, Dict, List, Optional, Tuple
+
+from celery.utils import worker_direct
+
+from server.celery_app import WATCH_CAMERA_TASK
+from server.heartbeat import read_heartbeats
+from server.instance.config import SUPERVISOR_DEFAULT_COST, SUPERVISOR_COST_SMOOTHING
+from server.redis_client import get_redis, WATCHER_COST_KEY, WATCHER_COST_SEGMENT_KEY, WATCHER_START_KEY, \
+    WORKERS_KEY
+
+
+def register_worker(hostname: str, capacity: float):
+    """
+    Saves capacity of a started Celery worker
+    """
+    get_redis().hset(WORKERS_KEY, hostname, json.dumps({'capacity': capacity, 'ts': time.time()}))
+
+
+def get_workers(celery, timeout: float = 2) -> Dict[str, float]:
+    """
+    Returns capacities of alive workers (1 if a worker did not register its capacity)
+    :return: worker hostname -> capacity
+    """
+    replies = celery.control.inspect(timeout=timeout).ping() or {}
+    registered = get_redis().hgetall(WORKERS_KEY)
+    capacities = {}
+    for hostname in replies:
+        info = registered.get(hostname.encode())
+        capacities[hostname] = json.loads(info)['capacity'] if info else 1
+    return capacities
+
+
+def read_costs(camera_ids: List[int]) -> Dict[int, float]:
+    """
+    Returns measured costs of cameras (SUPERVISOR_DEFAULT_COST for cameras never watched)
+    """
+    if not camera_ids:
+        return {}
+    values = get_redis().hmget(WATCHER_COST_KEY, [str(camera_id) for camera_id in camera_ids])
+    return {camera_id: float(value) if value is not None else SUPERVISOR_DEFAULT_COST
+            for camera_id, value in zip(camera_ids, values)}
+
+
+def update_costs(heartbeats: Dict[int, dict]) -> Dict[int, float]:
+    """
+    Adds loads reported by heartbeats to smoothed costs of cameras.
+    Heartbeats repeat the load of the last processed segment, so each segment is added once.
+    :return: updated costs
+    """
+    segments = {camera_id: hb.get('segment_ts') for camera_id, hb in heartbeats.items() if hb.get('load') is not None}
+    if not segments:
+        return {}
+    r = get_redis()
+    added = r.hmget(WATCHER_COST_SEGMENT_KEY, [str(camera_id) for camera_id in segments])
+    loads = {camera_id: heartbeats[camera_id]['load'] for (camera_id, segment_ts), added_ts
+             in zip(segments.items(), added) if added_ts is None or added_ts.decode() != segment_ts}
+    if not loads:
+        return {}
+    costs = read_costs(list(loads))
+    updated = {camera_id: costs[camera_id] + SUPERVISOR_COST_SMOOTHING * (load - costs[camera_id])
+               for camera_id, load in loads.items()}
+    r.hset(WATCHER_COST_KEY, mapping={str(camera_id): cost for camera_id, cost in updated.items()})
+    r.hset(WATCHER_COST_SEGMENT_KEY, mapping={str(camera_id): str(segments[camera_id]) for camera_id in loads})
+    return updated
+
+
+def worker_loads(assignment: Dict[int, str], costs: Dict[int, float], capacities: Dict[str, float]) -> Dict[str, float]:
+    """
+    :return: worker -> sum of costs of its cameras divided by its capacity
+    """
+    loads = {worker: 0.0 for worker in capacities}
+    for camera_id, worker in assignment.items():
+        if worker in loads:
+            loads[worker] += costs[camera_id] / capacities[worker]
+    return loads
+
+
+def place(camera_ids: List[int], costs: Dict[int, float], capacities: Dict[str, float],
+          assignment: Optional[Dict[int, str]] = None) -> Dict[int, str]:
+    """
+    Greedy placement (the longest processing time first): cameras in descending order of costs are placed
+    on workers which are the least loaded after placing
+    :param camera_ids: cameras to place
+    :param costs: costs of all cameras
+    :param capacities: capacities of workers
+    :param assignment: already placed cameras (they are not moved)
+    :return: camera id -> worker of placed cameras
+    """
+    loads = worker_loads(assignment or {}, costs, capacities)
+    placed = {}
+    for camera_id in sorted(camera_ids, key=lambda c: -costs[c]):
+        worker = min(loads, key=lambda w: loads[w] + costs[camera_id] / capacities[w])
+        loads[worker] += costs[camera_id] / capacities[worker]
+        placed[camera_id] = worker
+    return placed
+
+
+def plan_moves(assignment: Dict[int, str], costs: Dict[int, float], capacities: Dict[str, float],
+               threshold: float, max_moves: int, fixed: Collection[int] = ()) -> List[Tuple[int, str, str]]:
+    """
+    Plans moves of single cameras from the most loaded worker to the least loaded one while their loads differ
+    by more than threshold and a move decreases the max of their loads
+    :param fixed: cameras which can not be moved (their costs are counted)
+    :return: [(camera id, from worker, to worker)]
+    """
+    assignment = dict(assignment)
+    moves = []
+    for _ in range(max_moves):
+        loads = worker_loads(assignment, costs, capacities)
+        if len(loads) < 2:
+            break
+        busiest = max(loads, key=loads.get)
+        idlest = min(loads, key=loads.get)
+        if loads[busiest] - loads[idlest] <= threshold:
+            break
+        best, best_peak = None, loads[busiest]
+        for camera_id in (c for c, w in assignment.items() if w == busiest and c not in fixed):
+            peak = max(loads[busiest] - costs[camera_id] / capacities[busiest],
+                       loads[idlest] + costs[camera_id] / capacities[idlest])
+            if peak < best_peak:
+                best, best_peak = camera_id, peak
+        if best is None:
+            break
+        assignment[best] = idlest
+        moves.append((best, busiest, idlest))
+    return moves
+
+
+def start_watcher(celery, camera_id: int, worker: Optional[str] = None) -> str:
+    """
+    Starts watcher of a camera on a worker (on any worker if None) and records the start (see read_starts)
+    :return: task id
+    """
+    options = {'queue': worker_direct(worker)} if worker else {}
+    result = celery.send_task(WATCH_CAMERA_TASK, kwargs={'camera_id': camera_id}, **options)
+    get_redis().hset(WATCHER_START_KEY, str(camera_id),
+                     json.dumps({'task_id': result.id, 'worker': worker, 'ts': time.time()}))
+    logging.info('Watcher of camera {} is started on {}'.format(camera_id, worker or 'any worker'))
+    return result.id
+
+
+def read_starts(camera_ids: List[int]) -> Dict[int, dict]:
+    """
+    Returns the last started watchers of cameras which are not confirmed by heartbeats yet
+    :return: camera id -> {'task_id', 'worker', 'ts'}
+    """
+    if not camera_ids:
+        return {}
+    values = get_redis().hmget(WATCHER_START_KEY, [str(camera_id) for camera_id in camera_ids])
+    return {camera_id: json.loads(value) for camera_id, value in zip(camera_ids, values) if value is not None}
+
+
+def forget_starts(camera_ids: Collection[int]):
+    """
+    Removes start records of watchers which are running or failed to start
+    """
+    if camera_ids:
+        get_redis().hdel(WATCHER_START_KEY, *[str(camera_id) for camera_id in camera_ids])
+
+
+def stop_watcher(celery, heartbeat: dict, force: bool = False):
+    """
+    Stops watcher: SIGTERM lets it write buffered events, SIGKILL is for hung watchers
+    """
+    celery.control.revoke(heartbeat['task_id'], terminate=True, signal='SIGKILL' if force else 'SIGTERM')
+    logging.info('Watcher of camera {} on {} is {}'.format(heartbeat['camera_id'], heartbeat.get('worker'),
+                                                           'killed' if force else 'stopped'))
+
+
+class Supervisor:
+    """
+    Keeps one watcher per camera running and workers evenly loaded
+    """
+
+    def __init__(self, celery, start_grace: float, stop_timeout: float, threshold: float, max_moves: int):
+        """
+        :param start_grace: seconds a started watcher (its queued task) has to write its first heartbeat
+        :param stop_timeout: seconds a stopped watcher has to exit before it is killed
+        :param threshold: difference of worker loads to rebalance them
+        :param max_moves: max number of cameras moved at once
+        """
+        self.celery = celery
+        self.start_grace = start_grace
+        self.stop_timeout = stop_timeout
+        self.threshold = threshold
+        self.max_moves = max_moves
+        # camera id -> (task id, time of start, worker) of started watchers without heartbeats yet;
+        # it is read from Redis each cycle, so watchers started by others (restart_watchers.py) are seen too
+        self.starting: Dict[int, Tuple[str, float, Optional[str]]] = {}
+        # camera id -> (task id of the stopped watcher, target worker, deadline to kill it)
+        self.moving: Dict[int, Tuple[str, str, float]] = {}
+
+    def _start(self, camera_id: int, worker: Optional[str]):
+        self.starting[camera_id] = (start_watcher(self.celery, camera_id, worker), time.time(), worker)
+
+    def _read_starting(self, camera_ids: List[int], heartbeats: Dict[int, dict]):
+        """
+        Updates started watchers: confirmed by heartbeats and expired starts are forgotten
+        """
+        self.starting = {}
+        done = []
+        for camera_id, start in read_starts(camera_ids).items():
+            heartbeat = heartbeats.get(camera_id)
+            if heartbeat is not None and heartbeat['task_id'] == start['task_id']:
+                done.append(camera_id)
+            elif time.time() - start['ts'] > self.start_grace:
+                # the watcher did not start (or crashed at once); it is started again if there is no other watcher
+                logging.warning('Watcher of camera {} did not start in {} seconds'.format(camera_id,
+                                                                                         self.start_grace))
+                done.append(camera_id)
+            else:
+                self.starting[camera_id] = (start['task_id'], start['ts'], start['worker'])
+        forget_starts(done)
+
+    def step(self, camera_ids: List[int]):
+        """
+        One supervision cycle
+        :param camera_ids: cameras which must be watched
+        """
+        now = time.monotonic()
+        heartbeats = read_heartbeats(camera_ids)
+        capacities = get_workers(self.celery)
+        if not capacities:
+            logging.warning('No alive workers found')
+            return
+        update_costs(heartbeats)
+        costs = read_costs(camera_ids)
+        self._read_starting(camera_ids, heartbeats)
+
+        # moved watchers are started on target workers after the previous ones exit
+        for camera_id, (task_id, worker, deadline) in list(self.moving.items()):
+            heartbeat = heartbeats.get(camera_id)
+            if heartbeat is not None and heartbeat['task_id'] == task_id:
+                if now < deadline:
+                    continue
+                stop_watcher(self.celery, heartbeat, force=True)
+            del self.moving[camera_id]
+            if heartbeat is not None and heartbeat['task_id'] != task_id:
+                # another watcher of the camera is already running
+                continue
+            self._start(camera_id, worker if worker in capacities else None)
+
+        # current placement: running watchers on alive workers, started and moved ones on their target workers
+        assignment = {camera_id: hb.get('worker') for camera_id, hb in heartbeats.items()
+                      if hb.get('worker') in capacities}
+        assignment.update({camera_id: worker for camera_id, (_, _, worker) in self.starting.items()})
+        assignment.update({camera_id: worker for camera_id, (_, worker, _) in self.moving.items()})
+        assignment = {camera_id: worker for camera_id, worker in assignment.items() if worker in capacities}
+        # watchers of dead workers have no heartbeats as crashed ones
+        crashed = [camera_id for camera_id in camera_ids if camera_id not in heartbeats
+                   and camera_id not in self.moving and camera_id not in self.starting]
+        if crashed:
+            logging.warning('Watchers of cameras {} are not running'.format(crashed))
+        for camera_id, worker in place(crashed, costs, capacities, assignment).items():
+            self._start(camera_id, worker)
+            assignment[camera_id] = worker
+
+        # cameras which are being started or moved are not moved again
+        fixed = set(self.starting) | set(self.moving)
+        for camera_id, source, target in plan_moves(assignment, costs, capacities, self.threshold, self.max_moves,
+                                                    fixed):
+            logging.info('Camera {} (cost {:.2f}) is moved from {} to {}'.format(camera_id, costs[camera_id],
+                                                                                 source, target))
+            stop_watcher(self.celery, heartbeats[camera_id])
+            self.moving[camera_id] = (heartbeats[camera_id]['task_id'], target, now + self.stop_timeout)
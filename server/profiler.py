@@ -0,0 +1,124 @@
+"""
+On-demand sampling profiler of live watchers.
+
+A background thread samples the stack of the watcher (main) thread every interval seconds of wall time,
+so waiting for downloads and the detector is visible as well as CPU work.
+Stacks are written in collapsed format (`frame;frame;frame count`) to be rendered by flamegraph.pl or speedscope.
+
+Profiling is requested by SIGUSR2 sent to the watcher process or by `flask profile-watcher` (Redis control key).
+"""
+import datetime as dt
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from server.redis_client import get_redis, PROFILE_REQUEST_KEY
+
+_signal_requested = False
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class SamplingProfiler:
+    """
+    Samples stacks of one thread in a daemon thread, only one profiling at a time
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, path: str, thread_id: Optional[int] = None) -> bool:
+        """
+        Starts profiling of the thread (the calling one by default) for some seconds
+        :param seconds: profiling duration
+        :param path: collapsed stacks file
+        :param thread_id: thread to profile
+        :return: False if profiling is already running
+        """
+        if self.running:
+            return False
+        thread_id = thread_id or threading.get_ident()
+        self._thread = threading.Thread(target=self._run, args=(thread_id, seconds, path), name='profiler',
+                                        daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self, thread_id: int, seconds: float, path: str):
+        logging.info('Profiling for {} seconds to {}'.format(seconds, path))
+        stacks = Counter()
+        stop = time.monotonic() + seconds
+        while time.monotonic() < stop:
+            # noinspection PyProtectedMember
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stacks[_collapse(frame)] += 1
+            del frame
+            time.sleep(self.interval)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        logging.info('Profile is written: {} samples to {}'.format(sum(stacks.values()), path))
+
+
+def profile_path(profiles_dir: str, camera_id: int) -> str:
+    return os.path.join(profiles_dir, 'profile_cam{}_{:%Y%m%d_%H%M%S}.collapsed'.format(camera_id, dt.datetime.now()))
+
+
+def _on_signal(signum, frame):
+    global _signal_requested
+    _signal_requested = True
+
+
+def install_signal_handler():
+    """
+    SIGUSR2 requests profiling of the process for the default duration
+    """
+    signal.signal(signal.SIGUSR2, _on_signal)
+
+
+def request_profile(camera_id: int, seconds: float, ttl: int = 600):
+    """
+    Asks the watcher of the camera to profile itself. The request is dropped if the watcher does not take it in ttl.
+    """
+    get_redis().set(PROFILE_REQUEST_KEY.format(camera_id), seconds, ex=ttl)
+
+
+def check_profile_request(camera_id: int, default_seconds: float) -> Optional[float]:
+    """
+    Takes profiling request of the watcher (by signal or Redis)
+    :return: profiling duration if it is requested else None
+    """
+    global _signal_requested
+    if _signal_requested:
+        _signal_requested = False
+        return default_seconds
+    try:
+        pipe = get_redis().pipeline()
+        key = PROFILE_REQUEST_KEY.format(camera_id)
+        pipe.get(key)
+        pipe.delete(key)
+        seconds, _ = pipe.execute()
+    except Exception as e:
+        logging.error('Failed to check profiling request')
+        logging.error(str(e))
+        return None
+    return float(seconds) if seconds is not None else None
@@ -0,0 +1,32 @@
+import os
+
+import redis
+
+from server.instance.config import REDIS_URL
+
+# keys
+FACE_RELAY_METRICS_KEY = 'hypersight:face_relay:{}'  # metrics of a faces relay instance
+LIVE_VALUE_KEY = 'hypersight:live:{}'  # the latest value of an objects counter
+LIVE_FRAME_KEY = 'hypersight:frame:{}'  # the latest frame of a camera (JPEG) for zones editor
+HEARTBEAT_KEY = 'hypersight:heartbeat:{}'  # state of a camera watcher
+METRICS_KEY = 'hypersight:metrics:{}'  # metrics snapshot of a camera watcher
+PROFILE_REQUEST_KEY = 'hypersight:profile:{}'  # profiling duration requested for a camera watcher
+GENERATION_KEY = 'hypersight:generation:{}'  # version of processor events; changed by backfill and recalculation
+WATCHER_COST_KEY = 'hypersight:cost'  # hash: camera id -> smoothed load of its watcher (for placement)
+WATCHER_COST_SEGMENT_KEY = 'hypersight:cost_segment'  # hash: camera id -> segment ts of the last load added to cost
+WATCHER_START_KEY = 'hypersight:start'  # hash: camera id -> task id, worker and time of the last started watcher
+WORKERS_KEY = 'hypersight:workers'  # hash: Celery worker hostname -> its capacity
+
+_client = None
+
+
+def get_redis() -> redis.Redis:
+    """
+    Returns Redis client shared by the process (connections are created on demand).
+    Redis is used for Celery so it is always available in the stack.
+    :return:
+    """
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(os.getenv('REDIS_URL') or REDIS_URL)
+    return _client
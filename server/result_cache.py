@@ -0,0 +1,95 @@
+"""
+Cache of API results for closed time windows.
+Results are cached per API process with LRU eviction. Each entry is tagged with processor generations
+stored in Redis: backfill or recalculation of events bumps generations, so stale entries are never returned.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from server.redis_client import get_redis, GENERATION_KEY
+
+ALL_PROCESSORS = 'all'  # generation which invalidates results of all processors
+
+
+class ResultCache:
+    """
+    Thread safe LRU cache with hit/miss counters
+    """
+    MISSING = object()
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        """
+        :return: cached value or ResultCache.MISSING
+        """
+        with self._lock:
+            value = self._items.get(key, self.MISSING)
+            if value is self.MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {'size': len(self._items),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_ratio': self.hits / requests if requests else None}
+
+
+def get_generations(proc_ids: List[int]) -> Optional[Dict[int, Tuple[int, int]]]:
+    """
+    Returns generations of processors results
+    :return: processor id -> (global generation, processor generation) or None if Redis is unavailable
+    """
+    keys = [GENERATION_KEY.format(ALL_PROCESSORS)] + [GENERATION_KEY.format(proc_id) for proc_id in proc_ids]
+    try:
+        values = [int(value or 0) for value in get_redis().mget(keys)]
+    except Exception as e:
+        logging.error('Failed to read results generations')
+        logging.error(str(e))
+        return None
+    return {proc_id: (values[0], value) for proc_id, value in zip(proc_ids, values[1:])}
+
+
+def bump_generations(proc_ids: Optional[List[int]] = None):
+    """
+    Invalidates cached results of processors after their events are changed
+    :param proc_ids: processors ids; None to invalidate results of all processors
+    """
+    keys = [GENERATION_KEY.format(proc_id) for proc_id in proc_ids] if proc_ids \
+        else [GENERATION_KEY.format(ALL_PROCESSORS)]
+    try:
+        pipe = get_redis().pipeline()
+        for key in keys:
+            pipe.incr(key)
+        pipe.execute()
+    except Exception as e:
+        logging.error('Failed to invalidate cached results of processors {}'.format(proc_ids or ALL_PROCESSORS))
+        logging.error(str(e))
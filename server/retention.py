@@ -0,0 +1,180 @@
+"""
+Retention of raw ProcessorEvents.
+
+Raw events older than a configured age are deleted while their per-minute and per-hour rollups are kept,
+so metrics for old periods are still available with minute precision (or hour precision after minute rollups
+are deleted too). Ranges of old periods must be aligned to the kept precision, see rollups.split_range.
+For MySQL processor_event table can be partitioned by month: old months are dropped instantly as partitions.
+"""
+import datetime as dt
+import logging
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, text, func
+
+from server.database import engine
+from server.models import ProcessorEvent, ProcessorEventMinute, ProcessorEventHour
+from server.rollups import floor_ts, rebuild_rollups
+
+PARTITION_NAME = 'p{:%Y%m}'
+
+
+def _month_start(ts: dt.datetime) -> dt.datetime:
+    return dt.datetime(ts.year, ts.month, 1)
+
+
+def _next_month(ts: dt.datetime) -> dt.datetime:
+    return dt.datetime(ts.year + ts.month // 12, ts.month % 12 + 1, 1)
+
+
+def _partition_sql(month: dt.datetime) -> str:
+    return "PARTITION {} VALUES LESS THAN (TO_DAYS('{:%Y-%m-%d}'))".format(PARTITION_NAME.format(month),
+                                                                          _next_month(month))
+
+
+def _partitions(conn) -> List[tuple]:
+    """
+    :return: [(name, TO_DAYS upper bound or None for MAXVALUE)] of processor_event partitions
+    """
+    rows = conn.execute(text("SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+                             "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'processor_event' "
+                             "AND PARTITION_NAME IS NOT NULL ORDER BY PARTITION_ORDINAL_POSITION")).fetchall()
+    return [(name, None if desc == 'MAXVALUE' else int(desc)) for name, desc in rows]
+
+
+def partition_events(months_ahead: int = 3):
+    """
+    Partitions processor_event by month (MySQL only).
+    MySQL does not allow foreign keys for partitioned tables and requires ts in the primary key,
+    so the foreign key to processor is dropped and the primary key becomes (id, ts).
+    Run it once; then add_partitions is called by compact_events.
+    :param months_ahead: number of future months to create partitions for
+    """
+    with engine.connect() as conn:
+        if conn.dialect.name != 'mysql':
+            logging.warning('Partitioning is supported for MySQL only')
+            return
+        if _partitions(conn):
+            logging.info('processor_event is already partitioned')
+            add_partitions(months_ahead)
+            return
+        foreign_keys = conn.execute(text("SELECT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE "
+                                         "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'processor_event' "
+                                         "AND REFERENCED_TABLE_NAME IS NOT NULL")).fetchall()
+        for fk, in foreign_keys:
+            conn.execute(text('ALTER TABLE processor_event DROP FOREIGN KEY {}'.format(fk)))
+        first_ts = conn.execute(select([func.min(ProcessorEvent.ts)])).scalar() or dt.datetime.now()
+        month = _month_start(first_ts)
+        last_month = _month_start(dt.datetime.now())
+        for _ in range(months_ahead):
+            last_month = _next_month(last_month)
+        partitions = []
+        while month <= last_month:
+            partitions.append(_partition_sql(month))
+            month = _next_month(month)
+        partitions.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+        logging.info('Partitioning processor_event to {} partitions'.format(len(partitions)))
+        conn.execute(text('ALTER TABLE processor_event DROP PRIMARY KEY, ADD PRIMARY KEY (id, ts)'))
+        conn.execute(text('ALTER TABLE processor_event PARTITION BY RANGE (TO_DAYS(ts)) ({})'.format(
+            ', '.join(partitions))))
+
+
+def add_partitions(months_ahead: int = 3):
+    """
+    Splits pmax partition to month partitions up to months_ahead from now
+    """
+    with engine.connect() as conn:
+        if conn.dialect.name != 'mysql':
+            return
+        partitions = _partitions(conn)
+        if not partitions:
+            return
+        names = {name for name, _ in partitions}
+        month = _month_start(dt.datetime.now())
+        new_partitions = []
+        for _ in range(months_ahead + 1):
+            if PARTITION_NAME.format(month) not in names:
+                new_partitions.append(_partition_sql(month))
+            month = _next_month(month)
+        if new_partitions:
+            logging.info('Adding {} partitions to processor_event'.format(len(new_partitions)))
+            conn.execute(text('ALTER TABLE processor_event REORGANIZE PARTITION pmax INTO ({}, '
+                              'PARTITION pmax VALUES LESS THAN MAXVALUE)'.format(', '.join(new_partitions))))
+
+
+def drop_partitions(cutoff: dt.datetime) -> int:
+    """
+    Drops partitions with events older than cutoff only
+    :return: number of dropped partitions
+    """
+    with engine.connect() as conn:
+        if conn.dialect.name != 'mysql':
+            return 0
+        cutoff_days = conn.execute(select([func.TO_DAYS(cutoff)])).scalar()
+        old = [name for name, bound in _partitions(conn) if bound is not None and bound <= cutoff_days]
+        if old:
+            logging.info('Dropping partitions {}'.format(old))
+            conn.execute(text('ALTER TABLE processor_event DROP PARTITION {}'.format(', '.join(old))))
+        return len(old)
+
+
+def delete_events(cutoff: dt.datetime, batch_size: int = 10000) -> int:
+    """
+    Deletes events older than cutoff by small batches to avoid long locks
+    :return: number of deleted events
+    """
+    pe = ProcessorEvent.__table__
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(select([pe.c.id]).where(pe.c.ts < cutoff).limit(batch_size))]
+            if not ids:
+                break
+            conn.execute(pe.delete().where(pe.c.id.in_(ids)))
+        deleted += len(ids)
+    return deleted
+
+
+def retention_limits(retention_days: Optional[int], minute_rollups_retention_days: Optional[int] = None,
+                     now: Optional[dt.datetime] = None) -> Tuple[Optional[dt.datetime], Optional[dt.datetime]]:
+    """
+    Hour aligned cutoffs of compact_events. Limits for now are not earlier than those of any previous run.
+    :return: (raw events are deleted before, minute rollups are deleted before); None if they are kept
+    """
+    now = now or dt.datetime.now()
+    hour = ProcessorEventHour.resolution
+    raw_since = None if retention_days is None else floor_ts(now - dt.timedelta(days=retention_days), hour)
+    minutes_since = None
+    if minute_rollups_retention_days is not None:
+        minutes_since = floor_ts(now - dt.timedelta(days=minute_rollups_retention_days), hour)
+    return raw_since, minutes_since
+
+
+def compact_events(retention_days: int, minute_rollups_retention_days: Optional[int] = None,
+                   months_ahead: int = 3) -> int:
+    """
+    Retention job. Rebuilds rollups for events to be deleted (so aggregates are complete)
+    and deletes raw events older than retention_days.
+    :param retention_days: raw events age to keep
+    :param minute_rollups_retention_days: minute rollups age to keep (hour rollups are kept forever); None to keep all
+    :param months_ahead: number of future month partitions to prepare (for partitioned table)
+    :return: number of deleted events
+    """
+    cutoff, minute_cutoff = retention_limits(retention_days, minute_rollups_retention_days)
+    with engine.connect() as conn:
+        first_ts = conn.execute(select([func.min(ProcessorEvent.ts)])).scalar()
+    if first_ts is None or first_ts >= cutoff:
+        logging.info('No events older than {}'.format(cutoff))
+        add_partitions(months_ahead)
+        return 0
+    logging.info('Compacting events from {} to {}'.format(first_ts, cutoff))
+    rebuild_rollups(start=first_ts, stop=cutoff - dt.timedelta(microseconds=1))
+    drop_partitions(cutoff)
+    deleted = delete_events(cutoff)
+    if minute_cutoff is not None:
+        table = ProcessorEventMinute.__table__
+        with engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.bucket < minute_cutoff))
+    add_partitions(months_ahead)
+    logging.info('Deleted {} events older than {}'.format(deleted, cutoff))
+    return deleted
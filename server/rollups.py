@@ -0,0 +1,444 @@
+"""
+Per-minute and per-hour rollups of ProcessorEvents.
+
+Rollups are updated by event_writer in the same transaction as events are inserted.
+Range queries take whole buckets from rollups and only ragged edges of a range from raw events,
+so results are exactly the same as aggregates over raw events.
+When raw events (or minute rollups) are deleted by retention, old ranges must be aligned to minutes (or hours),
+they are taken from whole buckets; other ranges are rejected with PrecisionError.
+"""
+import datetime as dt
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, or_, func, select, cast, literal_column, Integer
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from server.database import engine
+from server.models import ProcessorEvent, ProcessorEventMinute, ProcessorEventHour
+
+ROLLUPS = (ProcessorEventMinute, ProcessorEventHour)
+EPOCH = dt.datetime(1970, 1, 1)
+
+# time range: its borders inclusion depends on usage
+TsRange = Tuple[dt.datetime, dt.datetime]
+
+
+class PrecisionError(ValueError):
+    """
+    Range is more precise than events kept by retention
+    """
+
+
+def floor_ts(ts: dt.datetime, resolution: dt.timedelta) -> dt.datetime:
+    """
+    Returns start of a bucket containing ts. Buckets are aligned to epoch
+    """
+    delta = ts - EPOCH
+    us = (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+    step = (resolution.days * 86400 + resolution.seconds) * 10 ** 6 + resolution.microseconds
+    return EPOCH + dt.timedelta(microseconds=us - us % step)
+
+
+def ceil_ts(ts: dt.datetime, resolution: dt.timedelta) -> dt.datetime:
+    floored = floor_ts(ts, resolution)
+    return floored if floored == ts else floored + resolution
+
+
+def aggregate(rows: Iterable[dict], resolution: dt.timedelta) -> List[dict]:
+    """
+    Aggregates event rows (processor_id, ts, value) to rollup rows of given resolution
+    """
+    partials = {}
+    for row in rows:
+        key = (row['processor_id'], floor_ts(row['ts'], resolution))
+        partial = partials.get(key)
+        if partial is None:
+            partials[key] = {'processor_id': key[0], 'bucket': key[1], 'value_sum': row['value'] or 0, 'events': 1,
+                             'min_ts': row['ts'], 'max_ts': row['ts'], 'last_value': row['value']}
+        else:
+            partial['value_sum'] += row['value'] or 0
+            partial['events'] += 1
+            partial['min_ts'] = min(partial['min_ts'], row['ts'])
+            if row['ts'] >= partial['max_ts']:
+                partial['max_ts'] = row['ts']
+                partial['last_value'] = row['value']
+    return list(partials.values())
+
+
+def _upsert(conn, rollup, partials: List[dict]):
+    """
+    Adds partial aggregates to existing rollup rows
+    """
+    table = rollup.__table__
+    if conn.dialect.name == 'mysql':
+        stmt = mysql_insert(table)
+        # mysql applies assignments from left to right so last_value must be updated before max_ts
+        stmt = stmt.on_duplicate_key_update([
+            ('last_value', func.IF(stmt.inserted.max_ts >= table.c.max_ts, stmt.inserted.last_value,
+                                   table.c.last_value)),
+            ('value_sum', table.c.value_sum + stmt.inserted.value_sum),
+            ('events', table.c.events + stmt.inserted.events),
+            ('min_ts', func.LEAST(table.c.min_ts, stmt.inserted.min_ts)),
+            ('max_ts', func.GREATEST(table.c.max_ts, stmt.inserted.max_ts)),
+        ])
+        conn.execute(stmt, partials)
+        return
+    for partial in partials:
+        key = and_(table.c.processor_id == partial['processor_id'], table.c.bucket == partial['bucket'])
+        cur = conn.execute(select([table]).where(key)).first()
+        if cur is None:
+            conn.execute(table.insert(), partial)
+        else:
+            conn.execute(table.update().where(key).values(
+                value_sum=cur.value_sum + partial['value_sum'],
+                events=cur.events + partial['events'],
+                min_ts=min(cur.min_ts, partial['min_ts']),
+                max_ts=max(cur.max_ts, partial['max_ts']),
+                last_value=partial['last_value'] if partial['max_ts'] >= cur.max_ts else cur.last_value))
+
+
+def update_rollups(conn, rows: List[dict]):
+    """
+    event_writer flush hook. Adds written events to all rollups
+    """
+    for rollup in ROLLUPS:
+        _upsert(conn, rollup, aggregate(rows, rollup.resolution))
+
+
+def rebuild_rollups(processor_ids: Optional[List[int]] = None, start: Optional[dt.datetime] = None,
+                    stop: Optional[dt.datetime] = None, chunk_size: int = 10000) -> int:
+    """
+    Recalculates rollups from raw events.
+    Range is extended to whole hours so all affected buckets are rebuilt completely.
+    Events written by watchers during rebuild of the same range may be missed in rollups.
+    :param processor_ids: processors to rebuild (all if None)
+    :param start: first event ts (all history if None)
+    :param stop: last event ts (up to now if None)
+    :param chunk_size: number of raw events read at once
+    :return: number of processed events
+    """
+    pe = ProcessorEvent.__table__
+    hour = ProcessorEventHour.resolution
+    conditions = []
+    if processor_ids is not None:
+        conditions.append(pe.c.processor_id.in_(processor_ids))
+    if start is not None:
+        start = floor_ts(start, hour)
+        conditions.append(pe.c.ts >= start)
+    if stop is not None:
+        stop = floor_ts(stop, hour) + hour
+        conditions.append(pe.c.ts < stop)
+
+    # events are read by a separate connection because of server side cursor
+    with engine.connect() as reader, engine.begin() as conn:
+        for rollup in ROLLUPS:
+            table = rollup.__table__
+            delete = table.delete()
+            if processor_ids is not None:
+                delete = delete.where(table.c.processor_id.in_(processor_ids))
+            if start is not None:
+                delete = delete.where(table.c.bucket >= start)
+            if stop is not None:
+                delete = delete.where(table.c.bucket < stop)
+            conn.execute(delete)
+
+        query = select([pe.c.processor_id, pe.c.ts, pe.c.value]).order_by(pe.c.processor_id, pe.c.ts)
+        if conditions:
+            query = query.where(and_(*conditions))
+        result = reader.execution_options(stream_results=True).execute(query)
+        total = 0
+        rows = result.fetchmany(chunk_size)
+        while rows:
+            # events are sorted so only the buckets at the chunk border are updated twice
+            update_rollups(conn, [{'processor_id': row[0], 'ts': row[1], 'value': row[2]} for row in rows])
+            total += len(rows)
+            rows = result.fetchmany(chunk_size)
+    logging.info('Rollups rebuilt from {} events'.format(total))
+    return total
+
+
+def kept_resolution(ts: dt.datetime, raw_since: Optional[dt.datetime] = None,
+                    minutes_since: Optional[dt.datetime] = None) -> Optional[dt.timedelta]:
+    """
+    :param raw_since: raw events before it are deleted by retention (None if they are kept)
+    :param minutes_since: minute rollups before it are deleted by retention (None if they are kept)
+    :return: resolution of events kept for ts; None if raw events are kept
+    """
+    if minutes_since is not None and ts < minutes_since:
+        return ProcessorEventHour.resolution
+    if raw_since is not None and ts < raw_since:
+        return ProcessorEventMinute.resolution
+    return None
+
+
+def check_precision(ts: dt.datetime, raw_since: Optional[dt.datetime] = None,
+                    minutes_since: Optional[dt.datetime] = None, step: Optional[dt.timedelta] = None):
+    """
+    Checks that a range border (or series buckets of step) fits resolution of events kept for it
+    """
+    resolution = kept_resolution(ts, raw_since, minutes_since)
+    if resolution is None:
+        return
+    if floor_ts(ts, resolution) != ts or (step is not None and step % resolution):
+        raise PrecisionError('Events before {} are kept with {} minutes precision, {} does not fit it'.format(
+            (minutes_since if resolution == ProcessorEventHour.resolution else raw_since).strftime('%Y-%m-%d %H:%M'),
+            int(resolution.total_seconds() // 60), ts))
+
+
+def split_range(start: dt.datetime, stop: dt.datetime, raw_since: Optional[dt.datetime] = None,
+                minutes_since: Optional[dt.datetime] = None) -> Optional[Tuple[TsRange, Dict[type, List[TsRange]]]]:
+    """
+    Splits (start, stop] to whole buckets [first, last) and ragged edges: start < ts < first and last <= ts <= stop.
+    Whole buckets are taken from hour rollups and the rest of them from minute rollups.
+    :param raw_since: raw events before it are deleted (see kept_resolution), start and stop before it must be aligned
+    :param minutes_since: minute rollups before it are deleted (hour aligned)
+    :return: (first, last) and bucket ranges [from, to) of each rollup; None if there are no whole buckets
+    :raise PrecisionError: borders do not fit kept events
+    """
+    check_precision(start, raw_since, minutes_since)
+    check_precision(stop, raw_since, minutes_since)
+    minute = ProcessorEventMinute.resolution
+    hour = ProcessorEventHour.resolution
+    # start itself is not included into the range so the bucket starting at start is not whole
+    first_minute = floor_ts(start, minute) + minute
+    if raw_since is not None and start < raw_since:
+        # raw events of the first bucket are deleted, the bucket is taken whole
+        first_minute = start
+    last_minute = floor_ts(stop, minute)
+    if first_minute >= last_minute:
+        return None
+    rollup_parts = {ProcessorEventMinute: [], ProcessorEventHour: []}
+    first_hour = ceil_ts(first_minute, hour)
+    last_hour = floor_ts(last_minute, hour)
+    if first_hour < last_hour:
+        rollup_parts[ProcessorEventHour].append((first_hour, last_hour))
+        for part in ((first_minute, first_hour), (last_hour, last_minute)):
+            if part[0] < part[1]:
+                rollup_parts[ProcessorEventMinute].append(part)
+    else:
+        rollup_parts[ProcessorEventMinute].append((first_minute, last_minute))
+    return (first_minute, last_minute), rollup_parts
+
+
+def traffic_totals(ranges: Dict[int, TsRange], use_rollups: bool = True, raw_since: Optional[dt.datetime] = None,
+                   minutes_since: Optional[dt.datetime] = None) -> Dict[int, Tuple[int, dt.datetime, dt.datetime]]:
+    """
+    Calculates sum of values, min and max ts of events with start < ts <= stop for each processor.
+    Whatever the number of processors is it makes at most three grouped queries: raw events and both rollups.
+    :param ranges: processor id -> (start, stop)
+    :param use_rollups: False to aggregate raw events only
+    :param raw_since: raw events before it are deleted by retention (see split_range)
+    :param minutes_since: minute rollups before it are deleted by retention
+    :return: processor id -> (sum, min ts, max ts) for processors with events
+    :raise PrecisionError: a range does not fit events kept by retention
+    """
+    pe = ProcessorEvent.__table__
+    raw_conditions = []
+    rollup_conditions = {rollup: [] for rollup in ROLLUPS}
+    for proc_id, (start, stop) in ranges.items():
+        split = split_range(start, stop, raw_since, minutes_since) if use_rollups else None
+        if split is None:
+            raw_conditions.append(and_(pe.c.processor_id == proc_id, pe.c.ts > start, pe.c.ts <= stop))
+            continue
+        (first_bucket, last_bucket), rollup_parts = split
+        raw_conditions.append(and_(pe.c.processor_id == proc_id, pe.c.ts > start, pe.c.ts < first_bucket))
+        raw_conditions.append(and_(pe.c.processor_id == proc_id, pe.c.ts >= last_bucket, pe.c.ts <= stop))
+        for rollup, parts in rollup_parts.items():
+            table = rollup.__table__
+            for bucket_from, bucket_to in parts:
+                rollup_conditions[rollup].append(and_(table.c.processor_id == proc_id, table.c.bucket >= bucket_from,
+                                                      table.c.bucket < bucket_to))
+
+    queries = []
+    if raw_conditions:
+        queries.append(select([pe.c.processor_id, func.sum(pe.c.value), func.min(pe.c.ts), func.max(pe.c.ts)])
+                       .where(or_(*raw_conditions)).group_by(pe.c.processor_id))
+    for rollup, conditions in rollup_conditions.items():
+        if conditions:
+            table = rollup.__table__
+            queries.append(select([table.c.processor_id, func.sum(table.c.value_sum), func.min(table.c.min_ts),
+                                   func.max(table.c.max_ts)]).where(or_(*conditions)).group_by(table.c.processor_id))
+
+    totals = {}
+    with engine.connect() as conn:
+        for query in queries:
+            for proc_id, value_sum, min_ts, max_ts in conn.execute(query):
+                if min_ts is None:
+                    continue
+                if proc_id in totals:
+                    cur_sum, cur_min, cur_max = totals[proc_id]
+                    totals[proc_id] = ((cur_sum or 0) + (value_sum or 0), min(cur_min, min_ts), max(cur_max, max_ts))
+                else:
+                    totals[proc_id] = (value_sum, min_ts, max_ts)
+    return totals
+
+
+def latest_value(proc_id: int, ts: dt.datetime) -> Optional[Tuple[int, dt.datetime]]:
+    """
+    Returns value and ts of the latest event not later than ts.
+    If raw events were deleted by retention job the last value is taken from rollups.
+    """
+    pe = ProcessorEvent.__table__
+    with engine.connect() as conn:
+        row = conn.execute(select([pe.c.value, pe.c.ts]).where(and_(pe.c.processor_id == proc_id, pe.c.ts <= ts))
+                           .order_by(pe.c.ts.desc()).limit(1)).first()
+        if row:
+            return row[0], row[1]
+        for rollup in ROLLUPS:
+            table = rollup.__table__
+            row = conn.execute(select([table.c.last_value, table.c.max_ts])
+                               .where(and_(table.c.processor_id == proc_id, table.c.max_ts <= ts))
+                               .order_by(table.c.bucket.desc()).limit(1)).first()
+            if row:
+                return row[0], row[1]
+    return None
+
+
+def latest_values(timestamps: Dict[int, dt.datetime]) -> Dict[int, Tuple[int, dt.datetime]]:
+    """
+    Returns value and ts of the latest event not later than given ts for each processor.
+    Latest events of all processors are found by one grouped query.
+    :param timestamps: processor id -> ts
+    :return: processor id -> (value, ts) for processors with events
+    """
+    if not timestamps:
+        return {}
+    pe = ProcessorEvent.__table__
+    last = select([pe.c.processor_id, func.max(pe.c.ts).label('ts')]).where(
+        or_(*[and_(pe.c.processor_id == proc_id, pe.c.ts <= ts) for proc_id, ts in timestamps.items()])
+    ).group_by(pe.c.processor_id).alias('last')
+    query = select([pe.c.processor_id, pe.c.value, pe.c.ts]).select_from(
+        pe.join(last, and_(pe.c.processor_id == last.c.processor_id, pe.c.ts == last.c.ts)))
+    values = {}
+    with engine.connect() as conn:
+        for proc_id, value, ts in conn.execute(query):
+            values[proc_id] = (value, ts)
+    # raw events may be deleted by retention job
+    for proc_id, ts in timestamps.items():
+        if proc_id not in values:
+            value = latest_value(proc_id, ts)
+            if value:
+                values[proc_id] = value
+    return values
+
+
+def _bucket_index(conn, column, seconds: int):
+    """
+    SQL expression of a series bucket number of column (buckets are aligned to epoch)
+    """
+    if conn.dialect.name == 'mysql':
+        return func.TIMESTAMPDIFF(literal_column('SECOND'), EPOCH, column).op('DIV')(seconds)
+    if conn.dialect.name == 'sqlite':
+        return cast(func.strftime('%s', column), Integer) / seconds
+    return func.floor(func.extract('epoch', column) / seconds)
+
+
+def _series_source(start: dt.datetime, stop: dt.datetime, seconds: int, use_rollups: bool,
+                   raw_since: Optional[dt.datetime] = None, minutes_since: Optional[dt.datetime] = None):
+    """
+    Chooses the largest rollup which buckets fit series buckets.
+    :return: rollup (or None) and the end of whole rollup buckets; the rest of range is taken from raw events
+    :raise PrecisionError: buckets do not fit events kept by retention
+    """
+    if use_rollups:
+        check_precision(start, raw_since, minutes_since, dt.timedelta(seconds=seconds))
+        check_precision(stop, raw_since, minutes_since)
+    if use_rollups:
+        for rollup in (ProcessorEventHour, ProcessorEventMinute):
+            if seconds % int(rollup.resolution.total_seconds()) == 0:
+                return rollup, max(start, floor_ts(stop, rollup.resolution))
+    return None, start
+
+
+def series_buckets(start: dt.datetime, stop: dt.datetime, seconds: int) -> List[dt.datetime]:
+    """
+    Starts of series buckets covering [start, stop). Buckets are aligned to epoch
+    """
+    step = dt.timedelta(seconds=seconds)
+    bucket = floor_ts(start, step)
+    buckets = []
+    while bucket < stop:
+        buckets.append(bucket)
+        bucket += step
+    return buckets
+
+
+def traffic_series(proc_id: int, start: dt.datetime, stop: dt.datetime, seconds: int, use_rollups: bool = True,
+                   raw_since: Optional[dt.datetime] = None,
+                   minutes_since: Optional[dt.datetime] = None) -> List[Tuple[dt.datetime, int]]:
+    """
+    Sum of values for each bucket of [start, stop). start is rounded down to the bucket start.
+    :param raw_since: raw events before it are deleted by retention (see split_range)
+    :param minutes_since: minute rollups before it are deleted by retention
+    :return: [(bucket start, sum)]
+    """
+    start = floor_ts(start, dt.timedelta(seconds=seconds))
+    rollup, raw_start = _series_source(start, stop, seconds, use_rollups, raw_since, minutes_since)
+    pe = ProcessorEvent.__table__
+    sums = {}
+    with engine.connect() as conn:
+        queries = []
+        if rollup is not None and raw_start > start:
+            table = rollup.__table__
+            idx = _bucket_index(conn, table.c.bucket, seconds)
+            queries.append(select([idx, func.sum(table.c.value_sum)])
+                           .where(and_(table.c.processor_id == proc_id, table.c.bucket >= start,
+                                       table.c.bucket < raw_start)).group_by(idx))
+        if raw_start < stop:
+            idx = _bucket_index(conn, pe.c.ts, seconds)
+            queries.append(select([idx, func.sum(pe.c.value)])
+                           .where(and_(pe.c.processor_id == proc_id, pe.c.ts >= raw_start, pe.c.ts < stop))
+                           .group_by(idx))
+        for query in queries:
+            for idx, value_sum in conn.execute(query):
+                sums[int(idx)] = sums.get(int(idx), 0) + int(value_sum or 0)
+    return [(bucket, sums.get((bucket - EPOCH) // dt.timedelta(seconds=seconds), 0))
+            for bucket in series_buckets(start, stop, seconds)]
+
+
+def objects_series(proc_id: int, start: dt.datetime, stop: dt.datetime, seconds: int, use_rollups: bool = True,
+                   raw_since: Optional[dt.datetime] = None,
+                   minutes_since: Optional[dt.datetime] = None) -> List[Tuple[dt.datetime, Optional[int]]]:
+    """
+    Last value for each bucket of [start, stop) (step function: a bucket without events keeps the previous value).
+    start is rounded down to the bucket start.
+    :param raw_since: raw events before it are deleted by retention (see split_range)
+    :param minutes_since: minute rollups before it are deleted by retention
+    :return: [(bucket start, value)]; value is None before the first event
+    """
+    start = floor_ts(start, dt.timedelta(seconds=seconds))
+    rollup, raw_start = _series_source(start, stop, seconds, use_rollups, raw_since, minutes_since)
+    pe = ProcessorEvent.__table__
+    last_values = {}
+    with engine.connect() as conn:
+        queries = []
+        if rollup is not None and raw_start > start:
+            table = rollup.__table__
+            idx = _bucket_index(conn, table.c.bucket, seconds)
+            last = select([idx.label('idx'), func.max(table.c.bucket).label('bucket')]).where(
+                and_(table.c.processor_id == proc_id, table.c.bucket >= start, table.c.bucket < raw_start)
+            ).group_by(idx).alias('last')
+            queries.append(select([last.c.idx, table.c.max_ts, table.c.last_value]).select_from(
+                table.join(last, and_(table.c.processor_id == proc_id, table.c.bucket == last.c.bucket))))
+        if raw_start < stop:
+            idx = _bucket_index(conn, pe.c.ts, seconds)
+            last = select([idx.label('idx'), func.max(pe.c.ts).label('ts')]).where(
+                and_(pe.c.processor_id == proc_id, pe.c.ts >= raw_start, pe.c.ts < stop)
+            ).group_by(idx).alias('last')
+            queries.append(select([last.c.idx, pe.c.ts, pe.c.value]).select_from(
+                pe.join(last, and_(pe.c.processor_id == proc_id, pe.c.ts == last.c.ts))))
+        for query in queries:
+            for idx, ts, value in conn.execute(query):
+                if int(idx) not in last_values or ts >= last_values[int(idx)][0]:
+                    last_values[int(idx)] = (ts, value)
+
+    prev = latest_value(proc_id, start - dt.timedelta(microseconds=1))
+    value = prev[0] if prev else None
+    series = []
+    for bucket in series_buckets(start, stop, seconds):
+        idx = (bucket - EPOCH) // dt.timedelta(seconds=seconds)
+        if idx in last_values:
+            value = last_values[idx][1]
+        series.append((bucket, value))
+    return series
@@ -0,0 +1,67 @@
+"""
+Activity-adaptive sampling rate of camera watchers.
+
+A camera with watch_fps_min is sampled at watch_fps while its processors have activity (tracks or objects in zones).
+When the scene stays empty for ADAPTIVE_FPS_IDLE_SECONDS of video the rate is halved each segment
+down to watch_fps_min. Activity switches it back to watch_fps at once.
+Below one frame per segment whole segments are skipped (they are neither downloaded nor decoded).
+"""
+import datetime as dt
+import logging
+from typing import Optional, Tuple
+
+
+class AdaptiveFps:
+    """
+    Sampling rate of one watcher
+    """
+
+    def __init__(self, idle_seconds: float):
+        """
+        :param idle_seconds: seconds of video without activity to lower the rate
+        """
+        self.idle_seconds = idle_seconds
+        self.fps: Optional[float] = None
+        self.idle_since: Optional[dt.datetime] = None
+        # ts of the last sampled frame
+        self.last_ts: Optional[dt.datetime] = None
+
+    def current(self, fps_range: Tuple[float, float]) -> float:
+        """
+        :param fps_range: min and max fps of the camera (they can be changed by admin)
+        :return: fps to sample the next segment
+        """
+        min_fps, max_fps = fps_range
+        self.fps = max_fps if self.fps is None else min(max(self.fps, min_fps), max_fps)
+        return self.fps
+
+    def skip(self, segment_end: dt.datetime, fps: Optional[float] = None) -> bool:
+        """
+        Checks if a segment ends before the next frame must be sampled
+        :param fps: the rate segments are sampled at (the current rate lowered by load shedding); self.fps if None
+        """
+        fps = fps or self.fps
+        if self.last_ts is None or not fps:
+            return False
+        return segment_end <= self.last_ts + dt.timedelta(seconds=1 / fps)
+
+    def update(self, fps_range: Tuple[float, float], active: bool, last_ts: dt.datetime):
+        """
+        Changes the rate after a segment is processed
+        :param active: processors have activity at the segment
+        :param last_ts: ts of the last sampled frame of the segment
+        """
+        min_fps, max_fps = fps_range
+        self.last_ts = last_ts
+        if active:
+            self.idle_since = None
+            if self.fps != max_fps:
+                logging.info('Activity found, sampling rate is raised to {} fps'.format(max_fps))
+            self.fps = max_fps
+            return
+        if self.idle_since is None:
+            self.idle_since = last_ts
+        if (last_ts - self.idle_since).total_seconds() >= self.idle_seconds and self.fps > min_fps:
+            self.fps = max(min_fps, self.fps / 2)
+            logging.info('No activity for {:.0f} seconds, sampling rate is lowered to {} fps'
+                         .format((last_ts - self.idle_since).total_seconds(), self.fps))
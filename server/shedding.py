@@ -0,0 +1,92 @@
+"""
+Load shedding of camera watchers which fall behind live.
+
+Lag of a watcher is the time from the live edge (the end of the newest segment of the playlist it works on)
+to the start of processing of each segment. Older segments of a playlist are behind by design: the whole playlist
+is processed on start and new segments are collected while the watcher sleeps between polls.
+When it exceeds thresholds of LAG_LADDER the watcher degrades its work step by step:
+- lower_fps: frames are sampled LAG_FPS_FACTOR times slower,
+- larger_grid: one more row and column of frames in a mosaic for the detector (fewer detector calls),
+- skip_preview: HLS preview of processors and live frames are not made,
+- skip_faces: face detectors are not run.
+A step is removed when lag drops below LAG_RECOVERY_RATIO of its threshold (the last applied step first).
+"""
+import datetime as dt
+import logging
+from typing import List, Sequence, Tuple
+
+from server.telemetry import SHEDDING_LEVEL
+
+STEPS = ('lower_fps', 'larger_grid', 'skip_preview', 'skip_faces')
+
+
+def live_edge_lag(segment_ends: Sequence[dt.datetime], now: dt.datetime) -> float:
+    """
+    :param segment_ends: end ts of segments of the playlist
+    :return: seconds from the end of the newest segment to now
+    """
+    return (now - max(segment_ends)).total_seconds()
+
+
+class LoadShedder:
+    """
+    Degradation level of one watcher
+    """
+
+    def __init__(self, ladder: Sequence[Tuple[float, str]], recovery_ratio: float, fps_factor: float):
+        """
+        :param ladder: [(lag seconds, step)] in order of application, thresholds must not decrease
+        :param recovery_ratio: part of a threshold lag must drop below to remove the step
+        :param fps_factor: sampling rate multiplier of the lower_fps step
+        """
+        for i, (threshold, step) in enumerate(ladder):
+            if step not in STEPS:
+                raise ValueError('Unknown load shedding step {}, expected one of {}'.format(step, STEPS))
+            if i and threshold < ladder[i - 1][0]:
+                raise ValueError('Thresholds of load shedding steps must not decrease')
+        self.ladder = list(ladder)
+        self.recovery_ratio = recovery_ratio
+        self.fps_factor = fps_factor
+        self.level = 0  # number of applied steps
+        SHEDDING_LEVEL.set(value=self.level)
+
+    @property
+    def steps(self) -> List[str]:
+        return [step for _, step in self.ladder[:self.level]]
+
+    def active(self, step: str) -> bool:
+        return step in self.steps
+
+    def sampling_fps(self, fps: float) -> float:
+        """
+        :param fps: sampling rate of the camera
+        :return: sampling rate with lower_fps step applied
+        """
+        return fps * self.fps_factor if self.active('lower_fps') else fps
+
+    def grid_size(self, grid_size: Tuple[int, int]) -> Tuple[int, int]:
+        """
+        :param grid_size: (rows, cols) of the mosaic of the camera
+        :return: grid size with larger_grid step applied
+        """
+        return (grid_size[0] + 1, grid_size[1] + 1) if self.active('larger_grid') else grid_size
+
+    def update(self, lag: float) -> bool:
+        """
+        Applies or removes steps by lag of the next segment
+        :return: True if the level is changed
+        """
+        level = self.level
+        while self.level < len(self.ladder) and lag > self.ladder[self.level][0]:
+            self.level += 1
+        if self.level > level:
+            logging.warning('Lag {:.1f} s: load shedding steps {} are applied'
+                            .format(lag, self.steps[level:]))
+            SHEDDING_LEVEL.set(value=self.level)
+            return True
+        if self.level and lag < self.ladder[self.level - 1][0] * self.recovery_ratio:
+            self.level -= 1
+            logging.info('Lag {:.1f} s: load shedding step {} is removed'.format(lag, self.ladder[self.level][1]))
+            SHEDDING_LEVEL.set(value=self.level)
+            return True
+        return False
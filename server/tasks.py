@@ -5,21 +5,52 @@ import os
 import signal
 import time
 import traceback
-from typing import List, Tuple
+from typing import Callable, Iterator, List, Optional, Tuple
 from urllib.error import URLError
 from urllib.request import urlopen
 
 import m3u8
 import numpy as np
 import requests
-from celery import Celery
+from celery.signals import worker_ready
 from cv2 import cv2
+from sqlalchemy.orm import selectinload, with_polymorphic
 
+from server.celery_app import celery
+from server.config_sync import ConfigListener
 from server.database import db_session
-from server.instance.config import OBJECT_DETECTOR_URL, SEGMENTS_DIR
+from server.detection_log import DetectionLog
+from server.events import event_writer
+from server.heartbeat import Heartbeat
+from server.live import publish_live_frame, publish_events
+from server.instance.config import OBJECT_DETECTOR_URL, SEGMENTS_DIR, EVENT_RETENTION_DAYS, \
+    MINUTE_ROLLUPS_RETENTION_DAYS, EVENT_PARTITIONS_AHEAD, PROFILE_INTERVAL, PROFILE_SECONDS, PROFILES_DIR, \
+    DETECTION_LOG_DIR, CONFIG_RESYNC_INTERVAL, ADAPTIVE_FPS_IDLE_SECONDS, LAG_LADDER, LAG_RECOVERY_RATIO, \
+    LAG_FPS_FACTOR, USE_ROLLUPS
 from server.models import Camera, DetectedObject, Frame, Processor
+from server.placement import register_worker
+from server.profiler import SamplingProfiler, install_signal_handler, check_profile_request, profile_path
+from server.retention import compact_events
+from server.rollups import update_rollups
+from server.sampling import AdaptiveFps
+from server.shedding import LoadShedder, live_edge_lag
+from server.telemetry import registry, push_metrics, STAGE_SECONDS, PROCESSOR_SECONDS, SEGMENTS, SEGMENT_ERRORS, \
+    FRAMES, DETECTOR_CALLS, DETECTOR_BYTES, LAG, WATCH_FPS
 
-celery = Celery(__name__, autofinalize=False)
+# rollups are updated in the same transaction as events are written
+event_writer.add_flush_hook(update_rollups)
+# written events are pushed to subscribers
+event_writer.add_commit_hook(publish_events)
+
+
+@worker_ready.connect
+def on_worker_ready(sender, **kwargs):
+    # watchers are placed on workers by their CPUs
+    try:
+        register_worker(sender.hostname, os.cpu_count() or 1)
+    except Exception as e:
+        logging.error('Failed to register worker {}'.format(sender.hostname))
+        logging.error(str(e))
 
 
 class GracefulKiller:
@@ -29,12 +60,42 @@ class GracefulKiller:
     kill_now = False
 
     def __init__(self):
+        self.exit_callbacks = []
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
 
     def exit_gracefully(self, signum, frame):
         self.kill_now = True
 
+    def sleep(self, seconds: float, wake_up: Optional[Callable[[], bool]] = None):
+        """
+        Sleeps for some seconds but wakes up soon after an exit signal
+        :param wake_up: checked every half a second, sleep is interrupted if it returns True
+        """
+        stop = time.monotonic() + seconds
+        while not self.kill_now and time.monotonic() < stop:
+            if wake_up and wake_up():
+                return
+            time.sleep(max(0, min(0.5, stop - time.monotonic())))
+
+    def add_exit_callback(self, callback: Callable):
+        """
+        Callback will be called on exit (buffers flushing etc)
+        """
+        self.exit_callbacks.append(callback)
+
+    def shutdown(self):
+        """
+        Runs exit callbacks. Must be called from the main loop, not from the signal handler
+        """
+        for callback in self.exit_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.error('Exit callback failed')
+                logging.error(traceback.format_exc())
+                logging.error(str(e))
+
 
 def combine_images(images: List[np.ndarray], grid_size: tuple):
     """
@@ -65,6 +126,25 @@ def offset(obj: list, x_offset: float, y_offset: float, grid_size: Tuple[int, in
             (obj[2] - x_offset) * grid_size[1], (obj[3] - y_offset) * grid_size[0]] + obj[4:]
 
 
+def read_frames(cap: cv2.VideoCapture, frame_rate: float, watch_fps: float,
+                first_ts: dt.datetime) -> Iterator[Frame]:
+    """
+    Selects frames of a video with watch_fps rate. Skipped frames are only grabbed (not converted to images).
+    :param cap: opened video
+    :param frame_rate: video frame rate
+    :param watch_fps: required frame rate
+    :param first_ts: ts of the first frame of the video
+    """
+    step = max(1, round(frame_rate / watch_fps))
+    frame_id = 0
+    while cap.grab():
+        if frame_id % step == 0:
+            ret, img = cap.retrieve()
+            if ret:
+                yield Frame(img, first_ts + dt.timedelta(seconds=frame_id / frame_rate))
+        frame_id += 1
+
+
 def detect_objs(frames: List[Frame], grid_size: Tuple[int, int]):
     """
     Batch object detection. Combines frame into one grid mosaic, sends them to detection server and unpacks results.
@@ -90,24 +170,76 @@ def detect_objs(frames: List[Frame], grid_size: Tuple[int, int]):
 
         # request server for detection
         _, buf = cv2.imencode('.jpg', batch_image)
-        r = requests.post(OBJECT_DETECTOR_URL, data=buf.tostring(), headers=headers)
+        DETECTOR_CALLS.inc()
+        DETECTOR_BYTES.inc(value=len(buf))
+        r = requests.post(OBJECT_DETECTOR_URL, data=buf.tobytes(), headers=headers)
         objects = json.loads(r.text)
 
         # split objects by initial frames
-        frame_id = 0
-        for row in range(grid_size[0]):
-            for col in range(grid_size[1]):
-                x_min = col / grid_size[1]
-                x_max = x_min + 1 / grid_size[1]
-                y_min = row / grid_size[0]
-                y_max = y_min + 1 / grid_size[0]
-                if frame_id < len(sub_frames):
-                    # to avoid writing objects of empty frames (which do not exist)
-                    f_objs = [offset(obj, x_min, y_min, grid_size) for obj in objects if
-                              x_min <= obj[0] <= x_max and y_min <= obj[1] <= y_max]
-                    logging.debug('Detected {} objects at {} frame'.format(len(f_objs), frame_id))
-                    sub_frames[frame_id].objects = [DetectedObject(*obj) for obj in f_objs]
-                frame_id += 1
+        for frame, f_objs in zip(sub_frames, split_detections(objects, len(sub_frames), grid_size)):
+            frame.objects = f_objs
+
+
+def split_detections(objects: List[list], n_frames: int, grid_size: Tuple[int, int]) -> List[List[DetectedObject]]:
+    """
+    Splits objects detected at a grid mosaic by initial frames (cells of the grid)
+    :param objects: detector results [x_min, y_min, x_max, y_max, prob, ...] relative to the mosaic
+    :param n_frames: number of real frames at the mosaic (the rest cells are empty)
+    :param grid_size:
+    :return: objects of each frame relative to the frame
+    """
+    frames_objects = []
+    frame_id = 0
+    for row in range(grid_size[0]):
+        for col in range(grid_size[1]):
+            x_min = col / grid_size[1]
+            x_max = x_min + 1 / grid_size[1]
+            y_min = row / grid_size[0]
+            y_max = y_min + 1 / grid_size[0]
+            if frame_id < n_frames:
+                # to avoid writing objects of empty frames (which do not exist)
+                f_objs = [offset(obj, x_min, y_min, grid_size) for obj in objects if
+                          x_min <= obj[0] <= x_max and y_min <= obj[1] <= y_max]
+                logging.debug('Detected {} objects at {} frame'.format(len(f_objs), frame_id))
+                frames_objects.append([DetectedObject(*obj) for obj in f_objs])
+            frame_id += 1
+    return frames_objects
+
+
+def load_camera(camera_id: int, previous: Optional[Camera] = None) -> Optional[Camera]:
+    """
+    Loads camera with its processors and detaches them from the DB session, so the watcher does not query DB
+    until the config is changed. Enabled processors take runtime state (tracks, video builders) of the previous ones.
+    :param previous: camera loaded before
+    :return: None if the camera was deleted
+    """
+    db_session.rollback()
+    # noinspection PyUnresolvedReferences
+    # columns of processor subclasses (e.g. FaceDetector.best_shot) must be loaded with processors,
+    # they can not be loaded lazily after the session is closed
+    # noinspection PyUnresolvedReferences
+    camera = Camera.query.options(selectinload(Camera.processors.of_type(with_polymorphic(Processor, '*')))) \
+        .filter_by(id=camera_id).first()
+    if camera:
+        for proc in camera.processors:
+            _ = proc.camera
+    # release the connection, loaded attributes stay available
+    db_session.close()
+    previous_procs = {proc.id: proc for proc in previous.processors} if previous else {}
+    for proc in camera.processors if camera else []:
+        if proc.enabled and proc.id in previous_procs:
+            proc.take_state(previous_procs.pop(proc.id))
+    for proc in previous_procs.values():
+        proc.close()
+    return camera
+
+
+def close_processors(camera: Optional[Camera]):
+    """
+    Releases runtime state of processors of a stopped watcher
+    """
+    for proc in camera.processors if camera else []:
+        proc.close()
 
 
 @celery.task
@@ -120,7 +252,8 @@ def watch_camera(camera_id: int):
     - processors analysis
     - DB saving
 
-    After each loop it check DB again for possible changes (processor on/off, roe changes etc).
+    Camera and processors are reloaded from DB when admin notifies about their changes (processor on/off,
+    roe changes etc) and every CONFIG_RESYNC_INTERVAL seconds.
     If no processors selected or camera is unavailable it sleeps for some time and starts the loop again.
 
     """
@@ -137,23 +270,60 @@ def watch_camera(camera_id: int):
 
     # OS signals listener
     killer = GracefulKiller()
+    # write buffered events before exit
+    killer.add_exit_callback(event_writer.close)
+    # watcher state for status requests and health checks
+    heartbeat = Heartbeat(camera_id, watch_camera.request.id, watch_camera.request.hostname)
+    # supervisor must see the watcher before the first segment is processed
+    heartbeat.beat('starting')
+    killer.add_exit_callback(heartbeat.stop)
+    # metrics of this watcher for /metrics
+    registry.reset(camera=camera_id)
+    # profiling on demand: SIGUSR2 or `flask profile-watcher`
+    profiler = SamplingProfiler(PROFILE_INTERVAL)
+    install_signal_handler()
+    # raw detections for recomputing of events
+    detection_log = DetectionLog(DETECTION_LOG_DIR, camera_id) if DETECTION_LOG_DIR else None
+    # sampling rate of cameras with min fps follows activity
+    sampling = AdaptiveFps(ADAPTIVE_FPS_IDLE_SECONDS)
+    # work is degraded while the watcher is behind live
+    shedder = LoadShedder(LAG_LADDER, LAG_RECOVERY_RATIO, LAG_FPS_FACTOR)
+
+    # config change notifications (subscribed before loading, so changes are not missed)
+    config = ConfigListener(camera_id, CONFIG_RESYNC_INTERVAL)
+    config.changed()
+    killer.add_exit_callback(config.close)
 
     # find camera
-    # noinspection PyUnresolvedReferences
-    camera = Camera.query.filter_by(id=camera_id).first()
+    camera = load_camera(camera_id)
+    config.reloaded()
     if camera:
         logging.info('Camera {} found.'.format(camera.id))
     else:
-        logging.error('Camera {} was not found in DB. Aborted.'.format(camera.id))
+        logging.error('Camera {} was not found in DB. Aborted.'.format(camera_id))
+        killer.shutdown()
         return
+    # video builders are stopped and buffered best shots are sent on exit (camera of the latest reload)
+    killer.add_exit_callback(lambda: close_processors(camera))
 
     while True:
-        # rollback session to reload all camera and processor parameters from DB
-        db_session.rollback()
         # check system events
         if killer.kill_now:
             logging.warning("Camera {} watch process was terminated by signal".format(camera.id))
+            killer.shutdown()
             return
+        # reload camera and processor parameters only if they are changed
+        if config.changed():
+            camera = load_camera(camera_id, camera)
+            config.reloaded()
+            if camera is None:
+                logging.warning('Camera {} was deleted. Watcher is stopped.'.format(camera_id))
+                killer.shutdown()
+                return
+            logging.info('Config of camera {} is reloaded'.format(camera_id))
+        profile_seconds = check_profile_request(camera.id, PROFILE_SECONDS)
+        if profile_seconds and not profiler.start(profile_seconds, profile_path(PROFILES_DIR, camera.id)):
+            logging.warning('Profiling is already running')
 
         # list of processors that must process frames
         enabled_procs: List[Processor] = [p for p in camera.processors if p.enabled]
@@ -162,7 +332,8 @@ def watch_camera(camera_id: int):
         else:
             logging.warning('No enabled processors found for camera {}'.format(camera.id))
             logging.warning('Sleeping for {} seconds'.format(reconnect_time))
-            time.sleep(reconnect_time)
+            heartbeat.beat('no_processors')
+            killer.sleep(reconnect_time, config.changed)
             continue
         # logging.info('Refresh session each attempt')
         # db.session.commit()
@@ -183,13 +354,26 @@ def watch_camera(camera_id: int):
         except URLError:
             logging.warning('Failed to connect with camera {}'.format(camera.id))
             logging.warning('Sleeping for {} seconds'.format(reconnect_time))
-            time.sleep(reconnect_time)
+            heartbeat.beat('unavailable')
+            killer.sleep(reconnect_time)
             continue
 
         # process segments
         n_segments = len(stream.segments)
+        segment_ends = [s.current_program_date_time + dt.timedelta(seconds=s.duration) for s in stream.segments]
         for segment in stream.segments:
             if segment.absolute_uri not in last_processed_segments:
+                # events are stored as naive camera local time
+                first_ts = segment.current_program_date_time.replace(tzinfo=None) + dt.timedelta(hours=camera.tz)
+                segment_end = segment.current_program_date_time + dt.timedelta(seconds=segment.duration)
+                shedder.update(live_edge_lag(segment_ends, dt.datetime.now(segment_end.tzinfo)))
+                watch_fps = shedder.sampling_fps(sampling.current(camera.fps_range))
+                WATCH_FPS.set(value=watch_fps)
+                if sampling.skip(first_ts + dt.timedelta(seconds=segment.duration), watch_fps):
+                    # low sampling rate: the next frame is not in this segment
+                    logging.info('Segment {} is skipped at {} fps'.format(segment.absolute_uri, watch_fps))
+                    last_processed_segments.append(segment.absolute_uri)
+                    continue
                 t01 = time.time()
                 segment_fp = os.path.join(camera_tmp_dir, segment.uri.replace('/', '_'))
                 logging.info('Download ts file: {} to {}'.format(segment.absolute_uri, segment_fp))
@@ -219,24 +403,19 @@ def watch_camera(camera_id: int):
                         time.sleep(1)
                 if not segment_downloaded:
                     logging.error('Segment was not downloaded. Skipping.')
+                    SEGMENT_ERRORS.inc(('download',))
+                    push_metrics(camera.id)
                     continue
                 t02 = time.time()
                 logging.info('Open video')
                 cap = cv2.VideoCapture(segment_fp)
                 t03 = time.time()
                 logging.info('Select frames')
-                frames = []
-                frame_id = 0
-                ret, img = cap.read()
-                while ret:
-                    if ret and frame_id % round(stream_info.frame_rate / camera.watch_fps) == 0:
-                        ts = segment.current_program_date_time + dt.timedelta(
-                            seconds=frame_id / stream_info.frame_rate) + dt.timedelta(hours=camera.tz)
-                        logging.debug('Acceptes ts: {}'.format(ts))
-                        frames.append(Frame(img, ts))
-                    frame_id += 1
-                    ret, img = cap.read()
+                frames = list(read_frames(cap, stream_info.frame_rate, watch_fps, first_ts))
                 logging.info('Frames to process: {}'.format(len(frames)))
+                if frames and not shedder.active('skip_preview'):
+                    # preview for zones editor
+                    publish_live_frame(camera.id, frames[-1].image, frames[-1].ts)
                 if cap and cap.isOpened():
                     cap.release()
                 t04 = time.time()
@@ -250,32 +429,85 @@ def watch_camera(camera_id: int):
                                                         t03 - t02,
                                                         t04 - t03,
                                                         t05 - t04))
+                STAGE_SECONDS.observe(('download',), t02 - t01)
+                STAGE_SECONDS.observe(('open',), t03 - t02)
+                STAGE_SECONDS.observe(('decode',), t04 - t03)
+                STAGE_SECONDS.observe(('delete',), t05 - t04)
+                FRAMES.inc(value=len(frames))
                 if frames:
                     # detect objects at Frames
                     try:
-                        detect_objs(frames, camera.grid_size)
+                        detect_objs(frames, shedder.grid_size(camera.grid_size))
                     except Exception as e:
                         logging.error('Failed to detect objects')
                         logging.error(traceback.format_exc())
                         logging.error(str(e))
+                        heartbeat.beat('detector_unavailable')
+                        SEGMENT_ERRORS.inc(('detect',))
+                        push_metrics(camera.id)
                         break
 
+                    if detection_log:
+                        detection_log.write(frames)
                     t06 = time.time()
+                    STAGE_SECONDS.observe(('detect',), t06 - t05)
 
                     # todo: async
                     # calculate and save / send metrics
-                    for proc in enabled_procs:
+                    procs = [p for p in enabled_procs if not (shedder.active('skip_faces') and p.type == 'face')]
+                    for proc in procs:
+                        proc.preview_enabled = not shedder.active('skip_preview')
+                        proc.sampling_fps = watch_fps
                         logging.debug('Started {}'.format(proc.__class__.__name__))
                         t1 = time.time()
                         proc.process(frames)
                         t2 = time.time()
                         logging.debug('Finished {} for {:.2f}'.format(proc.__class__.__name__, t2 - t1))
+                        PROCESSOR_SECONDS.observe((str(proc.id), proc.type), t2 - t1)
                     t07 = time.time()
+                    STAGE_SECONDS.observe(('process',), t07 - t06)
+                    sampling.update(camera.fps_range, any(proc.is_active(frames) for proc in procs),
+                                    frames[-1].ts)
+                    STAGE_SECONDS.observe(('total',), t07 - t01)
                     logging.info('Detect objs: {:.2f}, Process frames: {:.2f}'.format(t06 - t05, t07 - t06))
                     logging.info('Total time {:.2f}'.format(t07 - t01))
                 else:
                     logging.warning('No frames found')
+                processing_time = time.time() - t01
+                lag = (dt.datetime.now(segment_end.tzinfo) - segment_end).total_seconds()
+                SEGMENTS.inc()
+                LAG.set(value=lag)
+                push_metrics(camera.id)
+                heartbeat.beat('processing',
+                               last_segment=segment.absolute_uri,
+                               segment_ts=segment_end.isoformat(),
+                               lag=lag,
+                               fps=len(frames) / segment.duration if segment.duration else None,
+                               watch_fps=watch_fps,
+                               shedding=shedder.steps,
+                               processing_fps=len(frames) / processing_time if processing_time else None,
+                               processing_time=processing_time,
+                               # seconds of work per second of video: cost of the camera for placement
+                               load=processing_time / segment.duration if segment.duration else None)
             last_processed_segments.append(segment.absolute_uri)
         # leave only last processed segments
         last_processed_segments = last_processed_segments[-n_segments:]
-        time.sleep(max(1, (n_segments - 2) * stream.target_duration))
+        heartbeat.beat('sleeping')
+        # config changes are applied without waiting for the end of sleep
+        killer.sleep(max(1, (n_segments - 2) * stream.target_duration), config.changed)
+
+
+@celery.task
+def compact_old_events():
+    """
+    Retention job (scheduled daily by Celery beat when EVENT_RETENTION_DAYS is set).
+    Deletes raw events older than EVENT_RETENTION_DAYS keeping their rollups.
+    """
+    if EVENT_RETENTION_DAYS is None:
+        logging.info('Events retention is disabled')
+        return 0
+    if not USE_ROLLUPS:
+        # API would not count deleted events
+        logging.error('Events retention requires USE_ROLLUPS')
+        return 0
+    return compact_events(EVENT_RETENTION_DAYS, MINUTE_ROLLUPS_RETENTION_DAYS, EVENT_PARTITIONS_AHEAD)
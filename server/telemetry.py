@@ -0,0 +1,186 @@
+"""
+Watchers instrumentation in Prometheus terms.
+
+Each watcher process collects its counters and histograms in `registry` and pushes its snapshot to Redis
+(the key expires if the watcher dies). API renders snapshots of all watchers in Prometheus text format at /metrics.
+"""
+import json
+import logging
+import math
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Tuple
+
+from server.instance.config import HEARTBEAT_TTL
+from server.redis_client import get_redis, METRICS_KEY
+
+SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def snapshot(self) -> dict:
+        return {'type': self.type, 'doc': self.doc, 'labels': list(self.labels),
+                'samples': [[list(labels), value] for labels, value in self.values.items()]}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels: tuple = (), value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, labels: tuple = (), value: float = 0):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (), buckets: Sequence[float] = SECONDS_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels: tuple = (), value: float = 0):
+        # [counts of buckets (not cumulative) and +Inf, sum, count]
+        sample = self.values.get(labels)
+        if sample is None:
+            sample = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+        sample[0][bisect_left(self.buckets, value)] += 1
+        sample[1] += value
+        sample[2] += 1
+
+    def snapshot(self) -> dict:
+        return dict(super().snapshot(), buckets=list(self.buckets))
+
+
+class Registry:
+    """
+    Metrics of one process. const_labels (camera id for watchers) are added to all samples.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = OrderedDict()
+        self.const_labels: Dict[str, str] = {}
+
+    def _add(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, doc: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, doc, labels))
+
+    def gauge(self, name: str, doc: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, doc, labels))
+
+    def histogram(self, name: str, doc: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = SECONDS_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, doc, labels, buckets))
+
+    def reset(self, **const_labels):
+        """
+        Clears all values (a new watcher is started in the process)
+        """
+        self.const_labels = {k: str(v) for k, v in const_labels.items()}
+        for metric in self.metrics.values():
+            metric.values.clear()
+
+    def snapshot(self) -> dict:
+        return {'const_labels': self.const_labels,
+                'metrics': {name: metric.snapshot() for name, metric in self.metrics.items()}}
+
+
+registry = Registry()
+STAGE_SECONDS = registry.histogram('hypersight_stage_seconds', 'Watcher loop stage duration per segment',
+                                   ['stage'])
+PROCESSOR_SECONDS = registry.histogram('hypersight_processor_seconds', 'Processor duration per segment',
+                                       ['processor', 'type'])
+SEGMENTS = registry.counter('hypersight_segments_total', 'Processed segments')
+SEGMENT_ERRORS = registry.counter('hypersight_segment_errors_total', 'Segments failed by stage', ['stage'])
+FRAMES = registry.counter('hypersight_frames_total', 'Frames sampled for processing')
+DETECTOR_CALLS = registry.counter('hypersight_detector_calls_total', 'Requests to the object detector')
+DETECTOR_BYTES = registry.counter('hypersight_detector_bytes_total', 'Bytes of images sent to the object detector')
+EVENTS = registry.counter('hypersight_events_total', 'Events emitted by processors', ['processor'])
+LAG = registry.gauge('hypersight_lag_seconds', 'Time from the end of the last segment to its processing')
+WATCH_FPS = registry.gauge('hypersight_watch_fps', 'Current sampling rate of the camera')
+SHEDDING_LEVEL = registry.gauge('hypersight_shedding_level', 'Number of applied load shedding steps')
+
+
+def push_metrics(camera_id: int):
+    """
+    Saves snapshot of watcher metrics to Redis
+    """
+    try:
+        get_redis().set(METRICS_KEY.format(camera_id), json.dumps(registry.snapshot()), ex=HEARTBEAT_TTL)
+    except Exception as e:
+        logging.error('Failed to push metrics of camera {}'.format(camera_id))
+        logging.error(str(e))
+
+
+def read_snapshots() -> List[dict]:
+    """
+    Returns metrics snapshots of all running watchers
+    """
+    r = get_redis()
+    keys = list(r.scan_iter(METRICS_KEY.format('*')))
+    return [json.loads(value) for value in r.mget(keys) if value is not None] if keys else []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render(snapshots: List[dict]) -> str:
+    """
+    Renders metrics snapshots of many processes in Prometheus text exposition format
+    """
+    names = OrderedDict()
+    for snapshot in snapshots:
+        for name, metric in snapshot['metrics'].items():
+            names.setdefault(name, metric)
+    lines = []
+    for name, meta in names.items():
+        lines.append('# HELP {} {}'.format(name, meta['doc']))
+        lines.append('# TYPE {} {}'.format(name, meta['type']))
+        for snapshot in snapshots:
+            metric = snapshot['metrics'].get(name)
+            if not metric:
+                continue
+            const_labels = list(snapshot['const_labels'].items())
+            for label_values, value in metric['samples']:
+                labels = const_labels + list(zip(metric['labels'], label_values))
+                if metric['type'] != 'histogram':
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(metric['buckets'] + [float('inf')], counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labels + [('le', _format_value(float(bound)))]), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(float(total))))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+    return '\n'.join(lines) + '\n'
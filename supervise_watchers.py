@@ -0,0 +1,27 @@
+"""
+Watchers supervisor. Restarts crashed camera watchers and moves single cameras between Celery workers
+to balance their load (see server/placement.py). One instance runs next to Celery workers.
+"""
+import logging
+import time
+
+from celery_worker import celery
+from server.database import db_session
+from server.instance.config import SUPERVISOR_INTERVAL, SUPERVISOR_START_GRACE, SUPERVISOR_STOP_TIMEOUT, \
+    SUPERVISOR_REBALANCE_THRESHOLD, SUPERVISOR_MAX_MOVES
+from server.models import Camera
+from server.placement import Supervisor
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+supervisor = Supervisor(celery, SUPERVISOR_START_GRACE, SUPERVISOR_STOP_TIMEOUT, SUPERVISOR_REBALANCE_THRESHOLD,
+                        SUPERVISOR_MAX_MOVES)
+while True:
+    try:
+        # noinspection PyUnresolvedReferences
+        camera_ids = [camera.id for camera in Camera.query.all()]
+        db_session.remove()
+        supervisor.step(camera_ids)
+    except Exception as e:
+        logging.exception('Supervision failed: {}'.format(e))
+    time.sleep(SUPERVISOR_INTERVAL)
@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# models are used without MySQL: the DB engine is created on import of the server package
+os.environ.setdefault('DATABASE_URL', 'sqlite:///{}'.format(os.path.join(tempfile.mkdtemp(), 'tests.db')))
+
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    """
+    Empty DB with all tables
+    """
+    from server.database import init_db
+    init_db()
@@ -0,0 +1,70 @@
+"""
+Faces relay in redis mode against a local redis-server (REDIS_URL), skipped if it is not available.
+"""
+import asyncio
+import threading
+
+import pytest
+
+from server import faces_protocol
+from server.redis_client import get_redis
+
+
+class FakeWebsocket:
+    """
+    Client connection of the relay: sends the greeting and collects relayed messages
+    """
+
+    def __init__(self, greeting: str):
+        self.greeting = greeting
+        self.received = asyncio.Queue()
+
+    async def recv(self):
+        return self.greeting
+
+    async def send(self, data):
+        await self.received.put(data)
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def redis_server():
+    try:
+        get_redis().ping()
+    except Exception as e:
+        pytest.skip('redis-server is not available: {}'.format(e))
+
+
+def test_detector_message_is_relayed_to_client(redis_server):
+    import faces_ws_server
+    from server.models import FaceDetector
+
+    async def run():
+        loop = asyncio.get_event_loop()
+        client = FakeWebsocket('{"type": "client", "format": "binary", "cameras": [7]}')
+        assert await faces_ws_server.register(client)
+        assert await client.received.get() == 'OK'
+        stopped = threading.Event()
+        thread = threading.Thread(target=faces_ws_server.listen_redis, args=(loop, stopped), daemon=True)
+        thread.start()
+        try:
+            message = faces_protocol.encode_binary({'frame_ts': '2024-01-01 00:00:00.000000', 'container': 'jpg',
+                                                    'camera_id': 7, 'camera_url': 'url', 'faces': [{'conf': 0.9}]},
+                                                   [b'\xff\xd8face\x00\xff\xd9'])
+            # the subscription is made in the thread, messages published before it are lost
+            for _ in range(50):
+                if get_redis().pubsub_numsub(faces_ws_server.FACE_REDIS_CHANNEL)[0][1]:
+                    break
+                await asyncio.sleep(0.1)
+            FaceDetector._publish_to_redis(message)
+            return await asyncio.wait_for(client.received.get(), timeout=5)
+        finally:
+            stopped.set()
+            await faces_ws_server.unregister(client)
+
+    received = asyncio.new_event_loop().run_until_complete(run())
+    meta, images = faces_protocol.decode_binary(received)
+    assert meta['camera_id'] == 7
+    assert images == [b'\xff\xd8face\x00\xff\xd9']
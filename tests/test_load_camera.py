@@ -0,0 +1,22 @@
+from server.database import db_session
+from server.models import Camera, FaceDetector, TrafficCounter
+from server.tasks import load_camera
+
+
+def test_processors_are_loaded_before_session_close(db):
+    camera = Camera(stream_url='load_camera', tz=0)
+    db_session.add(camera)
+    db_session.commit()
+    face_detector = FaceDetector(camera.id, '[]', 0.5)
+    face_detector.best_shot = True
+    db_session.add_all([face_detector, TrafficCounter(camera.id, '[]', 0.5)])
+    db_session.commit()
+    camera_id = camera.id
+    db_session.remove()
+
+    camera = load_camera(camera_id)
+    face_detectors = [proc for proc in camera.processors if isinstance(proc, FaceDetector)]
+    assert len(face_detectors) == 1
+    # subclass columns are read after the session is closed
+    assert face_detectors[0].best_shot is True
+    assert face_detectors[0].camera.id == camera_id
@@ -0,0 +1,69 @@
+import datetime as dt
+import random
+
+import pytest
+
+from server.database import engine
+from server.models import ProcessorEvent, ProcessorEventMinute
+from server.retention import delete_events
+from server.rollups import traffic_totals, update_rollups, PrecisionError
+
+
+def write_events(rows):
+    """
+    Writes events with rollups as event_writer does
+    """
+    with engine.begin() as conn:
+        conn.execute(ProcessorEvent.__table__.insert(), rows)
+        update_rollups(conn, rows)
+
+
+def test_traffic_totals_with_rollups_equal_raw_events(db):
+    rnd = random.Random(1)
+    start = dt.datetime(2024, 1, 1, 22, 0)
+    rows = [{'processor_id': rnd.choice([1, 2]), 'value': rnd.randint(1, 3),
+             'ts': start + dt.timedelta(seconds=rnd.uniform(0, 4 * 3600))} for _ in range(3000)]
+    for i in range(0, len(rows), 500):
+        write_events(rows[i:i + 500])
+
+    ranges = [(start, start + dt.timedelta(hours=4)),
+              (start + dt.timedelta(minutes=1), start + dt.timedelta(hours=2)),
+              (start + dt.timedelta(minutes=59, seconds=59), start + dt.timedelta(hours=3, seconds=1))]
+    for _ in range(30):
+        a, b = sorted(start + dt.timedelta(seconds=rnd.uniform(0, 4 * 3600)) for _ in range(2))
+        ranges.append((a, b))
+    # event ts themselves are borders too: start is excluded, stop is included
+    ranges.append((rows[0]['ts'], rows[1]['ts']) if rows[0]['ts'] < rows[1]['ts'] else (rows[1]['ts'], rows[0]['ts']))
+    for time_range in ranges:
+        for proc_id in (1, 2):
+            assert traffic_totals({proc_id: time_range}, use_rollups=True) == \
+                traffic_totals({proc_id: time_range}, use_rollups=False), time_range
+    batch = {1: ranges[1], 2: ranges[2]}
+    assert traffic_totals(batch, use_rollups=True) == traffic_totals(batch, use_rollups=False)
+
+
+def test_traffic_totals_after_retention(db):
+    rnd = random.Random(2)
+    start = dt.datetime(2024, 1, 1, 22, 0)
+    rows = [{'processor_id': 1, 'value': rnd.randint(1, 3),
+             'ts': start + dt.timedelta(seconds=rnd.uniform(0, 4 * 3600))} for _ in range(2000)]
+    write_events(rows)
+    minutes_since = start + dt.timedelta(hours=1)
+    raw_since = start + dt.timedelta(hours=3)
+    aligned = [(start, start + dt.timedelta(hours=4)),
+               (start, start + dt.timedelta(hours=2, minutes=30)),
+               (minutes_since, start + dt.timedelta(hours=3, seconds=1234.5)),
+               (start + dt.timedelta(hours=1, minutes=17), start + dt.timedelta(hours=3, minutes=30))]
+    expected = [traffic_totals({1: time_range}, use_rollups=False) for time_range in aligned]
+
+    delete_events(raw_since)
+    table = ProcessorEventMinute.__table__
+    with engine.begin() as conn:
+        conn.execute(table.delete().where(table.c.bucket < minutes_since))
+
+    for time_range, totals in zip(aligned, expected):
+        assert traffic_totals({1: time_range}, True, raw_since, minutes_since) == totals, time_range
+    for time_range in [(start + dt.timedelta(minutes=30), raw_since),
+                       (minutes_since, start + dt.timedelta(hours=2, seconds=30))]:
+        with pytest.raises(PrecisionError):
+            traffic_totals({1: time_range}, True, raw_since, minutes_since)
@@ -0,0 +1,99 @@
+import datetime as dt
+import logging
+
+import pytest
+
+from server.shedding import LoadShedder, live_edge_lag
+from server.telemetry import SHEDDING_LEVEL
+
+START = dt.datetime(2024, 1, 1)
+LADDER = [(30, 'lower_fps'), (60, 'larger_grid'), (90, 'skip_preview'), (120, 'skip_faces')]
+
+
+def watch_stream(shedder: LoadShedder, processing_seconds: float, duration: float = 1800,
+                 segment_duration: float = 10, n_segments: int = 6) -> int:
+    """
+    Replays the watcher loop on a live HLS playlist: the whole playlist is processed on start, then new segments
+    are processed after each sleep of (n_segments - 2) * segment_duration
+    :param processing_seconds: processing time of a segment
+    :return: max shedding level
+    """
+    now = START + dt.timedelta(seconds=n_segments * segment_duration)
+    processed = set()
+    max_level = 0
+    while now < START + dt.timedelta(seconds=duration):
+        newest = int((now - START).total_seconds() // segment_duration)
+        playlist = range(max(0, newest - n_segments), newest)
+        segment_ends = [START + dt.timedelta(seconds=(i + 1) * segment_duration) for i in playlist]
+        for i in playlist:
+            if i not in processed:
+                shedder.update(live_edge_lag(segment_ends, now))
+                max_level = max(max_level, shedder.level)
+                now += dt.timedelta(seconds=processing_seconds)
+                processed.add(i)
+        now += dt.timedelta(seconds=max(1, (n_segments - 2) * segment_duration))
+    return max_level
+
+
+def test_steady_state_is_not_shed():
+    # old segments of the playlist are 60 seconds behind live, but the watcher keeps up
+    assert watch_stream(LoadShedder(LADDER, 0.5, 0.5), processing_seconds=2) == 0
+
+
+def test_slow_watcher_is_shed():
+    assert watch_stream(LoadShedder(LADDER, 0.5, 0.5), processing_seconds=15) > 0
+
+
+def test_steps_are_applied_by_thresholds(caplog):
+    shedder = LoadShedder(LADDER, 0.5, 0.5)
+    assert SHEDDING_LEVEL.values[()] == 0
+    assert not shedder.update(30)
+    assert shedder.level == 0 and not shedder.active('lower_fps')
+    with caplog.at_level(logging.INFO):
+        assert shedder.update(31)
+    assert shedder.steps == ['lower_fps'] and SHEDDING_LEVEL.values[()] == 1
+    assert "['lower_fps'] are applied" in caplog.text
+    caplog.clear()
+    # several steps at once
+    with caplog.at_level(logging.INFO):
+        assert shedder.update(100)
+    assert shedder.steps == ['lower_fps', 'larger_grid', 'skip_preview'] and SHEDDING_LEVEL.values[()] == 3
+    assert "['larger_grid', 'skip_preview'] are applied" in caplog.text
+    assert shedder.active('skip_preview') and not shedder.active('skip_faces')
+
+
+def test_steps_are_removed_by_recovery_ratio(caplog):
+    shedder = LoadShedder(LADDER, 0.5, 0.5)
+    shedder.update(100)
+    # between the recovery lag and the threshold of the last step the level is kept
+    assert not shedder.update(45)
+    assert shedder.level == 3
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        assert shedder.update(44)
+    assert shedder.steps == ['lower_fps', 'larger_grid'] and SHEDDING_LEVEL.values[()] == 2
+    assert 'step skip_preview is removed' in caplog.text
+    # one step per segment, the last applied step first
+    assert shedder.update(0)
+    assert shedder.steps == ['lower_fps']
+    assert shedder.update(0)
+    assert shedder.level == 0 and SHEDDING_LEVEL.values[()] == 0
+    assert not shedder.update(0)
+
+
+def test_steps_degrade_work():
+    shedder = LoadShedder(LADDER, 0.5, 0.5)
+    assert shedder.sampling_fps(5) == 5
+    assert shedder.grid_size((2, 2)) == (2, 2)
+    shedder.update(31)
+    assert shedder.sampling_fps(5) == 2.5
+    assert shedder.grid_size((2, 2)) == (2, 2)
+    shedder.update(61)
+    assert shedder.grid_size((2, 2)) == (3, 3)
+
+
+def test_invalid_ladder():
+    with pytest.raises(ValueError):
+        LoadShedder([(30, 'lower_fps'), (60, 'skip_detector')], 0.5, 0.5)
+    with pytest.raises(ValueError):
+        LoadShedder([(60, 'lower_fps'), (30, 'larger_grid')], 0.5, 0.5)
@@ -0,0 +1,87 @@
+import datetime as dt
+import random
+
+from server.models import Camera, TrafficCounter, Frame, DetectedObject
+
+START = dt.datetime(2024, 1, 1)
+# lanes: (y, speed in frame widths per second)
+LANES = ((0.2, 0.08), (0.4, 0.12), (0.6, 0.16), (0.8, 0.1))
+
+
+def make_traffic(seed: int, n_cars: int = 360, duration: float = 900, headway: float = 3):
+    """
+    Cars crossing the frame from left to right
+    :return: [(ts of entering the frame in seconds, lane y, speed)]
+    """
+    rnd = random.Random(seed)
+    cars = []
+    while len(cars) < n_cars:
+        y, lane_speed = rnd.choice(LANES)
+        t, speed = rnd.uniform(0, duration), lane_speed * rnd.uniform(0.95, 1.05)
+        # cars of a lane keep headway at both edges of the frame
+        if all(min(abs(t + x / speed - t2 - x / s2) for x in (0, 1)) >= headway
+               for t2, y2, s2 in cars if y2 == y):
+            cars.append((t, y, speed))
+    return cars
+
+
+def make_counter(sampling_fps) -> TrafficCounter:
+    counter = TrafficCounter(1, '[[[0.55, 0], [1.01, 0], [1.01, 1], [0.55, 1]]]', 0.5)
+    counter.camera = Camera(watch_fps=5, watch_fps_min=0.5, stream_url='replay', tz=0)
+    counter.sampling_fps = sampling_fps
+    return counter
+
+
+def replay(cars, sampling_fps: float, seed: int) -> int:
+    """
+    Counts cars by detections sampled at sampling_fps (10% of detections are missed)
+    :return: number of counted tracks
+    """
+    rnd = random.Random(seed)
+    counter = make_counter(sampling_fps)
+    stop = max(t + 1 / speed for t, _, speed in cars) + 5
+    total = 0
+    for i in range(int(stop * sampling_fps)):
+        ts = i / sampling_fps
+        frame = Frame(None, START + dt.timedelta(seconds=ts))
+        for t, y, speed in cars:
+            x = (ts - t) * speed + rnd.gauss(0, 0.004)
+            if 0 <= x <= 1 and rnd.random() > 0.1:
+                frame.objects.append(DetectedObject(x - 0.03, y - 0.025, x + 0.03, y + 0.025, 0.9))
+        total += len(counter._analyze_frame(frame))
+    return total
+
+
+def test_traffic_count_at_reduced_fps():
+    for seed in (1, 2):
+        cars = make_traffic(seed)
+        full = replay(cars, 5, seed)
+        assert abs(full - len(cars)) <= len(cars) * 0.02
+        for fps in (2.5, 1):
+            assert abs(replay(cars, fps, seed) - full) <= full * 0.03, fps
+
+
+def analyze(counter: TrafficCounter, ts: float, *centers) -> int:
+    frame = Frame(None, START + dt.timedelta(seconds=ts))
+    frame.objects = [DetectedObject(x - 0.03, y - 0.025, x + 0.03, y + 0.025, 0.9) for x, y in centers]
+    return len(counter._analyze_frame(frame))
+
+
+def test_tracking_scale_at_reduced_fps():
+    # scale follows only the sampling rate, not gaps between frames
+    for sampling_fps, scale in ((None, 1), (10, 1), (5, 1), (2.5, 2), (1, 5), (0.5, 5)):
+        assert make_counter(sampling_fps)._interval_scale(5.0) == scale, sampling_fps
+
+    # track gap stays in seconds at reduced fps
+    counter = make_counter(1)
+    analyze(counter, 0, (0.1, 0.2))
+    analyze(counter, 4, (0.1, 0.8))
+    assert len(counter.scene.tracks) == 2
+    analyze(counter, 6, (0.12, 0.8))
+    assert len(counter.scene.tracks) == 1
+
+    # objects cross the zone in fewer frames at reduced fps
+    for sampling_fps, counted in ((5, 0), (1, 1)):
+        counter = make_counter(sampling_fps)
+        analyze(counter, 0, (0.5, 0.5))
+        assert analyze(counter, 1 / sampling_fps, (0.58, 0.5)) == counted, sampling_fps